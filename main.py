@@ -3,4 +3,16 @@ import sqlalchemy as sa
 from src.app.adapters.orm import metadata
 from src.app.service_layer.unit_of_work import POSTGRES_URI
 
-metadata.create_all(bind=sa.create_engine(POSTGRES_URI))
+engine = sa.create_engine(POSTGRES_URI)
+metadata.create_all(bind=engine)
+# create_all skips existing tables, add the columns and indexes they are missing
+inspector = sa.inspect(engine)
+with engine.begin() as conn:
+    for table in metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                conn.execute(sa.text(f"ALTER TABLE {table.name} ADD COLUMN {sa.schema.CreateColumn(column).compile(engine)}"))
+for table in metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
@@ -0,0 +1,20 @@
+"""
+This module runs the blocking calls of the adapters off the event loop.
+"""
+
+import asyncio
+import typing as t
+
+from sqlalchemy.util import concurrency
+
+T = t.TypeVar("T")
+
+
+def call(fn: t.Callable[..., T], *args, **kwargs) -> T:
+    """
+    Call `fn`, in a thread of the default executor when called from a coroutine run by
+    AsyncSqlAlchemyUnitOfWork.run_sync, so the event loop serves the other requests meanwhile.
+    """
+    if not concurrency.in_greenlet():
+        return fn(*args, **kwargs)
+    return concurrency.await_only(asyncio.to_thread(fn, *args, **kwargs))
@@ -0,0 +1,295 @@
+"""
+This module contains the AbstractCache class and its subclasses.
+"""
+
+import abc
+import asyncio
+import collections
+import json
+import logging
+import math
+import threading
+import time
+import typing as t
+
+import pydantic_core
+import redis
+
+from src.app.adapters import blocking
+
+logger = logging.getLogger(__name__)
+
+
+class AbstractCache(abc.ABC):
+    @abc.abstractmethod
+    def get(self, key: t.Hashable, default: t.Any = None) -> t.Any:
+        """
+        Abstract method to get a value by key, `default` when missing or expired.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> None:
+        """
+        Abstract method to set a value, expiring after `ttl` seconds or the ttl of the cache.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> bool:
+        """
+        Abstract method to set a value only if the key is missing or expired, returns whether it was set.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, key: t.Hashable) -> None:
+        """
+        Abstract method to remove a value by key.
+        """
+        raise NotImplementedError
+
+
+class LRUCache(AbstractCache):
+    """
+    Thread-safe cache bounded to `max_size` entries, the least recently used is evicted first.
+    Entries older than their ttl (seconds) are treated as missing.
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None, clock: t.Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # type: collections.OrderedDict[t.Hashable, tuple[float | None, t.Any]]
+
+    def get(self, key: t.Hashable, default: t.Any = None) -> t.Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> None:
+        with self.lock:
+            self._put(key, value, ttl)
+
+    def add(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > self.clock()):
+                return False
+            self._put(key, value, ttl)
+            return True
+
+    def _put(self, key: t.Hashable, value: t.Any, ttl: float | None) -> None:
+        ttl = ttl if ttl is not None else self.ttl
+        self.entries[key] = (self.clock() + ttl if ttl is not None else None, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key: t.Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Remove every value.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class RedisCache(AbstractCache):
+    """
+    Cache shared by the workers in a Redis compatible server. Values are stored as JSON and read back as such,
+    tuples as lists and datetimes as ISO strings.
+    The cache is best effort, a server error is logged and reads as a miss. A failed delete leaves the value
+    until its ttl, the server being down also means nobody reads it meanwhile.
+    Called from a coroutine, the round trips run in a thread, see `blocking.call`.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: float, prefix: str = "post-service:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: t.Hashable, default: t.Any = None) -> t.Any:
+        try:
+            raw = blocking.call(self.client.get, f"{self.prefix}{key}")
+        except redis.RedisError:
+            logger.exception("Failed to read %s from the cache", key)
+            return default
+        return json.loads(raw) if raw is not None else default
+
+    def set(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> None:
+        ttl = ttl if ttl is not None else self.ttl
+        try:
+            blocking.call(self.client.set, f"{self.prefix}{key}", pydantic_core.to_json(value), ex=math.ceil(ttl))
+        except redis.RedisError:
+            logger.exception("Failed to write %s to the cache", key)
+
+    def add(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> bool:
+        ttl = ttl if ttl is not None else self.ttl
+        try:
+            return bool(blocking.call(self.client.set, f"{self.prefix}{key}", pydantic_core.to_json(value), ex=math.ceil(ttl), nx=True))
+        except redis.RedisError:
+            # as if the key was missing, the caller goes on alone
+            logger.exception("Failed to add %s to the cache", key)
+            return True
+
+    def delete(self, key: t.Hashable) -> None:
+        try:
+            blocking.call(self.client.delete, f"{self.prefix}{key}")
+        except redis.RedisError:
+            logger.exception("Failed to delete %s from the cache", key)
+
+
+class TieredCache(AbstractCache):
+    """
+    In-process cache in front of a shared one. A value found in the shared cache is copied to the local one,
+    so the local ttl bounds how long a worker misses the invalidations done by the others.
+    """
+
+    def __init__(self, local: AbstractCache, remote: AbstractCache):
+        self.local = local
+        self.remote = remote
+
+    def get(self, key: t.Hashable, default: t.Any = None) -> t.Any:
+        value = self.local.get(key)
+        if value is None:
+            value = self.remote.get(key)
+            if value is None:
+                return default
+            self.local.set(key, value)
+        return value
+
+    def set(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> None:
+        self.remote.set(key, value, ttl)
+        self.local.set(key, value)
+
+    def add(self, key: t.Hashable, value: t.Any, ttl: float | None = None) -> bool:
+        # the shared cache decides, the local one may miss a value added by another worker
+        if not self.remote.add(key, value, ttl):
+            return False
+        self.local.set(key, value)
+        return True
+
+    def delete(self, key: t.Hashable) -> None:
+        self.remote.delete(key)
+        self.local.delete(key)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical loads: while the load of a key is in flight, the other callers of the key
+    wait for it and share its result, or its exception, instead of loading again.
+    Keys are (kind, ...) tuples, loads and coalesced calls are counted by kind.
+    Threads coalesce with `do`, coroutines with `ado`.
+
+    `wrote` is called after each commit: a load in flight may have read before it, so only the callers that
+    came before the commit share it and a caller after its own write always gets a load that sees it.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None  # type: t.Any
+            self.error = None  # type: BaseException | None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # type: dict[tuple, SingleFlight._Call]
+        self.async_calls = {}  # type: dict[tuple, asyncio.Future]
+        self.loads = collections.Counter()  # type: collections.Counter[str]
+        self.coalesced = collections.Counter()  # type: collections.Counter[str]
+        self.generation = 0
+
+    def wrote(self) -> None:
+        """
+        Stop sharing the loads in flight with the next callers, a write was committed after they started.
+        """
+        with self.lock:
+            self.generation += 1
+
+    def do(self, key: tuple, load: t.Callable[[], t.Any]) -> t.Any:
+        """
+        Run `load`, or wait for the identical one in flight. Every caller gets the same result object.
+        """
+        with self.lock:
+            key = (*key, self.generation)
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self._Call()
+                self.loads[key[0]] += 1
+            else:
+                self.coalesced[key[0]] += 1
+
+        if not leader:
+            blocking.call(call.done.wait)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = load()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    async def ado(self, key: tuple, load: t.Callable[[], t.Awaitable[t.Any]]) -> t.Any:
+        """
+        Await `load`, or the identical one in flight. Every caller gets the same result object.
+        Unlike `do`, waiting does not block the event loop running the load.
+        """
+        with self.lock:
+            key = (*key, self.generation)
+            future = self.async_calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.async_calls[key] = asyncio.get_running_loop().create_future()
+                self.loads[key[0]] += 1
+            else:
+                self.coalesced[key[0]] += 1
+
+        if not leader:
+            # a cancelled caller must not cancel the load of the others
+            return await asyncio.shield(future)
+
+        try:
+            result = await load()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieved, even without waiting callers
+            future.exception()
+            raise
+        finally:
+            with self.lock:
+                del self.async_calls[key]
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        Get the loads and coalesced calls by kind.
+        """
+        with self.lock:
+            return {kind: {"loads": self.loads[kind], "coalesced": self.coalesced[kind]} for kind in self.loads}
@@ -0,0 +1,138 @@
+"""
+This module contains the CounterBuffer class.
+"""
+
+import collections
+import logging
+import threading
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+# (table name, record id)
+CounterKey = tuple[str, str]
+
+
+class CounterBuffer:
+    """
+    Like count deltas committed to the database but not applied to the like_count of their records yet.
+
+    Each delta is written to the like_count_deltas table in the transaction of its like, so it is never lost;
+    the buffer only keeps the ids of the rows of this process and their sum per record, which the views add to
+    the like_count they read. A flush applies the rows to the counters and deletes them in one transaction, so
+    a failed or repeated flush never applies a row twice.
+
+    `seq` is odd while a flush is being applied. A record whose like_count was read while `seq` was even and
+    unchanged is consistent with the buffer at that `seq`, see `pending_since`.
+    """
+
+    # flushed records remembered for `pending_since`, older ones read as flushed
+    MAX_FLUSHED = 100000
+
+    def __init__(self):
+        """
+        Initialize the CounterBuffer class.
+        """
+        self.lock = threading.Lock()
+        self.deltas = collections.Counter()  # type: collections.Counter[CounterKey]
+        self.delta_ids = []  # type: list[int]
+        self.in_flight = collections.Counter()  # type: collections.Counter[CounterKey]
+        self.seq = 0
+        # record: seq once its last flush was applied, for the seqs after `forgotten`
+        self.flushed = {}  # type: dict[CounterKey, int]
+        self.forgotten = 0
+        self._stop = threading.Event()
+        self._thread = None  # type: threading.Thread | None
+
+    def add(self, table: str, id: str, delta: int, delta_id: int) -> None:
+        """
+        Buffer a delta of the like_count of a record, committed as the row `delta_id` of like_count_deltas.
+        """
+        with self.lock:
+            self.deltas[(table, id)] += delta
+            self.delta_ids.append(delta_id)
+
+    def pending(self, table: str, id: str) -> int:
+        """
+        Get the delta of a record buffered in this process, including a flush being applied.
+        Views must use `pending_since`, it does not tell whether a like_count read has seen the flush.
+        """
+        with self.lock:
+            return self.deltas[(table, id)] + self.in_flight[(table, id)]
+
+    def pending_since(self, table: str, id: str, seq: int) -> int | None:
+        """
+        Get the delta to add to the like_count of a record read at `seq`.
+
+        Returns:
+            None when a flush of the record was applied since, the record must be read again.
+        """
+        key = (table, id)
+        with self.lock:
+            if seq % 2 or seq < self.forgotten or self.flushed.get(key, -1) > seq:
+                return None
+            # the flush being applied started after the read, its deltas are not in the record
+            return self.deltas[key] + (self.in_flight[key] if self.seq % 2 else 0)
+
+    def flush(self, apply: t.Callable[[list[int]], t.Iterable[CounterKey]]) -> None:
+        """
+        Apply the buffered deltas with `apply`, which gets the ids of their rows, must apply and delete them
+        in one transaction and returns the records it changed. Deltas that fail to apply are kept for the next flush.
+        """
+        with self.lock:
+            if self.seq % 2:
+                return
+            self.in_flight, self.deltas = self.deltas, collections.Counter()
+            delta_ids, self.delta_ids = self.delta_ids, []
+            self.seq += 1
+
+        try:
+            applied = set(apply(delta_ids))
+        except Exception:
+            logger.exception("Failed to flush %d like counters", len(self.in_flight))
+            with self.lock:
+                self.deltas.update(self.in_flight)
+                self.delta_ids = delta_ids + self.delta_ids
+                self.in_flight = collections.Counter()
+                self.seq += 1
+            return
+
+        with self.lock:
+            self.seq += 1
+            for key in applied | set(self.in_flight):
+                # moved to the end, the dict stays ordered by flush
+                self.flushed.pop(key, None)
+                self.flushed[key] = self.seq
+            self.in_flight = collections.Counter()
+            if len(self.flushed) > self.MAX_FLUSHED:
+                # dicts keep insertion order, the oldest flushes come first
+                dropped = list(self.flushed)[: len(self.flushed) // 2]
+                self.forgotten = max(self.flushed[key] for key in dropped)
+                for key in dropped:
+                    del self.flushed[key]
+
+    def start(self, apply: t.Callable[[list[int]], t.Iterable[CounterKey]], interval: float) -> None:
+        """
+        Flush the buffer with `apply` every `interval` seconds in a daemon thread.
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                self.flush(apply)
+            self.flush(apply)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="counter-buffer-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the flush thread after a last flush.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
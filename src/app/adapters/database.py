@@ -0,0 +1,147 @@
+"""
+This module contains the engines of the database and the statistics of their connection pools.
+"""
+
+import os
+import threading
+import time
+import typing as t
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy import pool
+from sqlalchemy.ext import asyncio as sa_asyncio
+
+from src.app.config import settings
+
+
+class _TimedPool:
+    """
+    Mixin recording how long the checkouts of a queue pool wait for a connection, opening a new one included.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait_time = time.perf_counter() - start
+            with self.stats_lock:
+                self.waits += 1
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+
+class TimedQueuePool(_TimedPool, pool.QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedPool, pool.AsyncAdaptedQueuePool):
+    pass
+
+
+def _pool_options(**overrides) -> dict:
+    options = dict(
+        pool_size=settings.POSTGRES_POOL_SIZE,
+        max_overflow=settings.POSTGRES_MAX_OVERFLOW,
+        pool_timeout=settings.POSTGRES_POOL_TIMEOUT,
+        pool_recycle=settings.POSTGRES_POOL_RECYCLE,
+        pool_pre_ping=settings.POSTGRES_POOL_PRE_PING,
+    )
+    options.update(overrides)
+    return options
+
+
+def create_engine(url: str, statement_timeout: int = settings.POSTGRES_STATEMENT_TIMEOUT_MS, **overrides) -> sa.Engine:
+    """
+    Create an engine with the pool settings, `overrides` are passed to `sqlalchemy.create_engine`.
+    """
+    connect_args = {"options": f"-c statement_timeout={statement_timeout}"} if statement_timeout else {}
+    return sa.create_engine(url, poolclass=TimedQueuePool, connect_args=connect_args, **_pool_options(**overrides))
+
+
+def create_async_engine(
+    url: str, statement_timeout: int = settings.POSTGRES_STATEMENT_TIMEOUT_MS, **overrides
+) -> sa_asyncio.AsyncEngine:
+    """
+    Create an asyncpg engine with the pool settings, `overrides` are passed to `create_async_engine`.
+    """
+    connect_args = {"server_settings": {"statement_timeout": str(statement_timeout)}} if statement_timeout else {}
+    return sa_asyncio.create_async_engine(
+        url, poolclass=TimedAsyncAdaptedQueuePool, connect_args=connect_args, **_pool_options(**overrides)
+    )
+
+
+def pool_stats(engine: sa.Engine | sa_asyncio.AsyncEngine) -> dict:
+    """
+    Get the statistics of the connection pool of an engine.
+    """
+    if isinstance(engine, sa_asyncio.AsyncEngine):
+        engine = engine.sync_engine
+    engine_pool = engine.pool
+    stats = {"size": 0, "checked_in": 0, "checked_out": 0, "overflow": 0}
+    if isinstance(engine_pool, pool.QueuePool):
+        stats = {
+            "size": engine_pool.size(),
+            "checked_in": engine_pool.checkedin(),
+            "checked_out": engine_pool.checkedout(),
+            # negative while the pool has not opened `size` connections yet
+            "overflow": max(engine_pool.overflow(), 0),
+        }
+    if isinstance(engine_pool, _TimedPool):
+        with engine_pool.stats_lock:
+            stats.update(waits=engine_pool.waits, wait_time=engine_pool.wait_time, max_wait_time=engine_pool.max_wait_time)
+    return stats
+
+
+class LazySessionFactory:
+    """
+    Session factory creating its engine on the first session of the process.
+
+    Nothing connects at import, and a process forked from one that did gets an engine of its own: the
+    connections of the parent are left to the parent, sharing a socket between processes corrupts it.
+    """
+
+    def __init__(self, engine_factory: t.Callable[[], sa.Engine]):
+        self.engine_factory = engine_factory
+        self.lock = threading.Lock()
+        self._engine = None  # type: sa.Engine | None
+        self._sessionmaker = None  # type: orm.sessionmaker | None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def engine(self) -> sa.Engine:
+        with self.lock:
+            if self._engine is None:
+                self._engine = self.engine_factory()
+                self._sessionmaker = orm.sessionmaker(bind=self._engine)
+            return self._engine
+
+    def __call__(self) -> orm.Session:
+        self.engine
+        return t.cast(orm.sessionmaker, self._sessionmaker)()
+
+    def _after_fork(self):
+        # the lock may have been held by another thread of the parent
+        self.lock = threading.Lock()
+        if self._engine is not None:
+            # drop the connections of the parent without closing them
+            self._engine.dispose(close=False)
+        self._engine = None
+        self._sessionmaker = None
+
+
+def engine_of(session_factory: t.Callable[[], orm.Session]) -> sa.Engine:
+    """
+    Get the engine of a session factory, lazy or not.
+    """
+    if isinstance(session_factory, LazySessionFactory):
+        return session_factory.engine
+    return t.cast(orm.sessionmaker, session_factory).kw["bind"]
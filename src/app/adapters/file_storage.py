@@ -3,19 +3,28 @@ This module contains the AbstractRepository class and its subclasses.
 """
 
 import abc
+import concurrent.futures
 import datetime
 import io
 import tempfile
+import threading
 import typing as t
 
 import fastapi
 import minio
+import minio.deleteobjects
 import minio.helpers
 
+from src.app.adapters import blocking
+from src.app.adapters import cache
+from src.app.config import settings
+
 
 class AbstractFileStorage(abc.ABC):
     def __init__(self):
         self.BUCKET_NAME = "posts"
+        self.upload_pool = None  # type: concurrent.futures.ThreadPoolExecutor | None
+        self.upload_pool_lock = threading.Lock()
 
         """
         Initialize the AbstractFileStorage class.
@@ -26,11 +35,24 @@ class AbstractFileStorage(abc.ABC):
         Add a file to the FileStorage.
         """
         try:
-            self._add(path, f, **kwargs)
+            blocking.call(self._add, path, f, **kwargs)
         except Exception as e:
             return 1
         return 0
 
+    def add_many(self, files: list[tuple[str, fastapi.UploadFile]]) -> list[int]:
+        """
+        Add files to the FileStorage in parallel, at most MINIO_UPLOAD_WORKERS at a time per process.
+        Returns the result of `add` for each file, in order.
+        """
+        if len(files) <= 1:
+            return [self.add(path, f) for path, f in files]
+
+        with self.upload_pool_lock:
+            if self.upload_pool is None:
+                self.upload_pool = concurrent.futures.ThreadPoolExecutor(settings.MINIO_UPLOAD_WORKERS, thread_name_prefix="upload")
+        return blocking.call(lambda: list(self.upload_pool.map(lambda file: self.add(*file), files)))
+
     def get(self, path: str) -> str:
         """
         Get a presigned URL from the FileStorage by path.
@@ -48,7 +70,14 @@ class AbstractFileStorage(abc.ABC):
         """
         Delete from the FileStorage by path.
         """
-        self._delete(path)
+        blocking.call(self._delete, path)
+
+    def delete_prefix(self, prefix: str) -> int:
+        """
+        Delete every file whose path starts with `prefix` from the FileStorage, in bulk.
+        Returns the number of files deleted.
+        """
+        return blocking.call(self._delete_prefix, prefix)
 
     @abc.abstractmethod
     def _add(self, path: str, f: fastapi.UploadFile, **kwargs):
@@ -78,30 +107,55 @@ class AbstractFileStorage(abc.ABC):
         """
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def _delete_prefix(self, prefix: str) -> int:
+        """
+        Abstract method to delete every file under a prefix from the FileStorage.
+        """
+        raise NotImplementedError
+
 
 class MinIOFileStorage(AbstractFileStorage):
 
     def __init__(self, client: minio.Minio):
         """
         Initialize the MinIOFileStorage class.
+        No request is sent to MinIO until a file is written.
         """
         super().__init__()
 
         self.client = client
-        if not self.client.bucket_exists(self.BUCKET_NAME):
-            self.client.make_bucket(self.BUCKET_NAME)
+        self.bucket_checked = False
+        self.bucket_lock = threading.Lock()
+        # reuse a presigned URL until half of its validity is left, clients always get a fresh enough link
+        self.url_expires = datetime.timedelta(seconds=settings.MINIO_PRESIGNED_URL_EXPIRES)
+        self.urls = cache.LRUCache(settings.MINIO_PRESIGNED_URL_CACHE_SIZE, ttl=settings.MINIO_PRESIGNED_URL_EXPIRES / 2)
+
+    def ensure_bucket(self) -> None:
+        """
+        Create the bucket if it does not exist, only checked once per storage.
+        """
+        if self.bucket_checked:
+            return
+        with self.bucket_lock:
+            if not self.bucket_checked:
+                if not self.client.bucket_exists(self.BUCKET_NAME):
+                    self.client.make_bucket(self.BUCKET_NAME)
+                self.bucket_checked = True
 
     def _add(self, path: str, f: fastapi.UploadFile, **kwargs) -> int:
         """
         Add a file to the FileStorage.
         """
-        file_data = f.file.read()
+        self.ensure_bucket()
+        # stream the spooled file, the client reads and uploads it one part at a time
         self.client.put_object(
             bucket_name=self.BUCKET_NAME,
             object_name=path,
-            data=io.BytesIO(file_data),
-            length=len(file_data),
-            content_type=f.content_type,
+            data=f.file,
+            length=f.size if f.size is not None else -1,
+            content_type=f.content_type or "application/octet-stream",
+            part_size=settings.MINIO_UPLOAD_PART_SIZE,
         )
         return 0
 
@@ -109,7 +163,11 @@ class MinIOFileStorage(AbstractFileStorage):
         """
         Get a presigned URL from the FileStorage by path.
         """
-        return self.client.presigned_get_object(self.BUCKET_NAME, path)
+        url = self.urls.get(path)
+        if url is None:
+            url = self.client.presigned_get_object(self.BUCKET_NAME, path, expires=self.url_expires)
+            self.urls.set(path, url)
+        return url
 
     def _edit(self, path: str, f: fastapi.UploadFile):
         """
@@ -121,4 +179,19 @@ class MinIOFileStorage(AbstractFileStorage):
         """
         Delete from the FileStorage by path.
         """
-        raise NotImplementedError
+        self.client.remove_object(self.BUCKET_NAME, path)
+        self.urls.delete(path)
+
+    def _delete_prefix(self, prefix: str) -> int:
+        """
+        Delete every file under a prefix, with one listing and one delete request per 1000 files.
+        """
+        self.ensure_bucket()
+        paths = [o.object_name for o in self.client.list_objects(self.BUCKET_NAME, prefix=prefix, recursive=True)]
+        # the deletes are sent while the errors are read
+        errors = list(self.client.remove_objects(self.BUCKET_NAME, (minio.deleteobjects.DeleteObject(path) for path in paths)))
+        if errors:
+            raise RuntimeError(f"Failed to delete {len(errors)} files under {prefix}: {errors[0]}")
+        for path in paths:
+            self.urls.delete(path)
+        return len(paths)
@@ -1,26 +1,40 @@
-# """
-# Module-level docstring describing the purpose of the module.
-# """
-
-# import logging
-
-# import redis
-
-# from src.app import config
-# from src.app.domain import events
-
-# logger = logging.getLogger(__name__)
-
-# r = redis.Redis(host=config.settings.REDIS_HOST, port=config.settings.REDIS_PORT, db=2)
-
-
-# def publish(channel, event: events.Event):
-#     """
-#     Method-level docstring describing the purpose of the method.
-
-#     Args:
-#         channel: The channel to publish the event to.
-#         event: The event to be published.
-#     """
-#     logging.info("publishing: channel=%s, event=%s", channel, event)
-#     r.publish(channel, event.model_dump_json())
+"""
+This module publishes the events of the outbox to a Redis stream.
+"""
+
+import logging
+import typing as t
+
+import redis
+
+from src.app import config
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxMessage(t.Protocol):
+    id: int
+    type: str
+    payload: str
+
+
+def publish(client: redis.Redis, messages: t.Sequence[OutboxMessage]) -> None:
+    """
+    Append events to the event stream, in one round trip.
+    A stream, unlike a channel, keeps the events for consumers that are down.
+
+    Args:
+        client: The Redis client.
+        messages: The events to be published, as read from the outbox.
+    """
+    logger.info("publishing %d events to %s", len(messages), config.settings.EVENT_STREAM)
+    pipe = client.pipeline(transaction=False)
+    for message in messages:
+        # the outbox id lets consumers skip the events published twice
+        pipe.xadd(
+            config.settings.EVENT_STREAM,
+            {"id": message.id, "type": message.type, "payload": message.payload},
+            maxlen=config.settings.EVENT_STREAM_MAXLEN,
+            approximate=True,
+        )
+    pipe.execute()
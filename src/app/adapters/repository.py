@@ -6,8 +6,17 @@ import abc
 import datetime
 import typing as t
 
+import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
 
+from src.app.adapters.orm import comments
+from src.app.adapters.orm import images
+from src.app.adapters.orm import like_count_deltas
+from src.app.adapters.orm import likes
+from src.app.adapters.orm import outbox
+from src.app.adapters.orm import posts
+from src.app.domain import events
 from src.app.domain import model
 
 
@@ -41,12 +50,17 @@ class AbstractRepository(abc.ABC):
         self._edit(r, _new)
         self.seen.add(r)
 
-    def delete(self, r: model.BaseModel) -> None:
+    def delete(self, r: model.BaseModel) -> t.Any:
         """
         Delete a record from the repository.
+
+        Returns:
+            What was deleted with the record, see the `_delete` of the repository.
         """
-        self._delete(r)
-        self.seen.remove(r)
+        deleted = self._delete(r)
+        # still seen, the events of a deleted record are published too
+        self.seen.add(r)
+        return deleted
 
     def query(self, **kwargs) -> list[model.BaseModel]:
         """
@@ -147,6 +161,14 @@ class SqlAlchemyRepository(AbstractRepository):
         _model = self.model
         return self.session.query(_model).filter_by(**kwargs).all()
 
+    def increment(self, id: str, field: str, delta: int = 1) -> None:
+        """
+        Add `delta` to a counter column of a record in one UPDATE, without loading it.
+        Concurrent increments are not lost, whatever the isolation level.
+        """
+        table = self.model.__table__
+        self.session.execute(sa.update(table).where(table.c.id == id).values({field: table.c[field] + delta}))
+
     @property
     def _q(self) -> orm.query.Query:
         """
@@ -154,3 +176,246 @@ class SqlAlchemyRepository(AbstractRepository):
         Use to execute complex queries.
         """
         return self.session.query(self.model)
+
+
+class SqlAlchemyPostRepository(SqlAlchemyRepository):
+    def __init__(self, session: orm.Session):
+        """
+        Initialize the SqlAlchemyPostRepository class.
+        """
+        super().__init__(session, model.Post)
+
+    def _delete(self, r: model.BaseModel) -> list[str]:
+        """
+        Delete a post with its comments, replies, likes and images, one DELETE per table and nothing loaded.
+        The files of the images are left to the remove_post_images handler.
+
+        Returns:
+            The ids of the comments and replies deleted.
+        """
+        # the likes and replies of the comments carry the post_id too
+        self.session.execute(sa.delete(likes).where(likes.c.post_id == r.id))
+        comment_ids = self.session.execute(sa.delete(comments).where(comments.c.post_id == r.id).returning(comments.c.id)).scalars().all()
+        self.session.execute(sa.delete(images).where(images.c.post_id == r.id))
+        self.session.execute(sa.delete(posts).where(posts.c.id == r.id))
+        # already deleted, the session must not flush it
+        self.session.expunge(r)
+        return list(comment_ids)
+
+
+class SqlAlchemyCommentRepository(SqlAlchemyRepository):
+    def __init__(self, session: orm.Session):
+        """
+        Initialize the SqlAlchemyCommentRepository class.
+        """
+        super().__init__(session, model.Comment)
+
+    def _delete(self, r: model.BaseModel) -> list[str]:
+        """
+        Delete a comment with its replies, at every level, and their likes, one DELETE per table and nothing loaded,
+        and take them all off the comment_count of the post.
+        As with the mapper, a comment changed or deleted since it was read fails the delete with StaleDataError.
+
+        Returns:
+            The ids of the replies deleted.
+        """
+        thread = sa.select(comments.c.id).where(comments.c.id == r.id, comments.c.version == r.version).cte("thread", recursive=True)
+        thread = thread.union_all(sa.select(comments.c.id).where(comments.c.comment_id == thread.c.id))
+        self.session.execute(sa.delete(likes).where(likes.c.comment_id.in_(sa.select(thread.c.id))))
+        deleted = self.session.execute(
+            sa.delete(comments).where(comments.c.id.in_(sa.select(thread.c.id))).returning(comments.c.id)
+        ).all()
+        if not deleted:
+            raise orm.exc.StaleDataError(f"comment {r.id} was changed or deleted since it was read")
+        self.session.execute(
+            sa.update(posts).where(posts.c.id == r.post_id).values(comment_count=posts.c.comment_count - len(deleted))
+        )
+        # already deleted, the session must not flush it
+        self.session.expunge(r)
+        return [id for (id,) in deleted if id != r.id]
+
+
+class SqlAlchemyLikeRepository(SqlAlchemyRepository):
+    def __init__(self, session: orm.Session):
+        """
+        Initialize the SqlAlchemyLikeRepository class.
+        """
+        super().__init__(session, model.Like)
+
+    def toggle(self, like: model.Like) -> int:
+        """
+        Add the like if it does not exist yet, remove it otherwise.
+        Only touches the row of the like, never the whole likes collection.
+
+        Returns:
+            The change of the like_count of the liked post or comment: 1, -1, or 0 when a concurrent
+            request added the same like first.
+        """
+        _like = model.Like
+        if like.comment_id is None:
+            key = sa.and_(_like.post_id == like.post_id, _like.comment_id.is_(None))
+        else:
+            key = _like.comment_id == like.comment_id
+
+        deleted = self.session.execute(sa.delete(_like).where(_like.user_id == like.user_id, key).returning(_like.id)).first()
+        if deleted is not None:
+            return -1
+
+        inserted = self.session.execute(
+            postgresql.insert(_like)
+            .values(
+                id=like.id,
+                user_id=like.user_id,
+                post_id=like.post_id,
+                comment_id=like.comment_id,
+                created_time=like.created_time,
+            )
+            .on_conflict_do_nothing()
+            .returning(_like.id)
+        ).first()
+        return 0 if inserted is None else 1
+
+    def add_like_count_delta(self, table_name: str, id: str, delta: int) -> int:
+        """
+        Record a delta of the like_count of a record, applied later by `apply_like_count_deltas`.
+        It is committed with the like, so the like and its count never disagree.
+
+        Returns:
+            The id of the delta.
+        """
+        return self.session.execute(
+            sa.insert(like_count_deltas).values(table_name=table_name, record_id=id, delta=delta).returning(like_count_deltas.c.id)
+        ).scalar_one()
+
+    def like_counts(self, table_name: str, ids: list[str]) -> dict[str, int]:
+        """
+        Read the like_count of records with their deltas not applied yet, in one statement: a flush applies and
+        deletes the deltas in one transaction, so the sum counts each like once whatever the flushes meanwhile.
+
+        Returns:
+            The like_count of the records found, by id.
+        """
+        table = posts if table_name == "posts" else comments
+        pending = (
+            sa.select(like_count_deltas.c.record_id, sa.func.sum(like_count_deltas.c.delta).label("delta"))
+            .where(like_count_deltas.c.table_name == table_name, like_count_deltas.c.record_id.in_(ids))
+            .group_by(like_count_deltas.c.record_id)
+            .subquery()
+        )
+        rows = self.session.execute(
+            sa.select(table.c.id, table.c.like_count + sa.func.coalesce(pending.c.delta, 0))
+            .outerjoin(pending, pending.c.record_id == table.c.id)
+            .where(table.c.id.in_(ids))
+        ).all()
+        return {id: int(like_count) for id, like_count in rows}
+
+    def apply_like_count_deltas(self, ids: list[int], orphan_age: datetime.timedelta) -> dict[tuple[str, str], int]:
+        """
+        Apply the deltas `ids`, and those older than `orphan_age`, to the like_count of their records and delete them.
+        Applied in the transaction that deletes them, a delta is applied once whoever flushes it and however often.
+
+        Returns:
+            The applied deltas, summed by (table name, id).
+        """
+        old = like_count_deltas.c.created_time < sa.func.now() - orphan_age
+        rows = self.session.execute(
+            sa.delete(like_count_deltas)
+            .where(sa.or_(like_count_deltas.c.id.in_(ids), old) if ids else old)
+            .returning(like_count_deltas.c.table_name, like_count_deltas.c.record_id, like_count_deltas.c.delta)
+        ).all()
+        deltas = {}  # type: dict[tuple[str, str], int]
+        for table_name, id, delta in rows:
+            deltas[(table_name, id)] = deltas.get((table_name, id), 0) + delta
+        self.add_like_counts(deltas)
+        return deltas
+
+    def add_like_counts(self, deltas: dict[tuple[str, str], int]) -> None:
+        """
+        Add deltas keyed by (table name, id) to the like_count of posts and comments,
+        with one UPDATE per table.
+        """
+        for _model in (model.Post, model.Comment):
+            table = _model.__table__
+            rows = [(id, delta) for (name, id), delta in deltas.items() if name == table.name]
+            if not rows:
+                continue
+            values = sa.values(sa.column("id", sa.String), sa.column("delta", sa.Integer), name="deltas").data(rows)
+            self.session.execute(
+                sa.update(table).where(table.c.id == values.c.id).values(like_count=table.c.like_count + values.c.delta)
+            )
+
+
+class SqlAlchemyOutboxRepository:
+    def __init__(self, session: orm.Session):
+        """
+        Initialize the SqlAlchemyOutboxRepository class.
+        """
+        self.session = session
+
+    def add(self, new_events: list[events.Event]) -> None:
+        """
+        Add events to the outbox, they are committed with the session.
+        """
+        if new_events:
+            self.session.execute(
+                sa.insert(outbox), [{"type": type(event).__name__, "payload": event.model_dump_json()} for event in new_events]
+            )
+
+    def fetch(self, limit: int) -> list[sa.Row]:
+        """
+        Get and lock the oldest events of the outbox, skipping the ones locked by another relay.
+        """
+        return self.session.execute(
+            sa.select(outbox.c.id, outbox.c.type, outbox.c.payload).order_by(outbox.c.id).limit(limit).with_for_update(skip_locked=True)
+        ).all()
+
+    def delete(self, ids: list[int]) -> None:
+        """
+        Remove published events from the outbox.
+        """
+        self.session.execute(sa.delete(outbox).where(outbox.c.id.in_(ids)))
+
+
+class SqlAlchemyCountRepository:
+    """
+    Recomputes the denormalized counters from the comments: comment_count of posts and reply_count of comments.
+    """
+
+    # table name: (table, counter column, column of comments referencing the table)
+    COUNTERS = {
+        "posts": (posts, "comment_count", "post_id"),
+        "comments": (comments, "reply_count", "comment_id"),
+    }
+
+    def __init__(self, session: orm.Session):
+        """
+        Initialize the SqlAlchemyCountRepository class.
+        """
+        self.session = session
+
+    def ids(self, table_name: str, after: str | None, limit: int) -> list[str]:
+        """
+        Get the ids of the next records of a table, in id order.
+        """
+        table = self.COUNTERS[table_name][0]
+        q = sa.select(table.c.id).order_by(table.c.id).limit(limit)
+        if after is not None:
+            q = q.where(table.c.id > after)
+        return list(self.session.execute(q).scalars())
+
+    def reconcile(self, table_name: str, ids: list[str]) -> list[str]:
+        """
+        Set the counter of the records to the count of their comments, in one UPDATE.
+
+        Returns:
+            The ids of the records whose counter had drifted.
+        """
+        table, counter, reference = self.COUNTERS[table_name]
+        # aliased, the replies of a comment are comments too
+        counted = comments.alias("counted")
+        count = sa.select(sa.func.count()).where(counted.c[reference] == table.c.id).scalar_subquery()
+        return list(
+            self.session.execute(
+                sa.update(table).where(table.c.id.in_(ids), table.c[counter] != count).values({counter: count}).returning(table.c.id)
+            ).scalars()
+        )
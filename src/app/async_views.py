@@ -0,0 +1,69 @@
+"""
+Async versions of the views, for the endpoints run on the event loop
+"""
+
+import copy
+
+from src.app import views
+from src.app.entrypoints import schema
+from src.app.service_layer import unit_of_work
+
+
+async def get_post(post_id: str, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Get a post by its id.
+    """
+    # a shared cache is read off the event loop, see RedisCache
+    key = await uow.run_sync(views._versioned_key, f"post:{post_id}", uow)
+    loaded = await uow.run_sync(uow.cache.get, key)
+    if loaded is None:
+        # on a miss of a hot post, concurrent requests share one load
+        loaded = await uow.loads.ado(("get_post", post_id), lambda: uow.run_sync(views._load_post, post_id, uow))
+        await uow.run_sync(uow.cache.set, key, loaded)
+    seq, post = copy.deepcopy(loaded)
+    # may read the like_count again from the database, see `views._with_pending_likes`
+    return await uow.run_sync(views._present_post, post, seq, uow)
+
+
+async def find_post(title: str, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Find a post by its title.
+    """
+    return await uow.run_sync(views.find_post, title, uow)
+
+
+async def get_comments(post_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None = None, cursor: str | None = None):
+    """
+    Get comments of a post, oldest first.
+    """
+    return await uow.run_sync(views.get_comments, post_id, uow, limit, cursor)
+
+
+async def get_comment_thread(post_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None = None, cursor: str | None = None):
+    """
+    Get the comments of a post as a tree.
+    """
+    return await uow.run_sync(views.get_comment_thread, post_id, uow, limit, cursor)
+
+
+async def get_comment(comment_id: str, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Get a comment by its id.
+    """
+    return await uow.run_sync(views.get_comment, comment_id, uow)
+
+
+async def get_reply_comments(comment_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None = None, cursor: str | None = None):
+    """
+    Get reply comments of a comment, oldest first.
+    """
+    return await uow.run_sync(views.get_reply_comments, comment_id, uow, limit, cursor)
+
+
+async def get_posts(params: schema.GetPostsRequest, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Get all posts.
+    Concurrent requests with the same parameters share one load.
+    """
+    loaded = await uow.loads.ado(views._posts_key(params), lambda: uow.run_sync(views._load_posts, params, uow))
+    return await uow.run_sync(views._present_posts, loaded, uow)
@@ -2,25 +2,41 @@
 This module contains the bootstrap function for the allocation application.
 """
 
+import functools
 import inspect
+import logging
 import typing as t
 
+import redis
+
+from src.app import config
+from src.app import views
+from src.app.adapters import cache
 from src.app.adapters import orm
+from src.app.service_layer import event_handler_pool
 from src.app.service_layer import handlers
 from src.app.service_layer import messagebus
 from src.app.service_layer import unit_of_work
 
+logger = logging.getLogger(__name__)
+
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork | t.Type[unit_of_work.AbstractUnitOfWork] = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork | t.Type[unit_of_work.AbstractUnitOfWork] | None = None,
+    event_pool: event_handler_pool.EventHandlerPool | None = None,
+    idempotency_store: cache.AbstractCache | None = None,
 ) -> messagebus.MessageBus:
     """
     Bootstrap the allocation application.
 
     Args:
         start_orm: A boolean indicating whether to start the ORM.
-        uow: An instance of the unit of work.
+        uow: An instance or class of the unit of work, a SqlAlchemyUnitOfWork when not given.
+        event_pool: The pool running the background event handlers, built from the settings when not given.
+            Without pool, every event handler runs in the request.
+        idempotency_store: The store of the results of the commands sent with an idempotency key, built from
+            the settings when not given.
         publish: A callable for publishing events.
 
     Returns:
@@ -29,12 +45,37 @@ def bootstrap(
     if start_orm:
         orm.start_mappers()
 
-    if isinstance(uow, type):
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+    elif isinstance(uow, type):
         uow = uow()
 
+    def flush_counters(ids: list[int]):
+        applied = list(uow.flush_counters(ids))
+        views.invalidate_like_counts(applied, uow)
+        return applied
+
+    uow.counters.start(flush_counters, interval=config.settings.LIKE_COUNTER_FLUSH_INTERVAL)
+
+    if event_pool is None and config.settings.EVENT_HANDLER_WORKERS > 0:
+        event_pool = event_handler_pool.EventHandlerPool(
+            workers=config.settings.EVENT_HANDLER_WORKERS,
+            max_pending=config.settings.EVENT_HANDLER_MAX_PENDING,
+            concurrency=config.settings.EVENT_HANDLER_CONCURRENCY,
+            submit_timeout=config.settings.EVENT_HANDLER_SUBMIT_TIMEOUT,
+        )
+    background = handlers.BACKGROUND_EVENT_HANDLERS if event_pool is not None else set()
+
+    if idempotency_store is None:
+        idempotency_store = default_idempotency_store()
+
     dependencies = {"uow": uow}
     injected_event_handlers = {
-        event_type: [inject_dependencies(handler, dependencies) for handler in event_handlers]
+        event_type: [inject_dependencies(handler, dependencies) for handler in event_handlers if handler not in background]
+        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+    }
+    injected_background_event_handlers = {
+        event_type: [inject_dependencies(handler, dependencies) for handler in event_handlers if handler in background]
         for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
     }
     injected_command_handlers = {
@@ -45,9 +86,49 @@ def bootstrap(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        background_event_handlers=injected_background_event_handlers,
+        event_pool=event_pool,
+        idempotency_store=idempotency_store,
+        idempotency_ttl=config.settings.IDEMPOTENCY_KEY_TTL,
+        idempotency_pending_ttl=idempotency_pending_ttl(),
+        max_retries=config.settings.COMMAND_MAX_RETRIES,
+        retry_base_delay=config.settings.COMMAND_RETRY_BASE_DELAY,
+        retry_max_delay=config.settings.COMMAND_RETRY_MAX_DELAY,
     )
 
 
+def default_idempotency_store() -> cache.AbstractCache:
+    """
+    Build the idempotency store from the settings, shared by the workers in Redis whenever a Redis db is set.
+    The in-process store only answers the retries reaching the worker of the first run.
+    """
+    db = config.settings.IDEMPOTENCY_REDIS_DB
+    if db is None:
+        db = config.settings.VIEW_CACHE_REDIS_DB
+    if db is None:
+        logger.warning("No Redis db for the idempotency keys, a retry reaching another worker runs its command again")
+        return cache.LRUCache(config.settings.IDEMPOTENCY_STORE_SIZE, ttl=config.settings.IDEMPOTENCY_KEY_TTL)
+    return cache.RedisCache(
+        redis.Redis(host=config.settings.REDIS_HOST, port=config.settings.REDIS_PORT, db=db),
+        ttl=config.settings.IDEMPOTENCY_KEY_TTL,
+    )
+
+
+def idempotency_pending_ttl() -> float:
+    """
+    How long the idempotency key of a running command stays taken, IDEMPOTENCY_PENDING_TTL unless unset.
+    Derived from the settings, it is twice the longest each run of the command waits for a connection then for
+    a statement, plus the delays between the runs. With statements without timeout, it is the ttl of the keys.
+    """
+    settings = config.settings
+    if settings.IDEMPOTENCY_PENDING_TTL is not None:
+        return settings.IDEMPOTENCY_PENDING_TTL
+    if not settings.POSTGRES_STATEMENT_TIMEOUT_MS:
+        return settings.IDEMPOTENCY_KEY_TTL
+    run = settings.POSTGRES_POOL_TIMEOUT + settings.POSTGRES_STATEMENT_TIMEOUT_MS / 1000
+    return 2 * ((settings.COMMAND_MAX_RETRIES + 1) * run + settings.COMMAND_MAX_RETRIES * settings.COMMAND_RETRY_MAX_DELAY)
+
+
 def inject_dependencies(handler: t.Callable, dependencies: dict):
     """
     Inject dependencies into a handler.
@@ -62,4 +143,5 @@ def inject_dependencies(handler: t.Callable, dependencies: dict):
 
     params = inspect.signature(handler).parameters
     deps = {name: dependency for name, dependency in dependencies.items() if name in params}
-    return lambda message: handler(message, **deps)
+    # keeps the name of the handler, the event pool limits the concurrency by name
+    return functools.wraps(handler)(lambda message: handler(message, **deps))
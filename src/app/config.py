@@ -24,15 +24,94 @@ class Settings(pydantic_settings.BaseSettings):
     POSTGRES_DB: str = "postgres"
     POSTGRES_HOST: str = "postgres"
     POSTGRES_PORT: int = 5432
+    # connections per engine: at most POOL_SIZE + MAX_OVERFLOW. A web worker has at least two engines, the sync one of the
+    # counter flush and the event handler pool and an async one per event loop, see AsyncSqlAlchemyUnitOfWork, and an
+    # event consumer one: keep the sum over the processes of engines * (POOL_SIZE + MAX_OVERFLOW) under max_connections
+    POSTGRES_POOL_SIZE: int = 5
+    POSTGRES_MAX_OVERFLOW: int = 10
+    # seconds a request waits for a free connection before failing
+    POSTGRES_POOL_TIMEOUT: float = 30.0
+    # seconds after which a connection is reopened, -1 keeps it forever
+    POSTGRES_POOL_RECYCLE: int = 1800
+    # test each connection on checkout, so a restart of Postgres does not fail the next requests
+    POSTGRES_POOL_PRE_PING: bool = True
+    # 0 lets statements run forever
+    POSTGRES_STATEMENT_TIMEOUT_MS: int = 30000
+    # conflicting writes fail on the version of the record or a serialization error, and their command is retried
+    POSTGRES_ISOLATION_LEVEL: str = "READ COMMITTED"
+    # retries of a command conflicting with a concurrent one, waiting a random delay under a doubling cap (seconds)
+    COMMAND_MAX_RETRIES: int = 3
+    COMMAND_RETRY_BASE_DELAY: float = 0.01
+    COMMAND_RETRY_MAX_DELAY: float = 0.5
 
     MINIO_ACCESS_KEY: str = "minio"
     MINIO_SECRET_KEY: str = "minio123"
     MINIO_HOST: str = "minio"
     MINIO_PORT: int = 9000
+    # memory held per upload, 5 MiB is the smallest part size of a multipart upload
+    MINIO_UPLOAD_PART_SIZE: int = 5 * 1024 * 1024
+    MINIO_UPLOAD_WORKERS: int = 8
+    MINIO_PRESIGNED_URL_EXPIRES: int = 7 * 24 * 60 * 60
+    MINIO_PRESIGNED_URL_CACHE_SIZE: int = 10000
 
     REDIS_HOST: str = "redis"
     REDIS_PORT: int = 6379
 
+    EVENT_REDIS_DB: int = 0
+    EVENT_STREAM: str = "post-service:events"
+    # approximate, older events are trimmed
+    EVENT_STREAM_MAXLEN: int = 100000
+    OUTBOX_BATCH_SIZE: int = 500
+    OUTBOX_POLL_INTERVAL: float = 0.1
+    EVENT_CONSUMER_GROUP: str = "post-service"
+    # unique per consumer, the host name and pid when unset
+    EVENT_CONSUMER_NAME: str | None = None
+    EVENT_CONSUMER_BATCH_SIZE: int = 100
+    EVENT_CONSUMER_WORKERS: int = 8
+    EVENT_CONSUMER_BLOCK_MS: int = 1000
+    # pending messages idle for longer are claimed from their consumer, presumed dead
+    EVENT_CONSUMER_CLAIM_IDLE_MS: int = 60000
+    # deliveries after which a failing event is moved to the dead letter stream
+    EVENT_CONSUMER_MAX_DELIVERIES: int = 5
+    EVENT_DEAD_LETTER_STREAM: str = "post-service:events:dead"
+    # seconds the outbox ids of the handled events are kept, to skip the events published twice
+    EVENT_CONSUMER_DEDUP_TTL: int = 24 * 60 * 60
+
+    VIEW_CACHE_SIZE: int = 10000
+    VIEW_CACHE_TTL: float = 300.0
+    # Redis db shared by the workers, only the in-process cache is used when unset: a worker then serves a record
+    # changed through another worker for up to VIEW_CACHE_TTL, set it when running more than one worker
+    VIEW_CACHE_REDIS_DB: int | None = None
+    # how long a worker keeps its copy of the shared cache, and misses the invalidations of the other workers
+    VIEW_CACHE_LOCAL_TTL: float = 1.0
+
+    # threads running the slow event handlers, like the removal of the files of a deleted post, out of the requests,
+    # 0 runs every handler in the request
+    EVENT_HANDLER_WORKERS: int = 4
+    EVENT_HANDLER_MAX_PENDING: int = 1000
+    # concurrent runs of one handler
+    EVENT_HANDLER_CONCURRENCY: int = 2
+    # how long a request waits for room in a full pool before it runs the handler itself
+    EVENT_HANDLER_SUBMIT_TIMEOUT: float = 1.0
+    EVENT_HANDLER_DRAIN_TIMEOUT: float = 30.0
+
+    # results of the commands sent with an Idempotency-Key, kept for retries
+    IDEMPOTENCY_STORE_SIZE: int = 100000
+    IDEMPOTENCY_KEY_TTL: float = 24 * 60 * 60
+    # how long a key stays taken by a command that never finished, like one of a crashed worker,
+    # longer than a command can run when unset, see bootstrap.idempotency_pending_ttl
+    IDEMPOTENCY_PENDING_TTL: float | None = None
+    # Redis db shared by the workers, so a retry reaching another worker is answered too, VIEW_CACHE_REDIS_DB when
+    # unset. Without either the store is in-process: a retry reaching another worker runs the command again
+    IDEMPOTENCY_REDIS_DB: int | None = None
+
+    # records per transaction of entrypoints/reconcile_counts.py
+    RECONCILE_BATCH_SIZE: int = 1000
+
+    LIKE_COUNTER_FLUSH_INTERVAL: float = 1.0
+    # seconds after which the like count deltas left by a dead worker are applied by the others
+    LIKE_COUNTER_ORPHAN_AGE: float = 60.0
+
     LOGGING_LEVEL: int = logging.INFO
 
 
@@ -12,6 +12,16 @@ class Command(pydantic.BaseModel):
 
     model_config = pydantic.ConfigDict(arbitrary_types_allowed=True)
 
+    # set by the client, a retry with the same key is answered with the result of the first run
+    idempotency_key: str | None = None
+
+    @property
+    def caller(self) -> str | None:
+        """
+        The user sending the command, its idempotency keys are not shared with the other users.
+        """
+        return getattr(self, "user_id", None) or getattr(self, "author_id", None)
+
 
 class CreatePostCommand(Command):
     """
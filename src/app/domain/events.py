@@ -31,6 +31,16 @@ class DeletedPostEvent(Event):
     """
 
     post_id: str
+    # the comments and replies deleted with the post
+    comment_ids: list[str] = []
+
+
+class AttachedImageEvent(Event):
+    """
+    Event representing images attached to a post.
+    """
+
+    post_id: str
 
 
 class LikedPostEvent(Event):
@@ -85,6 +95,8 @@ class RepliedCommentEvent(Event):
 
     comment_id: str
     post_id: str
+    # the replied comment
+    parent_id: str | None = None
 
 
 class DeletedCommentEvent(Event):
@@ -93,6 +105,11 @@ class DeletedCommentEvent(Event):
     """
 
     comment_id: str
+    post_id: str
+    # the replied comment, None for a comment on the post
+    parent_id: str | None = None
+    # the replies deleted with the comment, at every level
+    reply_ids: list[str] = []
 
 
 class DeniedPostActionEvent(Event):
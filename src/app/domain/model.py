@@ -22,6 +22,10 @@ class BaseModel:
     created_time: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
     updated_time: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
 
+    def __init__(self):
+        for field in dataclasses.fields(BaseModel):
+            setattr(self, field.name, field.default_factory())
+
     @abc.abstractmethod
     def model_dump(self) -> dict:
         """Dump the model as a dictionary."""
@@ -35,7 +39,7 @@ class Image(BaseModel):
     """
 
     def __init__(self, path: str, post_id: str):
-
+        super().__init__()
         self.path = path
         self.post_id = post_id
         # self.events = []  # type: list[events.Event]
@@ -79,7 +83,7 @@ class Like(BaseModel):
         post_id: str | None,
         comment_id: str | None,
     ):
-
+        super().__init__()
         self.user_id = user_id
         self.post_id = post_id
         self.comment_id = comment_id
@@ -130,13 +134,14 @@ class Comment(BaseModel):
         post_id: str | None,
         comment_id: str | None,
     ):
-
+        super().__init__()
         self.content = content
         self.author_id = author_id
         self.level = level
         self.post_id = post_id
         self.comment_id = comment_id
         self.like_count = 0
+        self.reply_count = 0
         self.version = 1
         self.created_time = datetime.datetime.now()
         # self.replies = []  # type: list[Comment]
@@ -183,14 +188,12 @@ class Comment(BaseModel):
     def delete(self) -> None:
         """ """
 
-    def like_unlike(self, user_id: str) -> None:
-        like = Like.create(user_id, self.post_id, self.id)
-        if like in self.likes:
-            self.likes.remove(like)
-            self.like_count -= 1
-        else:
-            self.likes.append(like)
-            self.like_count += 1
+    def like_unlike(self, user_id: str) -> Like:
+        """
+        Build the like of `user_id` on this comment.
+        Whether it is added or removed is decided by the likes repository, so the likes are never loaded.
+        """
+        return Like.create(user_id, self.post_id, self.id)
 
     def reply(self, content: str, author_id: str) -> Comment:
         reply = Comment.create(content, author_id, t.cast(MAX_LEVEL_DEPTH, self.level + 1), self.post_id, self.id)
@@ -210,6 +213,7 @@ class Comment(BaseModel):
             "comment_id": self.comment_id,
             "created_time": self.created_time.isoformat(),
             "like_count": self.like_count,
+            "reply_count": self.reply_count,
         }
 
 
@@ -225,11 +229,12 @@ class Post(BaseModel):
         content: str,
         author_id: str,
     ):
-
+        super().__init__()
         self.title = title
         self.content = content
         self.author_id = author_id
         self.like_count = 0
+        self.comment_count = 0
         self.version = 1
         # self.likes = []  # type: list[Like]
         # self.comments = []  # type: list[Comment]
@@ -267,18 +272,16 @@ class Post(BaseModel):
     def delete(self) -> None:
         """ """
 
-    def like_unlike(self, user_id: str) -> None:
-        like = Like.create(user_id, self.id, None)
-        if like in self.likes:
-            self.likes.remove(like)
-            self.like_count -= 1
-        else:
-            self.likes.append(like)
-            self.like_count += 1
+    def like_unlike(self, user_id: str) -> Like:
+        """
+        Build the like of `user_id` on this post.
+        Whether it is added or removed is decided by the likes repository, so the likes are never loaded.
+        """
+        return Like.create(user_id, self.id, None)
 
     def comment(self, content: str, author_id: str) -> Comment:
         comment = Comment.create(content, author_id, 0, self.id, None)
-        self.comments.append(comment)
+        # self.comments.append(comment) would load every comment of the post, see comment_count
         return comment
 
     def add_image(self, path: str) -> Image:
@@ -296,6 +299,7 @@ class Post(BaseModel):
             "author_id": self.author_id,
             "content": self.content,
             "like_count": self.like_count,
+            "comment_count": self.comment_count,
             "images": [image.model_dump() for image in self.images],
             "version": self.version,
             "created_time": self.created_time.isoformat(),
@@ -1,22 +1,84 @@
+import contextlib
 import typing as t
 
 import fastapi
 from icecream import ic
 
+from src.app import async_views
 from src.app import bootstrap
+from src.app import config
 from src.app import views
 from src.app.domain import commands
 from src.app.entrypoints import depends
 from src.app.entrypoints import schema
+from src.app.service_layer import messagebus
+from src.app.service_layer import unit_of_work
 
-app = fastapi.FastAPI(dependencies=[fastapi.Depends(depends.authorise_user)])
-bus = bootstrap.bootstrap()
+router = fastapi.APIRouter()
 
 
-@app.post("/posts", status_code=fastapi.status.HTTP_201_CREATED)
-def create_post(
+def create_app(bus: messagebus.MessageBus | None = None) -> fastapi.FastAPI:
+    """
+    Create the application, run it with `uvicorn --factory src.app.entrypoints.app:create_app`.
+
+    Nothing connects before startup: the message bus is bootstrapped by the lifespan of the application, and
+    its clients open their connections on first use.
+
+    Args:
+        bus: The message bus serving the requests, bootstrapped on startup when not given.
+            A given bus is owned by the caller, it is not stopped on shutdown.
+    """
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: fastapi.FastAPI):
+        if bus is not None:
+            app.state.bus = bus
+            yield
+            return
+
+        # requests wait on Postgres without holding a thread, see AsyncSqlAlchemyUnitOfWork
+        app.state.bus = bootstrap.bootstrap(uow=unit_of_work.AsyncSqlAlchemyUnitOfWork)
+        yield
+        # let the background event handlers finish, they may still like or write
+        app.state.bus.drain(config.settings.EVENT_HANDLER_DRAIN_TIMEOUT)
+        # write the buffered like counters before the worker exits
+        app.state.bus.uow.counters.stop()
+
+    app = fastapi.FastAPI(dependencies=[fastapi.Depends(depends.authorise_user)], lifespan=lifespan)
+    app.include_router(router)
+    app.add_exception_handler(messagebus.IdempotencyKeyReused, idempotency_key_reused)
+    app.add_exception_handler(messagebus.IdempotencyKeyInProgress, idempotency_key_in_progress)
+    app.add_exception_handler(messagebus.CommandConflict, command_conflict)
+    return app
+
+
+async def idempotency_key_reused(request: fastapi.Request, exc: Exception) -> fastapi.Response:
+    return fastapi.responses.JSONResponse(
+        status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+        content={"detail": "Idempotency-Key already used by another request"},
+    )
+
+
+async def idempotency_key_in_progress(request: fastapi.Request, exc: Exception) -> fastapi.Response:
+    return fastapi.responses.JSONResponse(
+        status_code=fastapi.status.HTTP_409_CONFLICT,
+        content={"detail": "A request with this Idempotency-Key is still being processed"},
+    )
+
+
+async def command_conflict(request: fastapi.Request, exc: Exception) -> fastapi.Response:
+    return fastapi.responses.JSONResponse(
+        status_code=fastapi.status.HTTP_409_CONFLICT,
+        content={"detail": "The request conflicts with concurrent ones, retry it"},
+    )
+
+
+@router.post("/posts", status_code=fastapi.status.HTTP_201_CREATED)
+async def create_post(
     request: schema.CreatePostRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    idempotency_key: str | None = fastapi.Header(None),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Create a post.
@@ -25,16 +87,19 @@ def create_post(
         title=request.title,
         content=request.content,
         author_id=user_id,
+        idempotency_key=idempotency_key,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=201)
 
 
-@app.post("/posts/{id}/images", status_code=fastapi.status.HTTP_201_CREATED)
+# run in the thread pool, the uploads to MinIO block
+@router.post("/posts/{id}/images", status_code=fastapi.status.HTTP_201_CREATED)
 def attach_image(
     request: schema.AttachImageRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Attach images to a post.
@@ -49,22 +114,24 @@ def attach_image(
     return fastapi.Response(status_code=201)
 
 
-@app.get("/posts/{id}")
-def get_post(
+@router.get("/posts/{id}")
+async def get_post(
     request: schema.GetPostRequest = fastapi.Depends(),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ) -> schema.PostResponse:
     """
     Get a post by its id.
     """
     id = request.id
-    post = views.get_post(post_id=id, uow=bus.uow)
+    post = await async_views.get_post(post_id=id, uow=bus.uow)
     return post
 
 
-@app.put("/posts/{id}", status_code=fastapi.status.HTTP_204_NO_CONTENT)
-def edit_post(
+@router.put("/posts/{id}", status_code=fastapi.status.HTTP_204_NO_CONTENT)
+async def edit_post(
     request: schema.EditPostRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Edit a post.
@@ -75,15 +142,16 @@ def edit_post(
         title=request.title,
         content=request.content,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=204)
 
 
-@app.delete("/posts/{id}", status_code=fastapi.status.HTTP_204_NO_CONTENT)
-def delete_post(
+@router.delete("/posts/{id}", status_code=fastapi.status.HTTP_204_NO_CONTENT)
+async def delete_post(
     request: schema.DeletePostRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Delete a post.
@@ -92,15 +160,17 @@ def delete_post(
         user_id=user_id,
         post_id=request.id,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=204)
 
 
-@app.post("/posts/{id}/like", status_code=fastapi.status.HTTP_204_NO_CONTENT)
-def like_post(
+@router.post("/posts/{id}/like", status_code=fastapi.status.HTTP_204_NO_CONTENT)
+async def like_post(
     request: schema.LikePostRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    idempotency_key: str | None = fastapi.Header(None),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Like a post.
@@ -108,16 +178,19 @@ def like_post(
     cmd = commands.LikePostCommand(
         user_id=user_id,
         post_id=request.id,
+        idempotency_key=idempotency_key,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=204)
 
 
-@app.post("/posts/{id}/comments", status_code=fastapi.status.HTTP_201_CREATED)
-def comment_post(
+@router.post("/posts/{id}/comments", status_code=fastapi.status.HTTP_201_CREATED)
+async def comment_post(
     request: schema.CommentRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    idempotency_key: str | None = fastapi.Header(None),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Comment a post.
@@ -126,16 +199,19 @@ def comment_post(
         user_id=user_id,
         post_id=request.id,
         content=request.content,
+        idempotency_key=idempotency_key,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=201)
 
 
-@app.post("/comments/{id}/reply", status_code=fastapi.status.HTTP_201_CREATED)
-def reply_comment(
+@router.post("/comments/{id}/reply", status_code=fastapi.status.HTTP_201_CREATED)
+async def reply_comment(
     request: schema.ReplyRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    idempotency_key: str | None = fastapi.Header(None),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Reply to a comment.
@@ -144,16 +220,18 @@ def reply_comment(
         user_id=user_id,
         comment_id=request.id,
         content=request.content,
+        idempotency_key=idempotency_key,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=201)
 
 
-@app.delete("/comments/{id}", status_code=fastapi.status.HTTP_204_NO_CONTENT)
-def delete_comment(
+@router.delete("/comments/{id}", status_code=fastapi.status.HTTP_204_NO_CONTENT)
+async def delete_comment(
     request: schema.DeleteCommentRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Delete a comment.
@@ -162,15 +240,17 @@ def delete_comment(
         user_id=user_id,
         comment_id=request.id,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=204)
 
 
-@app.post("/comments/{id}/like", status_code=fastapi.status.HTTP_204_NO_CONTENT)
-def like_comment(
+@router.post("/comments/{id}/like", status_code=fastapi.status.HTTP_204_NO_CONTENT)
+async def like_comment(
     request: schema.LikeCommentRequest = fastapi.Depends(),
     user_id: str = fastapi.Header(),
+    idempotency_key: str | None = fastapi.Header(None),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
 ):
     """
     Like a comment.
@@ -178,36 +258,61 @@ def like_comment(
     cmd = commands.LikeCommentCommand(
         user_id=user_id,
         comment_id=request.id,
+        idempotency_key=idempotency_key,
     )
-    bus.handle(cmd)
+    await bus.handle_async(cmd)
 
     return fastapi.Response(status_code=204)
 
 
-@app.get("/posts/{id}/comments")
-def get_comments(
+@router.get("/posts/{id}/comments")
+async def get_comments(
     request: schema.GetPostCommentRequest = fastapi.Depends(),
-) -> list[schema.CommentResponse]:
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
+) -> schema.CommentPageResponse:
     """
     Get comments of a post.
     """
-    comments = views.get_comments(post_id=request.id, uow=bus.uow)
+    try:
+        comments = await async_views.get_comments(post_id=request.id, uow=bus.uow, limit=request.limit, cursor=request.cursor)
+    except views.InvalidCursor:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
     return comments
 
 
-@app.get("/comments/{id}/reply")
-def get_replies(
+@router.get("/posts/{id}/thread")
+async def get_comment_thread(
+    request: schema.GetCommentThreadRequest = fastapi.Depends(),
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
+) -> schema.CommentThreadPageResponse:
+    """
+    Get the comments of a post with their replies, nested.
+    Pages hold `limit` top level comments, each with all its replies.
+    """
+    try:
+        thread = await async_views.get_comment_thread(post_id=request.id, uow=bus.uow, limit=request.limit, cursor=request.cursor)
+    except views.InvalidCursor:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return thread
+
+
+@router.get("/comments/{id}/reply")
+async def get_replies(
     request: schema.GetCommentReplyRequest = fastapi.Depends(),
-) -> list[schema.CommentResponse]:
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
+) -> schema.CommentPageResponse:
     """
     Get replies of a comment.
     """
-    replies = views.get_reply_comments(comment_id=request.id, uow=bus.uow)
+    try:
+        replies = await async_views.get_reply_comments(comment_id=request.id, uow=bus.uow, limit=request.limit, cursor=request.cursor)
+    except views.InvalidCursor:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
     return replies
 
 
-@app.get("/posts")
-def get_posts(
+@router.get("/posts")
+async def get_posts(
     # request: schema.GetPostsRequest = fastapi.Depends(),
     title: str | None = None,
     content: str | None = None,
@@ -215,9 +320,14 @@ def get_posts(
     order: t.Annotated[list[str] | None, fastapi.Query()] = ["-created_time"],
     limit: int = 10,
     offset: int = 0,
-) -> list[schema.PostResponse]:
+    cursor: str | None = None,
+    q: str | None = None,
+    bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus),
+) -> schema.PostPageResponse:
     """
     Get all posts.
+    Pass the `next_cursor` of a page as `cursor` to get the next one.
+    With `q`, only posts matching the full text search are returned, best matches first.
     """
     request = schema.GetPostsRequest(
         title=title,
@@ -226,6 +336,29 @@ def get_posts(
         order=order,
         limit=limit,
         offset=offset,
+        cursor=cursor,
+        q=q,
     )
-    posts = views.get_posts(request, uow=bus.uow)
+    try:
+        posts = await async_views.get_posts(request, uow=bus.uow)
+    except views.InvalidCursor:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
     return posts
+
+
+@router.get("/metrics")
+def get_metrics(bus: messagebus.MessageBus = fastapi.Depends(depends.get_bus)) -> dict:
+    """
+    Get the metrics of the worker.
+    """
+    metrics = {
+        "coalesced_reads": bus.uow.loads.stats(),
+        "database_pools": bus.uow.pool_stats(),
+        "command_retries": bus.retry_stats(),
+    }
+    if bus.event_pool is not None:
+        metrics["event_handlers"] = bus.event_pool.stats()
+    return metrics
+
+
+app = create_app()
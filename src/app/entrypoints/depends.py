@@ -1,6 +1,7 @@
 import fastapi
 
 from src.app.entrypoints import schema
+from src.app.service_layer import messagebus
 
 
 async def authorise_user(user_id: str = fastapi.Header(...)) -> str:
@@ -12,3 +13,10 @@ async def authorise_user(user_id: str = fastapi.Header(...)) -> str:
 
 def get_query_params(params: schema.GetPostsRequest = fastapi.Depends()):
     return params
+
+
+def get_bus(request: fastapi.Request) -> messagebus.MessageBus:
+    """
+    Get the message bus bootstrapped on startup, see app.create_app.
+    """
+    return request.app.state.bus
@@ -0,0 +1,56 @@
+"""
+Relay publishing the events of the outbox, run with `python -m src.app.entrypoints.outbox_relay`.
+
+An event is removed from the outbox once published, in the transaction that locked it. A crash in between
+publishes it again: delivery is at least once. Several relays can run, each one locks its own events.
+"""
+
+import logging
+import time
+
+import redis
+from sqlalchemy import orm
+
+from src.app import config
+from src.app.adapters import redis_event_publisher
+from src.app.adapters import repository
+from src.app.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def relay(session_factory: orm.sessionmaker, client: redis.Redis, batch_size: int) -> int:
+    """
+    Publish one batch of events from the outbox.
+
+    Returns:
+        The number of events published.
+    """
+    with session_factory() as session:
+        outbox = repository.SqlAlchemyOutboxRepository(session)
+        messages = outbox.fetch(batch_size)
+        if not messages:
+            return 0
+        redis_event_publisher.publish(client, messages)
+        outbox.delete([message.id for message in messages])
+        session.commit()
+        return len(messages)
+
+
+def main():
+    logging.basicConfig(level=config.settings.LOGGING_LEVEL)
+    logger.info("Outbox relay starting")
+    client = redis.Redis(host=config.settings.REDIS_HOST, port=config.settings.REDIS_PORT, db=config.settings.EVENT_REDIS_DB)
+    while True:
+        try:
+            published = relay(unit_of_work.DEFAULT_SESSION_FACTORY, client, config.settings.OUTBOX_BATCH_SIZE)
+        except Exception:
+            logger.exception("Failed to relay the outbox, retrying")
+            published = 0
+        # keep going while the outbox is full, poll otherwise
+        if published < config.settings.OUTBOX_BATCH_SIZE:
+            time.sleep(config.settings.OUTBOX_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
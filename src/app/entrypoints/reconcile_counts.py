@@ -0,0 +1,68 @@
+"""
+Job recomputing the comment_count of posts and the reply_count of comments, run with
+`python -m src.app.entrypoints.reconcile_counts`.
+
+The handlers keep the counters in step with the comments, this job backfills them after the columns are added
+and repairs any drift. Records are walked in id order, one batch per transaction, so it never holds many locks.
+The job runs at REPEATABLE READ whatever POSTGRES_ISOLATION_LEVEL: a batch conflicting with a concurrent
+comment fails rather than writing a stale count, and is retried. Cached posts and comments pick the repaired
+counters up when they expire.
+"""
+
+import logging
+import time
+import typing as t
+
+from sqlalchemy import orm
+
+from src.app import config
+from src.app.adapters import database
+from src.app.adapters import repository
+from src.app.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+RETRIES = 3
+
+
+def reconcile(session_factory: t.Callable[[], orm.Session], table_name: str, batch_size: int) -> int:
+    """
+    Recompute the counters of every record of a table, "posts" or "comments".
+
+    Returns:
+        The number of records whose counter had drifted.
+    """
+    fixed = 0
+    after = None
+    while True:
+        for attempt in range(RETRIES):
+            try:
+                with session_factory() as session:
+                    counts = repository.SqlAlchemyCountRepository(session)
+                    ids = counts.ids(table_name, after, batch_size)
+                    drifted = counts.reconcile(table_name, ids) if ids else []
+                    session.commit()
+                break
+            except Exception:
+                if attempt == RETRIES - 1:
+                    raise
+                logger.warning("Failed to reconcile %s after %s, retrying", table_name, after, exc_info=True)
+                time.sleep(0.1 * 2**attempt)
+        if drifted:
+            logger.info("Reconciled %d %s", len(drifted), table_name)
+        fixed += len(drifted)
+        if len(ids) < batch_size:
+            return fixed
+        after = ids[-1]
+
+
+def main():
+    logging.basicConfig(level=config.settings.LOGGING_LEVEL)
+    engine = database.engine_of(unit_of_work.DEFAULT_SESSION_FACTORY).execution_options(isolation_level="REPEATABLE READ")
+    for table_name in ("posts", "comments"):
+        fixed = reconcile(orm.sessionmaker(bind=engine), table_name, config.settings.RECONCILE_BATCH_SIZE)
+        logger.info("%d %s had a drifted counter", fixed, table_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,238 @@
-# import json
-# import logging
+"""
+Consumer of the event stream, run with `python -m src.app.entrypoints.redis_event_consumer`.
 
-# import redis
+Every consumer of the group reads its own batches of the stream, so consumers scale horizontally. A message is
+acked once every handler of its event succeeded, after their commits. A failed message, or one of a consumer
+that died, stays pending and another consumer claims it once it is idle for `claim_idle_ms`. After
+`max_deliveries` it is moved to the dead letter stream instead. Delivery is at least once, the outbox ids of the
+handled events are kept for `dedup_ttl` seconds to skip an event the relay published twice, and the messages of
+a batch are handled concurrently, in no particular order.
 
-# from src.app import bootstrap
-# from src.app import config
-# from src.app.domain import commands
+Each event reaches one consumer of the group, so its cache invalidations only reach the caches that consumer
+shares: the Redis tier of the view cache when VIEW_CACHE_REDIS_DB is set. There is no invalidation across the
+in-process caches of the workers, a change is seen by the other workers once their copy expires.
+"""
 
-# logger = logging.getLogger(__name__)
+import concurrent.futures
+import logging
+import os
+import signal
+import socket
+import threading
 
-# r = redis.Redis(host=config.settings.REDIS_HOST, port=config.settings.REDIS_PORT, db=0)
+import pydantic
+import redis
 
+from src.app import bootstrap
+from src.app import config
+from src.app.domain import commands
+from src.app.domain import events
+from src.app.service_layer import messagebus
 
-# def main():
-#     logger.info("Redis pubsub starting")
-#     bus = bootstrap.bootstrap()
-#     pubsub = r.pubsub(ignore_subscribe_messages=True)
-#     pubsub.subscribe("some_topic")
+logger = logging.getLogger(__name__)
 
-#     for m in pubsub.listen():
-#         handle_some_event(m, bus)
+MESSAGE_TYPES = {
+    name: message_type
+    for module in (events, commands)
+    for name, message_type in vars(module).items()
+    if isinstance(message_type, type) and issubclass(message_type, pydantic.BaseModel)
+}
 
 
-# def handle_some_event(m, bus):
-#     logger.info("handling %s", m)
-#     data = json.loads(m["data"])
-#     cmd = commands.SomeCommand()
-#     bus.handle(cmd)
+class StreamConsumer:
+    def __init__(
+        self,
+        client: redis.Redis,
+        bus: messagebus.MessageBus,
+        stream: str,
+        group: str,
+        consumer: str,
+        batch_size: int,
+        workers: int,
+        block_ms: int,
+        claim_idle_ms: int,
+        max_deliveries: int = 5,
+        dead_letter_stream: str | None = None,
+        dedup_ttl: int = 24 * 60 * 60,
+    ):
+        """
+        Initialize the StreamConsumer class, the dead letter stream is `{stream}:dead` unless given.
+        """
+        self.client = client
+        self.bus = bus
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.dead_letter_stream = dead_letter_stream or f"{stream}:dead"
+        self.dedup_ttl = dedup_ttl
+        self.claim_cursor = "0-0"
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event-consumer")
 
+    def ensure_group(self) -> None:
+        """
+        Create the consumer group, reading the stream from its start, unless it exists.
+        """
+        try:
+            self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
 
-# if __name__ == "__main__":
-#     main()
+    def poll(self) -> int:
+        """
+        Handle the messages left idle by dead consumers, then a batch of new messages.
+
+        Returns:
+            The number of messages handled.
+        """
+        self.claim_cursor, claimed, *_ = self.client.xautoclaim(
+            self.stream, self.group, self.consumer, self.claim_idle_ms, start_id=self.claim_cursor, count=self.batch_size
+        )
+        if claimed:
+            logger.info("Claimed %d idle messages", len(claimed))
+            claimed = self._dead_letter(claimed)
+        read = self.client.xreadgroup(
+            self.group, self.consumer, {self.stream: ">"}, count=self.batch_size, block=None if claimed else self.block_ms
+        )
+        messages = claimed + [message for _, stream_messages in read for message in stream_messages]
+        if not messages:
+            return 0
+
+        acked, unhandled, outbox_ids = [], [], set()
+        for message, handled_before in zip(messages, self._handled_before(messages)):
+            id, fields = message
+            outbox_id = fields.get(b"id")
+            if handled_before:
+                logger.info("Skipping message %s, its event %s was handled already", id, outbox_id)
+                acked.append(id)
+            elif outbox_id is None or outbox_id not in outbox_ids:
+                unhandled.append(message)
+            # else published twice in the batch, left pending until the first one is handled
+            outbox_ids.add(outbox_id)
+
+        handled = [message for message, ok in zip(unhandled, self.pool.map(self._handle, unhandled)) if ok]
+        pipe = self.client.pipeline(transaction=False)
+        for _, fields in handled:
+            if b"id" in fields:
+                pipe.set(self._handled_key(fields[b"id"]), 1, ex=self.dedup_ttl)
+        acked += [id for id, _ in handled]
+        if acked:
+            pipe.xack(self.stream, self.group, *acked)
+        pipe.execute()
+        return len(messages)
+
+    def run(self, stop: threading.Event) -> None:
+        """
+        Consume the stream until `stop` is set.
+        """
+        self.ensure_group()
+        while not stop.is_set():
+            try:
+                self.poll()
+            except redis.RedisError:
+                logger.exception("Failed to read %s, retrying", self.stream)
+                stop.wait(1)
+        self.pool.shutdown()
+
+    def _handled_key(self, outbox_id: bytes) -> str:
+        return f"{self.stream}:handled:{self.group}:{outbox_id.decode()}"
+
+    def _handled_before(self, messages: list[tuple[bytes, dict[bytes, bytes]]]) -> list[bool]:
+        """
+        Tell the messages whose event was handled already, by its outbox id, in one round trip.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for _, fields in messages:
+            if b"id" in fields:
+                pipe.exists(self._handled_key(fields[b"id"]))
+        results = iter(pipe.execute())
+        return [b"id" in fields and bool(next(results)) for _, fields in messages]
+
+    def _dead_letter(self, claimed: list[tuple[bytes, dict[bytes, bytes]]]) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        """
+        Move the claimed messages delivered more than `max_deliveries` times to the dead letter stream.
+
+        Returns:
+            The other claimed messages.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for id, _ in claimed:
+            pipe.xpending_range(self.stream, self.group, min=id, max=id, count=1)
+        deliveries = [pending[0]["times_delivered"] if pending else 0 for pending in pipe.execute()]
+
+        dead = [(message, n) for message, n in zip(claimed, deliveries) if n > self.max_deliveries]
+        if not dead:
+            return claimed
+        pipe = self.client.pipeline(transaction=True)
+        for (id, fields), n in dead:
+            logger.error("Moving message %s to %s after %d deliveries", id, self.dead_letter_stream, n)
+            # trimmed from the stream while pending when empty
+            if fields:
+                pipe.xadd(self.dead_letter_stream, {**fields, b"message_id": id, b"deliveries": n})
+        pipe.xack(self.stream, self.group, *[id for (id, _), _ in dead])
+        pipe.execute()
+        return [message for message, n in zip(claimed, deliveries) if n <= self.max_deliveries]
+
+    def _handle(self, message: tuple[bytes, dict[bytes, bytes]]) -> bool:
+        """
+        Handle a message with the bus.
+
+        Returns:
+            Whether the message can be acked, a message that cannot be parsed is acked and dropped.
+        """
+        id, fields = message
+        if not fields:
+            # trimmed from the stream while pending
+            return True
+        name = fields[b"type"].decode()
+        if name not in MESSAGE_TYPES:
+            logger.error("Dropping message %s of unknown type %s", id, name)
+            return True
+        try:
+            parsed = MESSAGE_TYPES[name].model_validate_json(fields[b"payload"])
+        except pydantic.ValidationError:
+            logger.exception("Dropping malformed message %s", id)
+            return True
+        try:
+            # strict, a failed event handler fails the message instead of being logged and acked
+            self.bus.handle(parsed, strict=True)
+        except Exception:
+            logger.exception("Failed to handle message %s, it is retried once claimed", id)
+            return False
+        return True
+
+
+def main():
+    logging.basicConfig(level=config.settings.LOGGING_LEVEL)
+    logger.info("Redis stream consumer starting")
+    bus = bootstrap.bootstrap()
+    client = redis.Redis(host=config.settings.REDIS_HOST, port=config.settings.REDIS_PORT, db=config.settings.EVENT_REDIS_DB)
+    consumer = StreamConsumer(
+        client,
+        bus,
+        stream=config.settings.EVENT_STREAM,
+        group=config.settings.EVENT_CONSUMER_GROUP,
+        consumer=config.settings.EVENT_CONSUMER_NAME or f"{socket.gethostname()}-{os.getpid()}",
+        batch_size=config.settings.EVENT_CONSUMER_BATCH_SIZE,
+        workers=config.settings.EVENT_CONSUMER_WORKERS,
+        block_ms=config.settings.EVENT_CONSUMER_BLOCK_MS,
+        claim_idle_ms=config.settings.EVENT_CONSUMER_CLAIM_IDLE_MS,
+        max_deliveries=config.settings.EVENT_CONSUMER_MAX_DELIVERIES,
+        dead_letter_stream=config.settings.EVENT_DEAD_LETTER_STREAM,
+        dedup_ttl=config.settings.EVENT_CONSUMER_DEDUP_TTL,
+    )
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    consumer.run(stop)
+    bus.drain(config.settings.EVENT_HANDLER_DRAIN_TIMEOUT)
+    bus.uow.counters.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -63,11 +63,22 @@ class LikeCommentRequest:
 @pydantic.dataclasses.dataclass
 class GetPostCommentRequest:
     id: Annotated[str, fastapi.Path(...)]
+    limit: Annotated[int, fastapi.Query(gt=0, le=100)] = 20
+    cursor: Annotated[str | None, fastapi.Query()] = None
+
+
+@pydantic.dataclasses.dataclass
+class GetCommentThreadRequest:
+    id: Annotated[str, fastapi.Path(...)]
+    limit: Annotated[int, fastapi.Query(gt=0, le=100)] = 20
+    cursor: Annotated[str | None, fastapi.Query()] = None
 
 
 @pydantic.dataclasses.dataclass
 class GetCommentReplyRequest:
     id: Annotated[str, fastapi.Path(...)]
+    limit: Annotated[int, fastapi.Query(gt=0, le=100)] = 20
+    cursor: Annotated[str | None, fastapi.Query()] = None
 
 
 @pydantic.dataclasses.dataclass
@@ -79,12 +90,15 @@ class GetPostsRequest:
     order: Annotated[list[str], fastapi.Query(["-created_time"])]
     limit: Annotated[int, fastapi.Query(10)]
     offset: Annotated[int, fastapi.Query(0)]
+    cursor: Annotated[str | None, fastapi.Query()] = None
+    q: Annotated[str | None, fastapi.Query()] = None
 
 
 class CommentResponse(pydantic.BaseModel):
     content: str
     author_id: str
     created_time: str
+    reply_count: int
 
 
 class ImageResponse(pydantic.BaseModel):
@@ -100,5 +114,32 @@ class PostResponse(pydantic.BaseModel):
     created_time: str
     author_id: str
     like_count: int
+    comment_count: int
     version: int
     images: list[ImageResponse]
+
+
+class CommentThreadResponse(pydantic.BaseModel):
+    id: str
+    content: str
+    author_id: str
+    level: int
+    like_count: int
+    reply_count: int
+    created_time: str
+    replies: list["CommentThreadResponse"]
+
+
+class CommentThreadPageResponse(pydantic.BaseModel):
+    items: list[CommentThreadResponse]
+    next_cursor: str | None
+
+
+class CommentPageResponse(pydantic.BaseModel):
+    items: list[CommentResponse]
+    next_cursor: str | None
+
+
+class PostPageResponse(pydantic.BaseModel):
+    items: list[PostResponse]
+    next_cursor: str | None
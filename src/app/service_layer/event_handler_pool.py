@@ -0,0 +1,151 @@
+"""
+This module contains the EventHandlerPool class.
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+import typing as t
+
+from src.app.adapters import blocking
+
+logger = logging.getLogger(__name__)
+
+
+class EventHandlerPool:
+    """
+    Bounded pool of threads running event handlers out of the request that raised their events.
+
+    Each handler name runs at most `concurrency` times at once, or its own limit in `concurrency_limits`.
+    A handler over its limit is deferred, the next run of the same name finishing runs it, so a thread never waits
+    on a busy handler while others are pending. At most `max_pending` handlers wait for a thread, and as many
+    deferred ones. When they are all taken, `submit` waits up to `submit_timeout` seconds for room then runs the
+    handler in the caller, slowing the producer down instead of dropping the event. Called from a coroutine,
+    the wait and the handler run in a thread, see `blocking.call`.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        max_pending: int,
+        concurrency: int,
+        concurrency_limits: dict[str, int] | None = None,
+        submit_timeout: float = 1.0,
+    ):
+        self.pending = queue.Queue(maxsize=max_pending)  # type: queue.Queue[tuple[str, t.Callable[[], None]] | None]
+        self.max_deferred = max_pending
+        self.concurrency = concurrency
+        self.concurrency_limits = concurrency_limits or {}
+        self.submit_timeout = submit_timeout
+        self.lock = threading.Lock()
+        # notified when a handler name frees a run
+        self.freed = threading.Condition(self.lock)
+        self.running = collections.Counter()  # type: collections.Counter[str]
+        # handlers over the limit of their name, by name
+        self.deferred = collections.defaultdict(collections.deque)  # type: collections.defaultdict[str, collections.deque]
+        self.deferred_count = 0
+        self.closed = False
+        self.ran_inline = 0
+        self.threads = [threading.Thread(target=self._work, name=f"event-handler-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, name: str, fn: t.Callable[[], None]) -> None:
+        """
+        Run `fn`, the handler `name` of an event, in the pool.
+        """
+        if not self.closed:
+            try:
+                self.pending.put_nowait((name, fn))
+                return
+            except queue.Full:
+                pass
+        blocking.call(self._submit_or_run, name, fn)
+
+    def _submit_or_run(self, name: str, fn: t.Callable[[], None]) -> None:
+        if not self.closed:
+            try:
+                self.pending.put((name, fn), timeout=self.submit_timeout)
+                return
+            except queue.Full:
+                logger.warning("Event handler pool is full, running %s in the caller", name)
+        with self.lock:
+            self.ran_inline += 1
+        self._start(name, fn, defer=False)
+
+    def drain(self, timeout: float) -> None:
+        """
+        Stop taking handlers and wait up to `timeout` seconds for the pending ones to finish.
+        Handlers submitted from now on run in the caller.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+
+        # after every pending handler, one stop per thread
+        deadline = time.monotonic() + timeout
+        for _ in self.threads:
+            try:
+                self.pending.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+        running = sum(thread.is_alive() for thread in self.threads)
+        if running:
+            dropped = self.pending.qsize() + self.deferred_count
+            logger.warning("%d event handlers still running after %.1f s, %d pending are dropped", running, timeout, dropped)
+            return
+        # submitted while the pool was closing
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self._start(*item, defer=False)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the number of pending and deferred handlers, and of handlers run in the caller because the pool was full.
+        """
+        return {"pending": self.pending.qsize(), "deferred": self.deferred_count, "ran_inline": self.ran_inline}
+
+    def _start(self, name: str, fn: t.Callable[[], None], defer: bool) -> None:
+        """
+        Run `fn` then the handlers of the same name deferred meanwhile, or defer it when `name` is at its limit.
+        Without `defer`, or with every deferred slot taken, the caller waits for a run of `name` to finish instead.
+        """
+        limit = self.concurrency_limits.get(name, self.concurrency)
+        with self.lock:
+            while self.running[name] >= limit:
+                if defer and self.deferred_count < self.max_deferred:
+                    self.deferred[name].append(fn)
+                    self.deferred_count += 1
+                    return
+                self.freed.wait()
+            self.running[name] += 1
+
+        while True:
+            try:
+                fn()
+            except Exception:
+                logger.exception("Exception running event handler %s", name)
+            with self.lock:
+                if not self.deferred[name]:
+                    self.running[name] -= 1
+                    self.freed.notify_all()
+                    return
+                fn = self.deferred[name].popleft()
+                self.deferred_count -= 1
+
+    def _work(self) -> None:
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            self._start(*item, defer=True)
@@ -4,13 +4,17 @@ This module contains the handlers for post-related commands.
 
 from __future__ import annotations
 
+import logging
 import uuid
 
+from src.app import views
 from src.app.domain import commands
 from src.app.domain import events
 from src.app.domain import model
 from src.app.service_layer import unit_of_work
 
+logger = logging.getLogger(__name__)
+
 
 def create_post(cmd: commands.CreatePostCommand, uow: unit_of_work.AbstractUnitOfWork):
     """
@@ -37,16 +41,24 @@ def attach_image(cmd: commands.AttachImageCommand, uow: unit_of_work.AbstractUni
         images = uow_ctx.images
         post = uow_ctx.posts.get(cmd.post_id)
         if post.can_edit_or_delete(user_id=cmd.user_id):
-            for file in cmd.images:
-                path = f"posts/{post.id}/{file.filename}"
-                image = post.add_image(path)
-                images.add(image)
-                err_code = uow_ctx.minio.add(path, file)
-                if err_code == 0:
-                    uow_ctx.commit()
-                else:
-                    # Notification.send(f"Failed to upload image {file.filename}.")
-                    uow_ctx.rollback()
+            # unique, an upload never replaces an object a committed image points to
+            paths = [f"posts/{post.id}/{uuid.uuid4().hex}/{file.filename}" for file in cmd.images]
+            err_codes = uow_ctx.minio.add_many(list(zip(paths, cmd.images)))
+            uploaded = [path for path, err_code in zip(paths, err_codes) if err_code == 0]
+            # Notification.send(f"Failed to upload image {file.filename}.") for the others
+            for path in uploaded:
+                images.add(post.add_image(path))
+            post.events.append(events.AttachedImageEvent(post_id=cmd.post_id))
+            try:
+                uow_ctx.commit()
+            except Exception:
+                # do not leave objects without image rows behind, the commit failure is what the caller gets
+                for path in uploaded:
+                    try:
+                        uow_ctx.minio.delete(path)
+                    except Exception:
+                        logger.exception("Failed to delete %s after the commit of its image failed", path)
+                raise
         else:
             post.events.append(events.DeniedPostActionEvent(post_id=cmd.post_id, user_id=cmd.user_id))
 
@@ -60,8 +72,8 @@ def edit_post(cmd: commands.EditPostCommand, uow: unit_of_work.AbstractUnitOfWor
         post = uow_ctx.posts.get(cmd.post_id)
         if post.can_edit_or_delete(user_id=cmd.user_id):
             post.edit(new_title=cmd.title, new_content=cmd.content)
-            uow_ctx.commit()
             post.events.append(events.EditedPostEvent(post_id=cmd.post_id, version=post.version))
+            uow_ctx.commit()
         else:
             post.events.append(events.DeniedPostActionEvent(post_id=cmd.post_id, user_id=cmd.user_id))
 
@@ -73,12 +85,15 @@ def like_unlike_post(cmd: commands.LikePostCommand, uow: unit_of_work.AbstractUn
 
     with uow.unit_of_work() as uow_ctx:
         post = uow_ctx.posts.get(cmd.post_id)
-        post.like_unlike(user_id=cmd.user_id)
-        uow_ctx.commit()
-        if cmd.user_id in post.likes:
+        delta = uow_ctx.likes.toggle(post.like_unlike(user_id=cmd.user_id))
+        if delta >= 0:
             post.events.append(events.LikedPostEvent(post_id=cmd.post_id, user_id=cmd.user_id))
         else:
             post.events.append(events.UnlikedPostEvent(post_id=cmd.post_id, user_id=cmd.user_id))
+        delta_id = uow_ctx.likes.add_like_count_delta("posts", post.id, delta) if delta else None
+        uow_ctx.commit()
+        if delta_id is not None:
+            uow_ctx.counters.add("posts", post.id, delta, delta_id)
 
 
 def like_unlike_comment(cmd: commands.LikeCommentCommand, uow: unit_of_work.AbstractUnitOfWork):
@@ -88,12 +103,15 @@ def like_unlike_comment(cmd: commands.LikeCommentCommand, uow: unit_of_work.Abst
 
     with uow.unit_of_work() as uow_ctx:
         comment = uow_ctx.comments.get(cmd.comment_id)
-        comment.like_unlike(user_id=cmd.user_id)
-        uow_ctx.commit()
-        if cmd.user_id in comment.likes:
+        delta = uow_ctx.likes.toggle(comment.like_unlike(user_id=cmd.user_id))
+        if delta >= 0:
             comment.events.append(events.LikedCommentEvent(comment_id=cmd.comment_id, user_id=cmd.user_id))
         else:
             comment.events.append(events.UnlikedCommentEvent(comment_id=cmd.comment_id, user_id=cmd.user_id))
+        delta_id = uow_ctx.likes.add_like_count_delta("comments", comment.id, delta) if delta else None
+        uow_ctx.commit()
+        if delta_id is not None:
+            uow_ctx.counters.add("comments", comment.id, delta, delta_id)
 
 
 def comment_post(cmd: commands.CommentPostCommand, uow: unit_of_work.AbstractUnitOfWork):
@@ -102,11 +120,14 @@ def comment_post(cmd: commands.CommentPostCommand, uow: unit_of_work.AbstractUni
     """
 
     with uow.unit_of_work() as uow_ctx:
+        # the comment_count increment commutes with the concurrent ones
+        uow_ctx.read_committed()
         post = uow_ctx.posts.get(cmd.post_id)
         comment = post.comment(content=cmd.content, author_id=cmd.user_id)
         uow_ctx.comments.add(comment)
-        uow_ctx.commit()
+        uow_ctx.posts.increment(post.id, "comment_count")
         post.events.append(events.CreatedCommentEvent(comment_id=comment.id, post_id=cmd.post_id))
+        uow_ctx.commit()
 
 
 def delete_post(cmd: commands.DeletePostCommand, uow: unit_of_work.AbstractUnitOfWork):
@@ -117,9 +138,9 @@ def delete_post(cmd: commands.DeletePostCommand, uow: unit_of_work.AbstractUnitO
     with uow.unit_of_work() as uow_ctx:
         post = uow_ctx.posts.get(cmd.post_id)
         if post.can_edit_or_delete(user_id=cmd.user_id):
-            uow_ctx.posts.delete(post)
+            comment_ids = uow_ctx.posts.delete(post)
+            post.events.append(events.DeletedPostEvent(post_id=cmd.post_id, comment_ids=comment_ids))
             uow_ctx.commit()
-            post.events.append(events.DeletedPostEvent(post_id=cmd.post_id))
         else:
             post.events.append(events.DeniedPostActionEvent(post_id=cmd.post_id, user_id=cmd.user_id))
 
@@ -130,11 +151,19 @@ def delete_comment(cmd: commands.DeleteCommentCommand, uow: unit_of_work.Abstrac
     """
 
     with uow.unit_of_work() as uow_ctx:
+        uow_ctx.read_committed()
         comment = uow_ctx.comments.get(cmd.comment_id)
         if comment.can_edit_or_delete(user_id=cmd.user_id):
-            uow_ctx.comments.delete(comment)
+            # with its replies, all taken off the comment_count of the post
+            reply_ids = uow_ctx.comments.delete(comment)
+            if comment.comment_id is not None:
+                uow_ctx.comments.increment(comment.comment_id, "reply_count", -1)
+            comment.events.append(
+                events.DeletedCommentEvent(
+                    comment_id=cmd.comment_id, post_id=comment.post_id, parent_id=comment.comment_id, reply_ids=reply_ids
+                )
+            )
             uow_ctx.commit()
-            comment.events.append(events.DeletedCommentEvent(comment_id=cmd.comment_id))
         else:
             comment.events.append(events.DeniedCommentActionEvent(comment_id=cmd.comment_id, user_id=cmd.user_id))
 
@@ -145,11 +174,14 @@ def reply_comment(cmd: commands.ReplyCommentCommand, uow: unit_of_work.AbstractU
     """
 
     with uow.unit_of_work() as uow_ctx:
+        uow_ctx.read_committed()
         comment = uow_ctx.comments.get(cmd.comment_id)
         reply = comment.reply(content=cmd.content, author_id=cmd.user_id)
         uow_ctx.comments.add(reply)
+        uow_ctx.comments.increment(comment.id, "reply_count")
+        uow_ctx.posts.increment(comment.post_id, "comment_count")
+        comment.events.append(events.RepliedCommentEvent(comment_id=reply.id, post_id=comment.post_id, parent_id=comment.id))
         uow_ctx.commit()
-        comment.events.append(events.RepliedCommentEvent(comment_id=reply.id, post_id=comment.post_id))
 
 
 def do_nothing(events: events.Event, uow: unit_of_work.AbstractUnitOfWork):
@@ -170,6 +202,60 @@ def handle_comment_created(events: events.CreatedCommentEvent, uow: unit_of_work
     """
 
 
+def remove_post_images(events: events.DeletedPostEvent, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Remove the image files of a deleted post from the storage, in bulk.
+    """
+    uow.minio.delete_prefix(f"posts/{events.post_id}/")
+
+
+def invalidate_cached_post(events: events.Event, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Drop the cached post of the event.
+    """
+    views.invalidate_post(events.post_id, uow)
+
+
+def invalidate_cached_comment(events: events.DeletedCommentEvent, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Drop the cached comment of the event.
+    """
+    views.invalidate_comment(events.comment_id, uow)
+
+
+def invalidate_cached_parent_comment(
+    events: events.RepliedCommentEvent | events.DeletedCommentEvent, uow: unit_of_work.AbstractUnitOfWork
+):
+    """
+    Drop the cached comment replied to in the event, its reply_count changed.
+    """
+    if events.parent_id is not None:
+        views.invalidate_comment(events.parent_id, uow)
+
+
+def invalidate_cached_post_comments(events: events.DeletedPostEvent, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Drop the cached comments of a deleted post.
+    """
+    for comment_id in events.comment_ids:
+        views.invalidate_comment(comment_id, uow)
+
+
+def invalidate_cached_replies(events: events.DeletedCommentEvent, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Drop the cached replies of a deleted comment.
+    """
+    for reply_id in events.reply_ids:
+        views.invalidate_comment(reply_id, uow)
+
+
+def invalidate_cached_comments(events: events.Event, uow: unit_of_work.AbstractUnitOfWork):
+    """
+    Drop the cached comment pages of the post of the event.
+    """
+    views.invalidate_comments(events.post_id, uow)
+
+
 def handle_permission_denied(events: events.Event, uow: unit_of_work.AbstractUnitOfWork):
     """
     Handle the permission denied event.
@@ -181,19 +267,36 @@ def handle_permission_denied(events: events.Event, uow: unit_of_work.AbstractUni
 
 EVENT_HANDLERS = {
     events.CreatedPostEvent: [handle_post_created],
-    events.EditedPostEvent: [do_nothing],
-    events.DeletedPostEvent: [do_nothing],
+    events.EditedPostEvent: [invalidate_cached_post],
+    events.DeletedPostEvent: [invalidate_cached_post, invalidate_cached_comments, invalidate_cached_post_comments, remove_post_images],
+    events.AttachedImageEvent: [invalidate_cached_post],
     events.LikedPostEvent: [do_nothing],
     events.UnlikedPostEvent: [do_nothing],
-    events.CreatedCommentEvent: [do_nothing],
+    # the comment_count of the post and the reply_count of the replied comment change too
+    events.CreatedCommentEvent: [invalidate_cached_comments, invalidate_cached_post, handle_comment_created],
     events.LikedCommentEvent: [do_nothing],
     events.UnlikedCommentEvent: [do_nothing],
-    events.RepliedCommentEvent: [do_nothing],
-    events.DeletedCommentEvent: [do_nothing],
+    events.RepliedCommentEvent: [invalidate_cached_comments, invalidate_cached_post, invalidate_cached_parent_comment],
+    events.DeletedCommentEvent: [
+        invalidate_cached_comment,
+        invalidate_cached_replies,
+        invalidate_cached_comments,
+        invalidate_cached_post,
+        invalidate_cached_parent_comment,
+    ],
     events.DeniedPostActionEvent: [handle_permission_denied],
     events.DeniedCommentActionEvent: [handle_permission_denied],
 }
 
+# slow side effects, run out of the request when the bus has an event pool, see bootstrap
+# cache invalidations stay in the request so it reads its own writes
+BACKGROUND_EVENT_HANDLERS = {
+    handle_post_created,
+    handle_comment_created,
+    handle_permission_denied,
+    remove_post_images,
+}
+
 COMMAND_HANDLERS = {
     commands.CreatePostCommand: create_post,
     commands.EditPostCommand: edit_post,
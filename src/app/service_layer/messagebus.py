@@ -1,13 +1,21 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
 
+import collections
+import functools
+import hashlib
+import json
 import logging
+import random
+import threading
 import typing as t
 
 from src.app.domain import commands
 from src.app.domain import events
 
 if t.TYPE_CHECKING:
+    from src.app.adapters import cache
+    from src.app.service_layer import event_handler_pool
     from src.app.service_layer import unit_of_work
 
 logger = logging.getLogger(__name__)
@@ -15,6 +23,24 @@ logger = logging.getLogger(__name__)
 Message = commands.Command | events.Event
 
 
+class IdempotencyKeyReused(ValueError):
+    """
+    An idempotency key was sent again with another command.
+    """
+
+
+class IdempotencyKeyInProgress(RuntimeError):
+    """
+    The command of an idempotency key is still running, its retry came too early.
+    """
+
+
+class CommandConflict(RuntimeError):
+    """
+    A command kept conflicting with concurrent ones, after every retry.
+    """
+
+
 class MessageBus:
     """Handles messages and dispatches them to the appropriate handlers."""
 
@@ -23,42 +49,183 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: dict[t.Type[events.Event], list[t.Callable]],
         command_handlers: dict[t.Type[commands.Command], t.Callable],
+        background_event_handlers: dict[t.Type[events.Event], list[t.Callable]] | None = None,
+        event_pool: event_handler_pool.EventHandlerPool | None = None,
+        idempotency_store: cache.AbstractCache | None = None,
+        idempotency_ttl: float = 24 * 60 * 60,
+        idempotency_pending_ttl: float = 60.0,
+        max_retries: int = 3,
+        retry_base_delay: float = 0.01,
+        retry_max_delay: float = 0.5,
     ):
-        """Initializes the MessageBus with the given parameters."""
+        """Initializes the MessageBus with the given parameters.
+
+        `background_event_handlers` run in `event_pool`, the caller of `handle` does not wait for them.
+        `idempotency_store` keeps the results of the commands with an idempotency key for `idempotency_ttl`
+        seconds, and the keys of the running ones for `idempotency_pending_ttl` at most.
+        A command conflicting with a concurrent one is run again up to `max_retries` times, after a random delay
+        under `retry_base_delay` doubled on each retry and capped to `retry_max_delay`.
+        """
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.background_event_handlers = background_event_handlers or {}
+        self.event_pool = event_pool
+        self.idempotency_store = idempotency_store
+        self.idempotency_ttl = idempotency_ttl
+        self.idempotency_pending_ttl = idempotency_pending_ttl
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retries_lock = threading.Lock()
+        # name of the command: {"retries": retried conflicts, "exhausted": conflicts left after every retry}
+        self.retries = collections.defaultdict(collections.Counter)  # type: collections.defaultdict[str, collections.Counter]
 
-    def handle(self, message: Message):
-        """"""
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
+    def handle(self, message: Message, strict: bool = False):
+        """Handles a message and the events it raises, returns the result of the handler of a command.
+
+        A failed event handler is logged and the others go on. With `strict`, the background event handlers run
+        in the caller too and the first failure is raised once every handler ran, for a consumer that must not
+        ack an event before it is handled.
+        """
+        result = None
+        # local to the call, the bus is shared by concurrent requests
+        queue = collections.deque([message])
+        while queue:
+            message = queue.popleft()
             if isinstance(message, events.Event):
-                self.handle_event(message)
+                self.handle_event(message, queue, strict)
             elif isinstance(message, commands.Command):
-                self.handle_command(message)
+                result = self.handle_command(message, queue)
             else:
                 raise Exception(f"{message} was not an Event or Command")
+        return result
+
+    async def handle_async(self, message: Message):
+        """Handles a message from a coroutine, see AbstractUnitOfWork.run_sync."""
+        return await self.uow.run_sync(self.handle, message)
 
-    def handle_event(self, event: events.Event):
+    def handle_event(self, event: events.Event, queue: collections.deque[Message], strict: bool = False):
         """"""
-        for handler in self.event_handlers[type(event)]:
+        handlers = list(self.event_handlers[type(event)])
+        if strict:
+            handlers += self.background_event_handlers.get(type(event), [])
+        errors = []
+        for handler in handlers:
             try:
                 logger.debug("handling event %s with handler %s", event, handler)
                 handler(event)
-                self.queue.extend(self.uow.collect_new_events())
-            except Exception:
+                queue.extend(self.uow.collect_new_events())
+            except Exception as e:
                 logger.exception("Exception handling event %s", event)
+                errors.append(e)
                 continue
+        if strict:
+            if errors:
+                raise errors[0]
+            return
+        for handler in self.background_event_handlers.get(type(event), []):
+            t.cast("event_handler_pool.EventHandlerPool", self.event_pool).submit(
+                handler.__name__, functools.partial(self._handle_event_in_background, handler, event)
+            )
 
-    def handle_command(self, command: commands.Command):
+    def _handle_event_in_background(self, handler: t.Callable, event: events.Event):
+        """"""
+        logger.debug("handling event %s with handler %s in background", event, handler)
+        try:
+            handler(event)
+        finally:
+            # the events of the units of work committed before a failure are still raised
+            for new_event in tuple(self.uow.collect_new_events()):
+                self.handle(new_event)
+
+    def drain(self, timeout: float):
+        """Waits for the event handlers running in background, for a graceful shutdown."""
+        if self.event_pool is not None:
+            self.event_pool.drain(timeout)
+
+    def handle_command(self, command: commands.Command, queue: collections.deque[Message]):
         """"""
         logger.debug("handling command %s", command)
+        if command.idempotency_key is not None and self.idempotency_store is not None:
+            return self._handle_idempotent_command(command, queue)
+        return self._run_command(command, queue)
+
+    def _run_command(self, command: commands.Command, queue: collections.deque[Message]):
+        """Runs the handler of a command, again while it conflicts with concurrent ones.
+
+        The unit of work of a failed run is rolled back and its events dropped, so a retry starts over.
+        """
+        name = type(command).__name__
+        attempt = 0
+        while True:
+            try:
+                handler = self.command_handlers[type(command)]
+                result = handler(command)
+                queue.extend(self.uow.collect_new_events())
+                return result
+            except Exception as e:
+                if not self.uow.is_conflict(e):
+                    logger.exception("Exception handling command %s", command)
+                    raise
+                if attempt == self.max_retries:
+                    self._count_retry(name, "exhausted")
+                    logger.exception("Command %s still conflicts after %d retries", command, attempt)
+                    raise CommandConflict(name) from e
+            delay = self._retry_delay(attempt)
+            logger.info("Command %s conflicts with a concurrent one, retrying in %.3fs", command, delay)
+            self._count_retry(name, "retries")
+            self.uow.sleep(delay)
+            attempt += 1
+
+    def _retry_delay(self, attempt: int) -> float:
+        # full jitter, so the conflicting commands do not retry in step
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2**attempt))
+
+    def _count_retry(self, name: str, outcome: str):
+        with self.retries_lock:
+            self.retries[name][outcome] += 1
+
+    def retry_stats(self) -> dict:
+        """Gets the number of retried conflicts, and of conflicts left after every retry, per command."""
+        with self.retries_lock:
+            return {name: {"retries": counts["retries"], "exhausted": counts["exhausted"]} for name, counts in self.retries.items()}
+
+    def _handle_idempotent_command(self, command: commands.Command, queue: collections.deque[Message]):
+        """Runs a command once per idempotency key of its caller, see `Command.caller`.
+
+        A retry is answered with the stored result of the first run, without running the handler again nor
+        touching the database. A failed run frees its key, so the command can be retried.
+        """
+        store = t.cast("cache.AbstractCache", self.idempotency_store)
+        key = f"idempotency:{type(command).__name__}:{command.caller}:{command.idempotency_key}"
+        fingerprint = hashlib.sha256(
+            json.dumps(command.model_dump(exclude={"idempotency_key"}), sort_keys=True, default=repr).encode()
+        ).hexdigest()
+
+        # (fingerprint, done, result), the key is taken atomically so concurrent retries run the command once
+        attempt = 0
+        while not store.add(key, (fingerprint, False, None), ttl=self.idempotency_pending_ttl):
+            entry = store.get(key)
+            if entry is None:
+                # expired meanwhile, or the store failed to read it: take it again, a few times
+                if attempt == self.max_retries:
+                    raise IdempotencyKeyInProgress(command.idempotency_key)
+                self.uow.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+            stored_fingerprint, done, result = entry
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyKeyReused(command.idempotency_key)
+            if not done:
+                raise IdempotencyKeyInProgress(command.idempotency_key)
+            logger.debug("answering command %s from its idempotency key", command)
+            return result
+
         try:
-            handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            result = self._run_command(command, queue)
         except Exception:
-            logger.exception("Exception handling command %s", command)
+            store.delete(key)
             raise
+        store.set(key, (fingerprint, True, result), ttl=self.idempotency_ttl)
+        return result
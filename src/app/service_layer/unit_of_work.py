@@ -1,16 +1,32 @@
 from __future__ import annotations
 
 import abc
+import asyncio
 import contextlib
+import contextvars
+import copy
+import datetime
+import functools
+import os
+import threading
+import time
 import typing as t
+import weakref
 
 import minio
-from sqlalchemy import create_engine
+import redis
+import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext import asyncio as sa_asyncio
+from sqlalchemy.util import concurrency
 
+from src.app.adapters import cache
+from src.app.adapters import counter_buffer
+from src.app.adapters import database
 from src.app.adapters import file_storage
 from src.app.adapters import repository
 from src.app.config import settings
+from src.app.domain import events
 from src.app.domain import model
 
 
@@ -18,7 +34,14 @@ class AbstractUnitOfWork(abc.ABC):
     posts: repository.AbstractRepository
     comments: repository.AbstractRepository
     images: repository.AbstractRepository
+    likes: repository.SqlAlchemyLikeRepository
+    outbox: repository.SqlAlchemyOutboxRepository
+    # events already written to the outbox, by id, kept so their ids are not reused meanwhile
+    committed_events: dict[int, events.Event]
     minio: file_storage.AbstractFileStorage
+    counters: counter_buffer.CounterBuffer
+    cache: cache.AbstractCache
+    loads: cache.SingleFlight
 
     @contextlib.contextmanager
     def unit_of_work(self):
@@ -33,10 +56,53 @@ class AbstractUnitOfWork(abc.ABC):
     def commit(self):
         self._commit()
 
+    async def run_sync(self, fn: t.Callable[..., t.Any], *args) -> t.Any:
+        """
+        Run `fn`, which opens units of work, from a coroutine without blocking the event loop.
+        """
+        return await asyncio.to_thread(fn, *args)
+
+    def sleep(self, seconds: float):
+        """
+        Wait between two units of work, from the code run by `run_sync`.
+        """
+        time.sleep(seconds)
+
+    def is_conflict(self, error: Exception) -> bool:
+        """
+        Whether `error` is a write conflicting with a concurrent unit of work, which succeeds when run again.
+        """
+        return False
+
+    def read_committed(self):
+        """
+        Run the transaction at READ COMMITTED whatever POSTGRES_ISOLATION_LEVEL, for the commands whose writes
+        commute, like counter increments, so they never fail on a concurrent one. Called before the first query.
+        """
+
+    def _uncommitted_events(self):
+        """
+        Events raised on the seen records since the last commit.
+        """
+        for repository in (self.posts, self.comments, self.images):
+            for r in repository.seen:
+                for event in r.events:
+                    if id(event) not in self.committed_events:
+                        self.committed_events[id(event)] = event
+                        yield event
+
     def collect_new_events(self):
-        for post in self.posts.seen:
-            while post.events:
-                yield post.events.pop(0)
+        return self._collect_seen_events()
+
+    def _collect_seen_events(self):
+        for repository in (self.posts, self.comments, self.images):
+            for r in repository.seen:
+                while r.events:
+                    yield r.events.pop(0)
+
+    @abc.abstractmethod
+    def flush_counters(self, ids: list[int]) -> t.Iterable[counter_buffer.CounterKey]:
+        raise NotImplementedError
 
     @abc.abstractmethod
     def _commit(self):
@@ -47,53 +113,214 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
+# serialization_failure and deadlock_detected
+CONFLICT_SQLSTATES = {"40001", "40P01"}
+
 POSTGRES_URI = f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOST}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}"
-DEFAULT_SESSION_FACTORY = orm.sessionmaker(
-    bind=create_engine(
-        POSTGRES_URI,
-        isolation_level="REPEATABLE READ",
-    )
-)
-DEFAUL_MINIO_CLIENT = minio.Minio(
-    endpoint=f"{settings.MINIO_HOST}:{settings.MINIO_PORT}",
-    access_key=settings.MINIO_ACCESS_KEY,
-    secret_key=settings.MINIO_SECRET_KEY,
-    secure=False,
+# the engine is created on the first session of each worker process, see LazySessionFactory
+DEFAULT_SESSION_FACTORY = database.LazySessionFactory(
+    lambda: database.create_engine(POSTGRES_URI, isolation_level=settings.POSTGRES_ISOLATION_LEVEL)
 )
 
 
+# the clients are created with the first unit of work rather than at import, and shared by every unit of work
+@functools.cache
+def default_minio_client() -> minio.Minio:
+    return minio.Minio(
+        endpoint=f"{settings.MINIO_HOST}:{settings.MINIO_PORT}",
+        access_key=settings.MINIO_ACCESS_KEY,
+        secret_key=settings.MINIO_SECRET_KEY,
+        secure=False,
+    )
+
+
+@functools.cache
+def default_counter_buffer() -> counter_buffer.CounterBuffer:
+    return counter_buffer.CounterBuffer()
+
+
+@functools.cache
+def default_view_cache() -> cache.AbstractCache:
+    """
+    Build the view cache from the settings. Without VIEW_CACHE_REDIS_DB it is in-process only, invalidated by the
+    changes made through this worker: the others keep serving their copy until it expires.
+    """
+    if settings.VIEW_CACHE_REDIS_DB is None:
+        return cache.LRUCache(settings.VIEW_CACHE_SIZE, ttl=settings.VIEW_CACHE_TTL)
+    return cache.TieredCache(
+        cache.LRUCache(settings.VIEW_CACHE_SIZE, ttl=settings.VIEW_CACHE_LOCAL_TTL),
+        cache.RedisCache(
+            redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.VIEW_CACHE_REDIS_DB),
+            ttl=settings.VIEW_CACHE_TTL,
+        ),
+    )
+
+
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY, minio_client=DEFAUL_MINIO_CLIENT):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        minio_client: minio.Minio | None = None,
+        counters: counter_buffer.CounterBuffer | None = None,
+        view_cache: cache.AbstractCache | None = None,
+    ):
         self.session_factory = session_factory
-        self.minio_client = minio_client
+        self.minio_client = minio_client if minio_client is not None else default_minio_client()
+        # shared by the units of work, it checks the bucket once on the first upload
+        self.minio = file_storage.MinIOFileStorage(self.minio_client)
+        self.counters = counters if counters is not None else default_counter_buffer()
+        self.cache = view_cache if view_cache is not None else default_view_cache()
+        # shared by the requests of the worker, so concurrent identical reads load once
+        self.loads = cache.SingleFlight()
+        # events raised in the units of work of the current request (thread or task), see collect_new_events
+        self.new_events = contextvars.ContextVar(f"new_events_{id(self)}", default=())  # type: contextvars.ContextVar[tuple]
+        # units of work opened by `with uow` in the current request, innermost last
+        self.entered = contextvars.ContextVar(f"entered_{id(self)}", default=())  # type: contextvars.ContextVar[tuple]
 
     @contextlib.contextmanager
     def unit_of_work(self):
+        """
+        Open a unit of work with its own session and repositories.
+        The instance is shared by every request, so the state of the unit of work lives on a copy of it.
+        """
+        uow_ctx = copy.copy(self)
+        uow_ctx.session = self._new_session()
         try:
-            self.session = self.session_factory()
-            self.posts = repository.SqlAlchemyRepository(self.session, model.Post)
-            self.comments = repository.SqlAlchemyRepository(self.session, model.Comment)
-            self.images = repository.SqlAlchemyRepository(self.session, model.Image)
-            self.minio = file_storage.MinIOFileStorage(self.minio_client)
-            yield self
+            uow_ctx.posts = repository.SqlAlchemyPostRepository(uow_ctx.session)
+            uow_ctx.comments = repository.SqlAlchemyCommentRepository(uow_ctx.session)
+            uow_ctx.images = repository.SqlAlchemyRepository(uow_ctx.session, model.Image)
+            uow_ctx.likes = repository.SqlAlchemyLikeRepository(uow_ctx.session)
+            uow_ctx.outbox = repository.SqlAlchemyOutboxRepository(uow_ctx.session)
+            uow_ctx.committed_events = {}
+            yield uow_ctx
         except:
-            self.rollback()
+            uow_ctx.rollback()
             raise
         finally:
-            self.session.close()
+            uow_ctx.session.close()
+        self.new_events.set(self.new_events.get() + tuple(uow_ctx._collect_seen_events()))
+
+    def _new_session(self) -> orm.Session:
+        return self.session_factory()
+
+    def collect_new_events(self):
+        new_events = self.new_events.get()
+        self.new_events.set(())
+        return iter(new_events)
 
     def __enter__(self):
-        self.session = self.session_factory()
-        self.posts = repository.SqlAlchemyRepository(self.session, model.Post)
-        self.comments = repository.SqlAlchemyRepository(self.session, model.Comment)
-        return super().__enter__()
+        # `with uow` opens a unit of work like `unit_of_work`, on a copy, the shared instance is never changed
+        context = self.unit_of_work()
+        self.entered.set(self.entered.get() + (context,))
+        return context.__enter__()
 
     def __exit__(self, *args):
-        super().__exit__(*args)
-        self.session.close()
+        entered = self.entered.get()
+        self.entered.set(entered[:-1])
+        return entered[-1].__exit__(*args)
+
+    def flush_counters(self, ids: list[int]) -> t.Iterable[counter_buffer.CounterKey]:
+        # own session, the flush runs in the counter buffer thread
+        session = self.session_factory()
+        try:
+            orphan_age = datetime.timedelta(seconds=settings.LIKE_COUNTER_ORPHAN_AGE)
+            deltas = repository.SqlAlchemyLikeRepository(session).apply_like_count_deltas(ids, orphan_age)
+            session.commit()
+            return deltas.keys()
+        finally:
+            session.close()
+
+    def pool_stats(self) -> dict:
+        """
+        Get the statistics of the connection pools.
+        """
+        return {"sync": database.pool_stats(database.engine_of(self.session_factory))}
+
+    def is_conflict(self, error: Exception) -> bool:
+        # a record changed since it was read, see the version_id_col of the mappers
+        if isinstance(error, orm.exc.StaleDataError):
+            return True
+        return isinstance(error, sa.exc.DBAPIError) and getattr(error.orig, "pgcode", None) in CONFLICT_SQLSTATES
+
+    def read_committed(self):
+        self.session.connection(execution_options={"isolation_level": "READ COMMITTED"})
 
     def _commit(self):
+        # the events are published if and only if the changes that raised them are committed
+        self.outbox.add(list(self._uncommitted_events()))
         self.session.commit()
+        # the reads of this request after the commit must see it
+        self.loads.wrote()
 
     def rollback(self):
         self.session.rollback()
+
+
+ASYNC_POSTGRES_URI = POSTGRES_URI.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def default_async_engine() -> sa_asyncio.AsyncEngine:
+    return database.create_async_engine(ASYNC_POSTGRES_URI, isolation_level=settings.POSTGRES_ISOLATION_LEVEL)
+
+
+class AsyncSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    Unit of work on an async engine, for coroutines.
+
+    `run_sync` runs the handlers, repositories and views unchanged in a greenlet: their sessions are the sync
+    side of async sessions, so every round trip to Postgres hands the event loop over to the other requests.
+    Units of work opened from threads, like the counter flush or the event handler pool, keep the sync engine.
+    The connections of an async engine belong to its event loop, so each loop gets its own engine.
+    """
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        minio_client: minio.Minio | None = None,
+        counters: counter_buffer.CounterBuffer | None = None,
+        view_cache: cache.AbstractCache | None = None,
+        engine_factory: t.Callable[[], sa_asyncio.AsyncEngine] = default_async_engine,
+    ):
+        super().__init__(session_factory, minio_client, counters, view_cache)
+        self.engine_factory = engine_factory
+        self.engines_lock = threading.Lock()
+        self.async_session_factories: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, sa_asyncio.async_sessionmaker] = (
+            weakref.WeakKeyDictionary()
+        )
+        # weak, the hook outlives the unit of work
+        after_fork = weakref.WeakMethod(self._after_fork)
+        os.register_at_fork(after_in_child=lambda: after_fork() and after_fork()())
+
+    async def run_sync(self, fn: t.Callable[..., t.Any], *args) -> t.Any:
+        return await concurrency.greenlet_spawn(fn, *args)
+
+    def sleep(self, seconds: float):
+        if not concurrency.in_greenlet():
+            return super().sleep(seconds)
+        # hands the event loop over to the other requests meanwhile
+        concurrency.await_only(asyncio.sleep(seconds))
+
+    def _new_session(self) -> orm.Session:
+        if not concurrency.in_greenlet():
+            return super()._new_session()
+        loop = asyncio.get_running_loop()
+        with self.engines_lock:
+            if loop not in self.async_session_factories:
+                self.async_session_factories[loop] = sa_asyncio.async_sessionmaker(self.engine_factory())
+            async_session_factory = self.async_session_factories[loop]
+        return async_session_factory().sync_session
+
+    def pool_stats(self) -> dict:
+        stats = super().pool_stats()
+        with self.engines_lock:
+            engines = [async_session_factory.kw["bind"] for async_session_factory in self.async_session_factories.values()]
+        # one pool per event loop, usually one
+        stats["async"] = [database.pool_stats(engine) for engine in engines]
+        return stats
+
+    def _after_fork(self):
+        # the event loops and connections of the parent are not the child's, drop them without closing them
+        self.engines_lock = threading.Lock()
+        for async_session_factory in self.async_session_factories.values():
+            async_session_factory.kw["bind"].sync_engine.dispose(close=False)
+        self.async_session_factories = weakref.WeakKeyDictionary()
@@ -2,65 +2,455 @@
 All view requests are handled here
 """
 
+import base64
+import copy
+import dataclasses
+import datetime
+import json
+import typing as t
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql
+
 from src.app.entrypoints import schema
 from src.app.service_layer import unit_of_work
 
 
+class InvalidCursor(ValueError):
+    """
+    The pagination cursor is malformed or was issued for another order.
+    """
+
+
+# loads of a view overlapping a flush of the counter buffer before its like_counts are read from the database
+LIKE_READ_ATTEMPTS = 2
+
+
+def _encode_cursor(keys: list[str], values: list) -> str:
+    """
+    Encode the sort key of the last row of a page into an opaque cursor.
+    """
+    values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps({"k": keys, "v": values}).encode()).decode()
+
+
+def _decode_cursor(cursor: str, keys: list[str], columns: list) -> list:
+    """
+    Decode a cursor issued by `_encode_cursor` for the same sort keys.
+    """
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if decoded["k"] != keys or len(decoded["v"]) != len(keys):
+            raise InvalidCursor(cursor)
+        return [
+            datetime.datetime.fromisoformat(value) if column.type.python_type is datetime.datetime else value
+            for column, value in zip(columns, decoded["v"])
+        ]
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def _paginate(
+    q,
+    _model,
+    order: list[tuple[str, bool]],
+    limit: int | None,
+    cursor: str | None,
+    offset: int = 0,
+    expressions: dict | None = None,
+) -> tuple[list, str | None]:
+    """
+    Keyset pagination: rows strictly after the cursor, sorted by `order` as (column name, descending)
+    with the id as tie-breaker, so every page costs an index range scan whatever its depth.
+    `expressions` names computed sort keys, like a search rank, usable in `order`.
+
+    Returns:
+        The rows of the page and the cursor of the next page, None on the last page.
+    """
+    expressions = expressions or {}
+    if "id" not in [key for key, _ in order]:
+        order = order + [("id", order[-1][1] if order else False)]
+    keys = [key for key, _ in order]
+    columns = [(expressions[key] if key in expressions else getattr(_model, key), desc) for key, desc in order]
+    if expressions:
+        q = q.add_columns(*[expression.label(key) for key, expression in expressions.items()])
+
+    if cursor is not None:
+        values = _decode_cursor(cursor, keys, [column for column, _ in columns])
+        if len({desc for _, desc in columns}) == 1:
+            # same direction for every key, a row comparison can use a composite index
+            after = sa.tuple_(*[column for column, _ in columns])
+            q = q.filter(after < sa.tuple_(*values) if columns[0][1] else after > sa.tuple_(*values))
+        else:
+            q = q.filter(
+                sa.or_(
+                    *[
+                        sa.and_(
+                            *[c == v for (c, _), v in zip(columns[:i], values[:i])],
+                            column < values[i] if desc else column > values[i],
+                        )
+                        for i, (column, desc) in enumerate(columns)
+                    ]
+                )
+            )
+
+    q = q.order_by(*[column.desc() if desc else column.asc() for column, desc in columns]).offset(offset)
+    if limit is None:
+        rows, next_cursor = q.all(), None
+    else:
+        # one more row tells whether there is a next page
+        rows, next_cursor = q.limit(limit + 1).all(), None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = _encode_cursor(
+                keys, [last._mapping[key] if key in expressions else getattr(last[0] if expressions else last, key) for key in keys]
+            )
+
+    if expressions:
+        rows = [row[0] for row in rows]
+    return rows, next_cursor
+
+
+def _read_likes(load: t.Callable[[], t.Any], uow: unit_of_work.AbstractUnitOfWork) -> tuple[int | None, t.Any]:
+    """
+    Run `load`, which reads like_counts, without waiting for the flushes of the counter buffer.
+    A load overlapping a flush may or may not have seen it, it is run again at most LIKE_READ_ATTEMPTS times.
+
+    Returns:
+        The seq of the counter buffer the like_counts read are consistent with, None when every load overlapped
+        a flush, see `_with_pending_likes`, and the result of `load`.
+    """
+    for _ in range(LIKE_READ_ATTEMPTS):
+        seq = uow.counters.seq
+        loaded = load()
+        if seq % 2 == 0 and uow.counters.seq == seq:
+            return seq, loaded
+    return None, loaded
+
+
+def _with_pending_likes(table: str, loaded: list[tuple[int | None, dict]], uow: unit_of_work.AbstractUnitOfWork) -> list[dict]:
+    """
+    Add the like_count deltas not flushed to the database yet to records read at their seq.
+
+    The like_counts of the records flushed since their read, or read at no seq, are read again from the database
+    with their deltas in one query, and the records are dropped from the cache.
+    """
+    records, stale = [], []
+    for seq, record in loaded:
+        pending = None if seq is None else uow.counters.pending_since(table, record["id"], seq)
+        if pending is None:
+            stale.append(record)
+        else:
+            record["like_count"] += pending
+        records.append(record)
+
+    if stale:
+        with uow.unit_of_work() as uow_ctx:
+            like_counts = uow_ctx.likes.like_counts(table, [record["id"] for record in stale])
+        for record in stale:
+            # a record deleted meanwhile keeps the like_count read
+            record["like_count"] = like_counts.get(record["id"], record["like_count"])
+        invalidate_like_counts([(table, record["id"]) for record in stale], uow)
+    return records
+
+
+def _generation(key: str, uow: unit_of_work.AbstractUnitOfWork) -> str:
+    """
+    Get the generation of a cached key, part of the key its value is cached under, see `_invalidate`.
+    """
+    generation = uow.cache.get(f"generation:{key}")
+    if generation is None:
+        # concurrent readers agree on the first one added, a failed cache gives an uncached generation
+        candidate = uuid.uuid4().hex
+        generation = candidate if uow.cache.add(f"generation:{key}", candidate) else uow.cache.get(f"generation:{key}") or candidate
+    return generation
+
+
+def _invalidate(key: str, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    """
+    Drop the generation of a cached key, so its value is loaded again.
+    A load that started before is cached under the old generation, which nobody reads anymore.
+    """
+    uow.cache.delete(f"generation:{key}")
+
+
+def _versioned_key(key: str, uow: unit_of_work.AbstractUnitOfWork, generation_key: str | None = None) -> str:
+    """
+    Get the key a value is cached under, with the current generation of `generation_key`, `key` unless given.
+    It must be read before the value is loaded.
+    """
+    return f"{key}:{_generation(generation_key or key, uow)}"
+
+
+def _cached(key: str, load: t.Callable[[], t.Any], uow: unit_of_work.AbstractUnitOfWork, generation_key: str | None = None) -> t.Any:
+    """
+    Read through the view cache, the caller gets its own copy of the cached value.
+    """
+    versioned_key = _versioned_key(key, uow, generation_key)
+    value = uow.cache.get(versioned_key)
+    if value is None:
+        value = load()
+        uow.cache.set(versioned_key, value)
+    return copy.deepcopy(value)
+
+
+def invalidate_post(post_id: str, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    """
+    Drop a cached post.
+    """
+    _invalidate(f"post:{post_id}", uow)
+
+
+def invalidate_comment(comment_id: str, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    """
+    Drop a cached comment.
+    """
+    _invalidate(f"comment:{comment_id}", uow)
+
+
+def invalidate_comments(post_id: str, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    """
+    Drop every cached comment page of a post at once, whatever their limit and cursor.
+    """
+    _invalidate(f"comments:{post_id}", uow)
+
+
+def invalidate_like_counts(keys: t.Iterable[tuple[str, str]], uow: unit_of_work.AbstractUnitOfWork) -> None:
+    """
+    Drop the cached records whose like_count was flushed, they are cached without their pending likes.
+    """
+    for table, id in keys:
+        if table == "posts":
+            invalidate_post(id, uow)
+        else:
+            invalidate_comment(id, uow)
+
+
 def get_post(post_id: str, uow: unit_of_work.AbstractUnitOfWork):
     """
     Get a post by its id, I think.
     """
-    with uow.unit_of_work() as uow_ctx:
-        post = uow_ctx.posts.get(post_id)
-        result = post.model_dump()
-        for image in result["images"]:
-            image["link"] = uow_ctx.minio.get(image["path"])
-        return result
+
+    # on a miss of a hot post, concurrent requests share one load
+    seq, post = _cached(f"post:{post_id}", lambda: uow.loads.do(("get_post", post_id), lambda: _load_post(post_id, uow)), uow)
+    return _present_post(post, seq, uow)
+
+
+def _load_post(post_id: str, uow: unit_of_work.AbstractUnitOfWork) -> tuple[int | None, dict]:
+    """
+    Load a post for `get_post`, without its pending likes and image links, with the seq it was read at.
+    """
+
+    def load():
+        with uow.unit_of_work() as uow_ctx:
+            return uow_ctx.posts.get(post_id).model_dump()
+
+    return _read_likes(load, uow)
+
+
+def _present_post(post: dict, seq: int | None, uow: unit_of_work.AbstractUnitOfWork) -> dict:
+    """
+    Add the pending likes and image links to a post loaded by `_load_post`.
+    """
+    (result,) = _with_pending_likes("posts", [(seq, post)], uow)
+    for image in result["images"]:
+        image["link"] = uow.minio.get(image["path"])
+    return result
 
 
 def find_post(title: str, uow: unit_of_work.AbstractUnitOfWork):
     """
     Find a post by its title.
     """
-    with uow.unit_of_work() as uow_ctx:
-        post = uow_ctx.posts.query(title=title)
-        return [post.model_dump() for post in post]
 
+    def load():
+        with uow.unit_of_work() as uow_ctx:
+            _post = uow_ctx.posts.model
+            post = uow_ctx.posts._q.options(orm.selectinload(_post.images)).filter_by(title=title).all()
+            return [post.model_dump() for post in post]
 
-def get_comments(post_id: str, uow: unit_of_work.AbstractUnitOfWork):
+    seq, posts = _read_likes(load, uow)
+    return _with_pending_likes("posts", [(seq, post) for post in posts], uow)
+
+
+def get_comments(post_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None = None, cursor: str | None = None):
     """
-    Get comments of a post.
+    Get comments of a post, oldest first.
+    A cached page only holds comment ids, so a change of one comment does not invalidate its pages.
+    The comments are cached one by one with the seq they were read at, each under its own generation.
     """
-    with uow.unit_of_work() as uow_ctx:
-        comments = uow_ctx.comments.query(post_id=post_id)
-        return [comment.model_dump() for comment in comments]
+
+    def load_page():
+        with uow.unit_of_work() as uow_ctx:
+            comment = uow_ctx.comments.model
+            q = uow_ctx.session.query(comment.id, comment.created_time).filter(comment.post_id == post_id)
+            rows, next_cursor = _paginate(q, comment, [("created_time", False)], limit, cursor)
+            return {"ids": [row.id for row in rows], "next_cursor": next_cursor}
+
+    def load_missing():
+        with uow.unit_of_work() as uow_ctx:
+            comment = uow_ctx.comments.model
+            return [record.model_dump() for record in uow_ctx.comments._q.filter(comment.id.in_(missing))]
+
+    page = _cached(f"comments:{post_id}:{limit}:{cursor}", load_page, uow, generation_key=f"comments:{post_id}")
+    # read before the load of the missing comments, see `_invalidate`
+    keys = {id: _versioned_key(f"comment:{id}", uow) for id in page["ids"]}
+    records = {id: uow.cache.get(key) for id, key in keys.items()}
+    missing = [id for id, record in records.items() if record is None]
+    if missing:
+        seq, loaded = _read_likes(load_missing, uow)
+        for record in loaded:
+            records[record["id"]] = (seq, record)
+            uow.cache.set(keys[record["id"]], records[record["id"]])
+    return {
+        # comments deleted since the page was cached are skipped
+        "items": _with_pending_likes("comments", [copy.deepcopy(records[id]) for id in page["ids"] if records[id] is not None], uow),
+        "next_cursor": page["next_cursor"],
+    }
 
 
 def get_comment(comment_id: str, uow: unit_of_work.AbstractUnitOfWork):
     """
     Get a comment by its id.
     """
-    with uow.unit_of_work() as uow_ctx:
-        comment = uow_ctx.comments.get(comment_id)
-        return comment.model_dump()
+
+    def load():
+        with uow.unit_of_work() as uow_ctx:
+            return uow_ctx.comments.get(comment_id).model_dump()
+
+    seq, comment = _cached(f"comment:{comment_id}", lambda: _read_likes(load, uow), uow)
+    return _with_pending_likes("comments", [(seq, comment)], uow)[0]
+
+
+def get_reply_comments(comment_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None = None, cursor: str | None = None):
+    """
+    Get reply comments of a comment, oldest first.
+    """
+
+    def load():
+        with uow.unit_of_work() as uow_ctx:
+            comment = uow_ctx.comments.model
+            q = uow_ctx.comments._q.filter(comment.comment_id == comment_id)
+            comments, next_cursor = _paginate(q, comment, [("created_time", False)], limit, cursor)
+            return [comment.model_dump() for comment in comments], next_cursor
+
+    seq, (comments, next_cursor) = _read_likes(load, uow)
+    return {
+        "items": _with_pending_likes("comments", [(seq, comment) for comment in comments], uow),
+        "next_cursor": next_cursor,
+    }
+
+
+def get_comment_thread(post_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None = None, cursor: str | None = None):
+    """
+    Get the comments of a post as a tree, the top level comments are paginated oldest first
+    and each one comes with all its replies, nested and oldest first.
+
+    The whole page is loaded in one query: a recursive CTE walks down from the top level comments of the page
+    along ix_comments_comment_id_created_time_id, at most MAX_LEVEL_DEPTH levels.
+    """
+    seq, (comments, next_cursor) = _read_likes(lambda: _load_comment_thread(post_id, uow, limit, cursor), uow)
+    return {
+        "items": _build_thread(_with_pending_likes("comments", [(seq, comment) for comment in comments], uow)),
+        "next_cursor": next_cursor,
+    }
 
 
-def get_reply_comments(comment_id: str, uow: unit_of_work.AbstractUnitOfWork):
+def _load_comment_thread(
+    post_id: str, uow: unit_of_work.AbstractUnitOfWork, limit: int | None, cursor: str | None
+) -> tuple[list[dict], str | None]:
     """
-    Get reply comments of a comment.
+    Load the comments of a page of `get_comment_thread`, ordered, and the cursor of the next page.
     """
     with uow.unit_of_work() as uow_ctx:
-        comments = uow_ctx.comments.query(comment_id=comment_id)
-        return [comment.model_dump() for comment in comments]
+        comment = uow_ctx.comments.model
+        table = comment.__table__
+        order = [table.c.created_time, table.c.id]
+
+        # the position of each top level comment in the page, inherited by its replies
+        roots = sa.select(table, sa.func.row_number().over(order_by=order).label("root_number")).where(
+            table.c.post_id == post_id, table.c.comment_id.is_(None)
+        )
+        if cursor is not None:
+            roots = roots.where(sa.tuple_(*order) > sa.tuple_(*_decode_cursor(cursor, ["created_time", "id"], order)))
+        roots = roots.order_by(*order)
+        if limit is not None:
+            # one more top level comment tells whether there is a next page
+            roots = roots.limit(limit + 1)
+        thread = roots.cte("thread", recursive=True)
+        replies = sa.select(table, thread.c.root_number).join(thread, table.c.comment_id == thread.c.id)
+        if limit is not None:
+            # the replies of the extra top level comment are not loaded
+            replies = replies.where(thread.c.root_number <= limit)
+        thread = thread.union_all(replies)
+
+        record = orm.aliased(comment, thread)
+        rows = uow_ctx.session.execute(sa.select(record, thread.c.root_number).order_by(thread.c.created_time, thread.c.id)).all()
+
+        next_cursor = None
+        if limit is not None and any(root_number > limit for _, root_number in rows):
+            rows = [(record, root_number) for record, root_number in rows if root_number <= limit]
+            last = [record for record, _ in rows if record.comment_id is None][-1]
+            next_cursor = _encode_cursor(["created_time", "id"], [last.created_time, last.id])
+
+        return [record.model_dump() for record, _ in rows], next_cursor
+
+
+def _build_thread(comments: list[dict]) -> list[dict]:
+    """
+    Nest the comments of a thread under their parents in one pass, keeping their order.
+
+    Returns:
+        The top level comments, each with its `replies`.
+    """
+    by_id = {comment["id"]: comment for comment in comments}
+    roots = []
+    for comment in comments:
+        comment["replies"] = comment.get("replies", [])
+        parent = by_id.get(comment["comment_id"]) if comment["comment_id"] is not None else None
+        if parent is None:
+            roots.append(comment)
+        else:
+            parent.setdefault("replies", []).append(comment)
+    return roots
 
 
 def get_posts(params: schema.GetPostsRequest, uow: unit_of_work.AbstractUnitOfWork):
     """
     Get all posts.
+    Concurrent requests with the same parameters share one load, unless it started before a write of the worker.
+    """
+    return _present_posts(uow.loads.do(_posts_key(params), lambda: _load_posts(params, uow)), uow)
+
+
+def _posts_key(params: schema.GetPostsRequest) -> tuple:
+    return ("get_posts", json.dumps(dataclasses.asdict(params), sort_keys=True))
+
+
+def _present_posts(loaded: tuple[int | None, dict], uow: unit_of_work.AbstractUnitOfWork) -> dict:
+    """
+    Add the pending likes to a copy of a page loaded by `_load_posts`, it may be shared by coalesced requests.
     """
+    seq, page = copy.deepcopy(loaded)
+    page["items"] = _with_pending_likes("posts", [(seq, post) for post in page["items"]], uow)
+    return page
+
+
+def _load_posts(params: schema.GetPostsRequest, uow: unit_of_work.AbstractUnitOfWork) -> tuple[int | None, dict]:
+    """
+    Load a page of posts for `get_posts`, without their pending likes, with the seq it was read at.
+    """
+    return _read_likes(lambda: _query_posts(params, uow), uow)
+
+
+def _query_posts(params: schema.GetPostsRequest, uow: unit_of_work.AbstractUnitOfWork) -> dict:
     with uow.unit_of_work() as uow_ctx:
         post = uow_ctx.posts.model
-        q = uow_ctx.posts._q
+        # load the images of the whole page in one query instead of one per post
+        q = uow_ctx.posts._q.options(orm.selectinload(post.images))
 
         if params.title is not None:
             q = q.filter(post.title.like(f"%{params.title}%"))
@@ -71,15 +461,22 @@ def get_posts(params: schema.GetPostsRequest, uow: unit_of_work.AbstractUnitOfWo
         if params.author_id is not None:
             q = q.filter(post.author_id == params.author_id)
 
-        if len(params.order) > 0:
-            q = q.order_by(
-                *[
-                    getattr(post, field[1:]).desc() if field.startswith("-") else getattr(post, field[1:]).asc()
-                    for field in params.order
-                    if field[1:] in post.__table__.columns.keys() and field[0] in ["-", "+"]
-                ]
-            )
-        q = q.limit(params.limit).offset(params.offset)
+        order = [
+            (field[1:], field.startswith("-"))
+            for field in params.order
+            if field[1:] in sa.inspect(post).column_attrs.keys() and field[0] in ["-", "+"]
+        ]
+        expressions = {}
+        if params.q is not None:
+            # full text search on the GIN index of posts.search_vector, best matches first
+            search_vector = post.__table__.c.search_vector
+            query = sa.func.websearch_to_tsquery("simple", params.q)
+            q = q.filter(search_vector.op("@@")(query))
+            # ts_rank is a real, compare cursors as double precision so they round trip exactly
+            expressions["rank"] = sa.cast(sa.func.ts_rank(search_vector, query), postgresql.DOUBLE_PRECISION)
+            order = [("rank", True)]
 
-        posts = q.all()
-        return [post.model_dump() for post in posts]
+        # offset is only kept for old clients, it is ignored once a cursor is given
+        offset = params.offset if params.cursor is None else 0
+        posts, next_cursor = _paginate(q, post, order, params.limit, params.cursor, offset, expressions)
+        return {"items": [post.model_dump() for post in posts], "next_cursor": next_cursor}
@@ -0,0 +1,45 @@
+"""
+Latency of opening units of work that never touch files, against a fake MinIO with a simulated round trip.
+
+Run with `python -m tests.benchmarks.bench_file_storage`, it needs no Postgres nor MinIO.
+"""
+
+import time
+
+from sqlalchemy import orm
+
+from src.app.adapters import file_storage
+from src.app.service_layer import unit_of_work
+from tests.fakes import FakeMinio
+
+ROUND_TRIP = 0.002
+UNITS_OF_WORK = 500
+
+
+def main():
+    client = FakeMinio(latency=ROUND_TRIP)
+    # sessions without engine, no query is sent
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory=orm.sessionmaker(), minio_client=client)
+
+    start = time.perf_counter()
+    for _ in range(UNITS_OF_WORK):
+        # what every unit of work used to do: a new storage checking the bucket
+        storage = file_storage.MinIOFileStorage(client)
+        storage.ensure_bucket()
+        storage.get("posts/post_id/image.png")
+    before = time.perf_counter() - start
+
+    client.calls.clear()
+    start = time.perf_counter()
+    for _ in range(UNITS_OF_WORK):
+        with uow.unit_of_work() as uow_ctx:
+            uow_ctx.minio.get("posts/post_id/image.png")
+    after = time.perf_counter() - start
+
+    print(f"{UNITS_OF_WORK} units of work, {ROUND_TRIP * 1000:.1f} ms MinIO round trip")
+    print(f"bucket checked per unit of work: {before * 1000 / UNITS_OF_WORK:.3f} ms each")
+    print(f"storage shared, checked lazily:  {after * 1000 / UNITS_OF_WORK:.3f} ms each ({len(client.calls)} MinIO calls)")
+
+
+if __name__ == "__main__":
+    main()
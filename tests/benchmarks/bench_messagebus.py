@@ -0,0 +1,77 @@
+"""
+Throughput of the MessageBus dispatch loop for long event chains, against the list queue it used to have.
+
+Run with `python -m tests.benchmarks.bench_messagebus`, it needs no Postgres nor MinIO.
+"""
+
+import time
+
+from src.app.domain import commands
+from src.app.domain import events
+from src.app.service_layer import messagebus
+
+CHAIN_LENGTHS = [1_000, 10_000, 100_000]
+
+
+class EventsUnitOfWork:
+    """
+    Unit of work without repositories, it returns the events its handlers raise.
+    """
+
+    def __init__(self):
+        self.new_events = []  # type: list[events.Event]
+
+    def collect_new_events(self):
+        new_events, self.new_events = self.new_events, []
+        return new_events
+
+
+class ListQueueMessageBus(messagebus.MessageBus):
+    """
+    The dispatch loop before the deque, popping the head of a list.
+    """
+
+    def handle(self, message: messagebus.Message):
+        queue = [message]
+        while queue:
+            message = queue.pop(0)
+            if isinstance(message, events.Event):
+                self.handle_event(message, queue)
+            else:
+                self.handle_command(message, queue)
+
+
+def run(bus_class: type[messagebus.MessageBus], chain_length: int) -> float:
+    uow = EventsUnitOfWork()
+    chain = [events.LikedPostEvent(post_id=str(i), user_id="user_id") for i in range(chain_length)]
+    handled = []
+
+    def create_post(cmd: commands.CreatePostCommand):
+        # a command raising a long chain of events at once, like a cascade
+        uow.new_events = list(chain)
+
+    bus = bus_class(
+        uow=uow,  # type: ignore[arg-type]
+        event_handlers={events.LikedPostEvent: [handled.append]},
+        command_handlers={commands.CreatePostCommand: create_post},
+    )
+
+    start = time.perf_counter()
+    bus.handle(commands.CreatePostCommand(title="title", content="content", author_id="author_id"))
+    elapsed = time.perf_counter() - start
+    assert len(handled) == chain_length
+    return elapsed
+
+
+def main():
+    for chain_length in CHAIN_LENGTHS:
+        before = run(ListQueueMessageBus, chain_length)
+        after = run(messagebus.MessageBus, chain_length)
+        print(
+            f"{chain_length:>7} events: list {chain_length / before:>12,.0f} events/s, "
+            f"deque {chain_length / after:>12,.0f} events/s ({before / after:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Startup time of a worker: importing the application, running its startup and serving the first request.
+
+Run with `python -m tests.benchmarks.bench_startup`, it needs Postgres (see the POSTGRES_* settings).
+Each run is a fresh interpreter, as a new worker would be, and counts the connections opened by the import.
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+RUNS = 5
+
+WORKER = """
+import json
+import socket
+import time
+
+connections = []
+connect = socket.socket.connect
+socket.socket.connect = lambda self, address: connections.append(address) or connect(self, address)
+
+start = time.perf_counter()
+from src.app.entrypoints import app
+imported = time.perf_counter()
+
+from fastapi.testclient import TestClient
+
+imports_connections = len(connections)
+with TestClient(app.app) as client:
+    started = time.perf_counter()
+    response = client.get("/posts", params={"author_id": "bench_author_id"}, headers={"user-id": "bench_user_id"})
+    assert response.status_code == 200, response.text
+    served = time.perf_counter()
+
+print(json.dumps({
+    "import": imported - start,
+    "startup": started - imported,
+    "first_request": served - started,
+    "import_connections": imports_connections,
+}))
+"""
+
+
+def main():
+    runs = []
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, "-c", WORKER], check=True, stdout=subprocess.PIPE, text=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    for phase in ("import", "startup", "first_request"):
+        timings = [run[phase] * 1000 for run in runs]
+        print(f"{phase:>13}: median {statistics.median(timings):7.1f} ms, max {max(timings):7.1f} ms")
+    print(f"connections opened by the import: {max(run['import_connections'] for run in runs)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,23 @@ from sqlalchemy.orm import clear_mappers
 from src.app import bootstrap
 from src.app import views
 from src.app.domain import commands
-from src.app.entrypoints.app import app
+from src.app.entrypoints.app import create_app
 from src.app.service_layer import unit_of_work
+from tests.confest import async_bus  # noqa: F811, F401
 from tests.confest import bus  # noqa: F811, F401
 from tests.confest import sql_session_factory  # noqa: F811, F401
 
-client = TestClient(app)
+
+@pytest.fixture(scope="module")
+def client(async_bus):
+    with TestClient(create_app(async_bus)) as client:
+        yield client
+
+
+def test_create_app_does_not_bootstrap():
+    app = create_app()
+
+    assert not hasattr(app.state, "bus")
 
 
 @pytest.fixture
@@ -22,7 +33,7 @@ def user_id():
     return "test_e2e_user_id"
 
 
-def test_create_post(user_id, bus):
+def test_create_post(user_id, client):
     response = client.post(
         "/posts",
         headers={"user-id": user_id},
@@ -59,14 +70,14 @@ def post_id(bus):
     return post["id"]
 
 
-def test_get_post(bus, post_id):
+def test_get_post(client, post_id):
     response = client.get(f"/posts/{post_id}", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 200
     assert response.json()["id"] == post_id
 
 
-def test_edit_post(bus, post_id, user_id):
+def test_edit_post(client, post_id, user_id):
     response = client.put(
         f"/posts/{post_id}",
         headers={"user-id": user_id},
@@ -76,19 +87,19 @@ def test_edit_post(bus, post_id, user_id):
     assert response.status_code == 204
 
 
-def test_delete_post(bus, post_id, user_id):
+def test_delete_post(client, post_id, user_id):
     response = client.delete(f"/posts/{post_id}", headers={"user-id": user_id})
 
     assert response.status_code == 204
 
 
-def test_like_post(bus, post_id):
+def test_like_post(client, post_id):
     response = client.post(f"/posts/{post_id}/like", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 204
 
 
-def test_comment_post(bus, post_id):
+def test_comment_post(client, post_id):
     response = client.post(
         f"/posts/{post_id}/comments",
         headers={"user-id": "test_user_id"},
@@ -108,12 +119,12 @@ def comment_id(bus, post_id):
     )
 
     bus.handle(cmd)
-    comments = views.get_comments(post_id, bus.uow)
+    comments = views.get_comments(post_id, bus.uow)["items"]
 
     return comments[0]["id"]
 
 
-def test_reply_comment(bus, comment_id):
+def test_reply_comment(client, comment_id):
     response = client.post(
         f"/comments/{comment_id}/reply",
         headers={"user-id": "test_user_id"},
@@ -124,31 +135,67 @@ def test_reply_comment(bus, comment_id):
     assert response.status_code == 201
 
 
-def test_delete_comment(bus, comment_id):
+def test_delete_comment(client, comment_id):
     response = client.delete(f"/comments/{comment_id}", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 204
 
 
-def test_like_comment(bus, comment_id):
+def test_like_comment(client, comment_id):
     response = client.post(f"/comments/{comment_id}/like", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 204
 
 
-def test_get_comments(bus, post_id):
+def test_get_comments(client, post_id):
     response = client.get(f"/posts/{post_id}/comments", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 200
 
 
-def test_get_reply_comments(bus, comment_id):
+def test_get_reply_comments(client, comment_id):
     response = client.get(f"/comments/{comment_id}/reply", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 200
 
 
-def test_get_posts(bus):
+def test_get_posts(client):
     response = client.get("/posts", headers={"user-id": "test_user_id"})
 
     assert response.status_code == 200
+
+
+def test_get_posts_invalid_cursor(client):
+    response = client.get("/posts", params={"cursor": "not a cursor"}, headers={"user-id": "test_user_id"})
+
+    assert response.status_code == 400
+
+
+def test_get_metrics(client):
+    client.get("/posts", headers={"user-id": "test_user_id"})
+    response = client.get("/metrics", headers={"user-id": "test_user_id"})
+
+    assert response.status_code == 200
+    assert response.json()["coalesced_reads"]["get_posts"]["loads"] >= 1
+    assert response.json()["database_pools"]["sync"]["checked_out"] >= 0
+    assert isinstance(response.json()["command_retries"], dict)
+
+
+def test_get_comment_thread(client, comment_id, post_id):
+    response = client.get(f"/posts/{post_id}/thread", headers={"user-id": "test_user_id"})
+
+    assert response.status_code == 200
+    assert [comment["id"] for comment in response.json()["items"]] == [comment_id]
+
+
+def test_comment_post_with_idempotency_key(client, post_id):
+    headers = {"user-id": "test_user_id", "idempotency-key": str(uuid.uuid4())}
+
+    for _ in range(2):
+        response = client.post(f"/posts/{post_id}/comments", headers=headers, json={"content": "test comment"})
+        assert response.status_code == 201
+    response = client.post(f"/posts/{post_id}/comments", headers=headers, json={"content": "another comment"})
+
+    assert response.status_code == 422
+    thread = client.get(f"/posts/{post_id}/thread", headers={"user-id": "test_user_id"}).json()
+    assert len(thread["items"]) == 1
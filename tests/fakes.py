@@ -0,0 +1,232 @@
+"""
+In-memory stand-ins of the external services, for tests and benchmarks.
+"""
+
+import itertools
+import threading
+import time
+import types
+from xml.etree import ElementTree
+
+import redis
+
+
+class FakeMinio:
+    """
+    Stand-in of minio.Minio, every request sleeps `latency` seconds like a network round trip.
+    `max_in_flight` is the most requests it served at once.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.buckets = set()  # type: set[str]
+        self.objects = {}  # type: dict[tuple[str, str], bytes]
+        self.calls = []  # type: list[str]
+        self.signed = 0
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _request(self, name: str) -> None:
+        with self.lock:
+            self.calls.append(name)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        self._request("bucket_exists")
+        return bucket_name in self.buckets
+
+    def make_bucket(self, bucket_name: str) -> None:
+        self._request("make_bucket")
+        self.buckets.add(bucket_name)
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, part_size: int = 0, **kwargs) -> None:
+        self._request("put_object")
+        # like the real client, read one part at a time
+        parts = []
+        while part := data.read(part_size or length):
+            parts.append(part)
+        self.objects[(bucket_name, object_name)] = b"".join(parts)
+
+    def remove_object(self, bucket_name: str, object_name: str) -> None:
+        self._request("remove_object")
+        self.objects.pop((bucket_name, object_name), None)
+
+    def list_objects(self, bucket_name: str, prefix: str | None = None, recursive: bool = False):
+        self._request("list_objects")
+        return [
+            types.SimpleNamespace(object_name=name)
+            for bucket, name in list(self.objects)
+            if bucket == bucket_name and name.startswith(prefix or "")
+        ]
+
+    def remove_objects(self, bucket_name: str, delete_object_list):
+        # like the real client, one request per 1000 objects, sent as the errors are read
+        delete_objects = iter(delete_object_list)
+        while batch := list(itertools.islice(delete_objects, 1000)):
+            self._request("remove_objects")
+            # the names are read from the request body the real client builds, DeleteObject has no public name
+            delete = ElementTree.Element("Delete")
+            for delete_object in batch:
+                delete_object.toxml(delete)
+            for key in delete.iter("Key"):
+                self.objects.pop((bucket_name, key.text), None)
+        yield from ()
+
+    def presigned_get_object(self, bucket_name: str, object_name: str, **kwargs) -> str:
+        # signed locally by the real client, no request
+        self.signed += 1
+        return f"http://fake-minio/{bucket_name}/{object_name}?signature={self.signed}"
+
+
+class FakeRedis:
+    """
+    Stand-in of redis.Redis for the commands used by the service, expiry is not enforced.
+    `down` makes every command fail like an unreachable server.
+    """
+
+    def __init__(self):
+        self.values = {}  # type: dict[str, bytes]
+        self.expires = {}  # type: dict[str, int]
+        self.streams = {}  # type: dict[str, list[tuple[bytes, dict[bytes, bytes]]]]
+        # (stream, group) -> last delivered id and pending entries: id -> [consumer, delivery time, deliveries]
+        self.groups = {}  # type: dict[tuple[str, str], dict]
+        self.round_trips = 0
+        self.down = False
+        self._last_id = 0
+
+    def _request(self) -> None:
+        if self.down:
+            raise redis.ConnectionError("fake redis is down")
+        self.round_trips += 1
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    def xadd(self, name: str, fields: dict, maxlen: int | None = None, approximate: bool = True) -> bytes:
+        self._request()
+        self._last_id += 1
+        id = f"{self._last_id}-0".encode()
+        stream = self.streams.setdefault(name, [])
+        stream.append((id, {self._encode(key): self._encode(value) for key, value in fields.items()}))
+        if maxlen is not None:
+            del stream[:-maxlen]
+        return id
+
+    @staticmethod
+    def _sequence(id) -> int:
+        return int(FakeRedis._encode(id).split(b"-")[0])
+
+    def xgroup_create(self, name: str, groupname: str, id: str = "$", mkstream: bool = False) -> None:
+        self._request()
+        if (name, groupname) in self.groups:
+            raise redis.ResponseError("BUSYGROUP Consumer Group name already exists")
+        stream = self.streams.setdefault(name, []) if mkstream else self.streams[name]
+        last_id = stream[-1][0] if id == "$" and stream else self._encode(id)
+        self.groups[(name, groupname)] = {"last_id": last_id, "pending": {}}
+
+    def xreadgroup(self, groupname: str, consumername: str, streams: dict, count: int | None = None, block: int | None = None):
+        self._request()
+        result = []
+        for name in streams:
+            group = self.groups[(name, groupname)]
+            new = [(id, fields) for id, fields in self.streams[name] if self._sequence(id) > self._sequence(group["last_id"])]
+            new = new[:count]
+            for id, _ in new:
+                group["pending"][id] = [consumername, time.monotonic(), 1]
+            if new:
+                group["last_id"] = new[-1][0]
+                result.append([name.encode(), new])
+        if not result and block:
+            time.sleep(min(block / 1000, 0.01))
+        return result
+
+    def xack(self, name: str, groupname: str, *ids) -> int:
+        self._request()
+        pending = self.groups[(name, groupname)]["pending"]
+        return sum(pending.pop(self._encode(id), None) is not None for id in ids)
+
+    def xautoclaim(self, name: str, groupname: str, consumername: str, min_idle_time: int, start_id="0-0", count=None):
+        self._request()
+        pending = self.groups[(name, groupname)]["pending"]
+        fields = dict(self.streams[name])
+        now = time.monotonic()
+        claimed = []
+        for id in sorted(pending, key=self._sequence):
+            if self._sequence(id) < self._sequence(start_id) or (now - pending[id][1]) * 1000 < min_idle_time:
+                continue
+            if count is not None and len(claimed) == count:
+                return [id, claimed, []]
+            pending[id] = [consumername, now, pending[id][2] + 1]
+            claimed.append((id, fields.get(id, {})))
+        return [b"0-0", claimed, []]
+
+    def xpending_range(self, name: str, groupname: str, min, max, count: int, consumername: str | None = None) -> list[dict]:
+        self._request()
+        pending = self.groups[(name, groupname)]["pending"]
+        now = time.monotonic()
+        return [
+            {
+                "message_id": id,
+                "consumer": consumer.encode(),
+                "time_since_delivered": int((now - delivered) * 1000),
+                "times_delivered": deliveries,
+            }
+            for id, (consumer, delivered, deliveries) in sorted(pending.items(), key=lambda item: self._sequence(item[0]))
+            if self._sequence(min) <= self._sequence(id) <= self._sequence(max) and consumername in (None, consumer)
+        ][:count]
+
+    def exists(self, *names: str) -> int:
+        self._request()
+        return sum(name in self.values for name in names)
+
+    def get(self, name: str) -> bytes | None:
+        self._request()
+        return self.values.get(name)
+
+    def set(self, name: str, value: bytes, ex: int | None = None, nx: bool = False) -> bool | None:
+        self._request()
+        if nx and name in self.values:
+            return None
+        self.values[name] = value
+        if ex is not None:
+            self.expires[name] = ex
+        return True
+
+    def delete(self, *names: str) -> int:
+        self._request()
+        return sum(self.values.pop(name, None) is not None for name in names)
+
+
+class FakePipeline:
+    """
+    Stand-in of redis.client.Pipeline, the commands are sent in one round trip on execute.
+    """
+
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.commands = []  # type: list[tuple[str, tuple, dict]]
+
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self) -> list:
+        self.client._request()
+        round_trips = self.client.round_trips
+        results = [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.client.round_trips = round_trips
+        self.commands = []
+        return results
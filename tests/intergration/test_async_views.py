@@ -0,0 +1,58 @@
+import asyncio
+import time
+import uuid
+
+import pytest
+import sqlalchemy as sa
+
+from src.app import async_views
+from src.app.domain import commands
+from src.app.entrypoints import schema
+from tests.confest import async_bus  # noqa: F811, F401
+from tests.confest import bus  # noqa: F811, F401
+from tests.confest import sql_session_factory  # noqa: F811, F401
+
+
+async def create_post(async_bus):
+    title = str(uuid.uuid4())
+    await async_bus.handle_async(commands.CreatePostCommand(title=title, content="test content", author_id="test_author_id"))
+    return (await async_views.find_post(title, async_bus.uow))[0]
+
+
+@pytest.mark.asyncio
+async def test_async_commands_and_views(async_bus):
+    post = await create_post(async_bus)
+
+    await async_bus.handle_async(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id"))
+    await async_bus.handle_async(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content="test comment"))
+
+    assert (await async_views.get_post(post["id"], async_bus.uow))["like_count"] == 1
+    comments = (await async_views.get_comments(post["id"], async_bus.uow))["items"]
+    assert [comment["content"] for comment in comments] == ["test comment"]
+    assert (await async_views.get_comment(comments[0]["id"], async_bus.uow))["post_id"] == post["id"]
+    posts = await async_views.get_posts(schema.GetPostsRequest(None, None, "test_author_id", ["-created_time"], 10, 0), async_bus.uow)
+    assert post["id"] in [item["id"] for item in posts["items"]]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_async_reads_share_one_load(async_bus):
+    post = await create_post(async_bus)
+    before = async_bus.uow.loads.stats().get("get_post", {"loads": 0, "coalesced": 0})
+
+    posts = await asyncio.gather(*[async_views.get_post(post["id"], async_bus.uow) for _ in range(20)])
+
+    assert all(result["id"] == post["id"] for result in posts)
+    assert async_bus.uow.loads.stats()["get_post"] == {"loads": before["loads"] + 1, "coalesced": before["coalesced"] + 19}
+
+
+@pytest.mark.asyncio
+async def test_waiting_on_postgres_does_not_block_the_event_loop(async_bus):
+    def sleep():
+        with async_bus.uow.unit_of_work() as uow_ctx:
+            uow_ctx.session.execute(sa.text("SELECT pg_sleep(0.2)"))
+
+    await async_bus.uow.run_sync(sleep)
+    start = time.perf_counter()
+    await asyncio.gather(*[async_bus.uow.run_sync(sleep) for _ in range(5)])
+
+    assert time.perf_counter() - start < 0.6
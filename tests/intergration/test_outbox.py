@@ -0,0 +1,119 @@
+import json
+import uuid
+
+import pytest
+import sqlalchemy as sa
+
+from src.app import views
+from src.app.adapters import orm
+from src.app.adapters import repository
+from src.app.config import settings
+from src.app.domain import commands
+from src.app.domain import events
+from src.app.entrypoints import outbox_relay
+from src.app.entrypoints import redis_event_consumer
+from tests.confest import bus  # noqa: F811, F401
+from tests.confest import sql_session_factory  # noqa: F811, F401
+from tests.fakes import FakeRedis
+
+
+def outbox_rows(sql_session_factory, post_id):
+    # the outbox is shared with the tests running meanwhile, only the events of the post are the test's
+    with sql_session_factory() as session:
+        rows = session.execute(sa.select(orm.outbox.c.id, orm.outbox.c.type, orm.outbox.c.payload).order_by(orm.outbox.c.id)).all()
+    return [row for row in rows if json.loads(row.payload).get("post_id") == post_id]
+
+
+def outbox_events(sql_session_factory, post_id):
+    return [row.type for row in outbox_rows(sql_session_factory, post_id)]
+
+
+def published(client, ids):
+    return [fields for _, fields in client.streams.get(settings.EVENT_STREAM, []) if int(fields[b"id"]) in ids]
+
+
+@pytest.fixture
+def relay_lock(sql_session_factory):
+    """
+    One relaying test at a time, across the test processes: a relay publishes the events of every test.
+    """
+    with sql_session_factory.kw["bind"].connect() as connection:
+        connection.execute(sa.text("SELECT pg_advisory_lock(hashtext('tests.outbox_relay'))"))
+        yield
+        connection.execute(sa.text("SELECT pg_advisory_unlock(hashtext('tests.outbox_relay'))"))
+        connection.commit()
+
+
+def create_post(bus):
+    title = str(uuid.uuid4())
+    bus.handle(commands.CreatePostCommand(title=title, content="test content", author_id="test_author_id"))
+    return views.find_post(title, bus.uow)[0]
+
+
+def test_events_are_written_with_the_changes(bus, sql_session_factory):
+    post = create_post(bus)
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id"))
+    bus.handle(commands.EditPostCommand(user_id="someone_else", post_id=post["id"], title="denied", content="denied"))
+
+    # a denied edit commits nothing, so raises no event to publish
+    assert outbox_events(sql_session_factory, post["id"]) == ["CreatedPostEvent", "LikedPostEvent"]
+
+
+def test_relay_publishes_batches_in_one_round_trip(bus, sql_session_factory, relay_lock):
+    post = create_post(bus)
+    for i in range(3):
+        bus.handle(commands.LikePostCommand(post_id=post["id"], user_id=f"test_user_id_{i}"))
+    ids = {row.id for row in outbox_rows(sql_session_factory, post["id"])}
+    client = FakeRedis()
+
+    batches = 0
+    while outbox_relay.relay(sql_session_factory, client, batch_size=100):
+        batches += 1
+
+    assert client.round_trips == batches
+    stream = published(client, ids)
+    assert [fields[b"type"] for fields in stream] == [b"CreatedPostEvent"] + [b"LikedPostEvent"] * 3
+    assert json.loads(stream[0][b"payload"]) == {"post_id": post["id"]}
+    assert outbox_events(sql_session_factory, post["id"]) == []
+
+
+def test_events_stay_in_the_outbox_until_published(bus, sql_session_factory, relay_lock):
+    post = create_post(bus)
+    client = FakeRedis()
+    client.down = True
+
+    with pytest.raises(Exception):
+        outbox_relay.relay(sql_session_factory, client, batch_size=100)
+    assert outbox_events(sql_session_factory, post["id"]) == ["CreatedPostEvent"]
+
+    ids = {row.id for row in outbox_rows(sql_session_factory, post["id"])}
+    client.down = False
+    while outbox_relay.relay(sql_session_factory, client, batch_size=100):
+        pass
+    assert outbox_events(sql_session_factory, post["id"]) == []
+    assert [fields[b"type"] for fields in published(client, ids)] == [b"CreatedPostEvent"]
+
+
+def test_relayed_events_are_consumed_by_the_bus(bus, sql_session_factory, relay_lock):
+    client = FakeRedis()
+    consumer = redis_event_consumer.StreamConsumer(
+        client, bus, settings.EVENT_STREAM, "test_group", "test_consumer", batch_size=100, workers=4, block_ms=10, claim_idle_ms=60000
+    )
+    consumer.ensure_group()
+    post = create_post(bus)
+    views.get_post(post["id"], bus.uow)
+
+    # edited by another worker, its event reaches the consumer of this process through the outbox and the stream
+    with sql_session_factory() as session:
+        session.execute(sa.update(orm.posts).where(orm.posts.c.id == post["id"]).values(title="edited elsewhere", version=2))
+        repository.SqlAlchemyOutboxRepository(session).add([events.EditedPostEvent(post_id=post["id"], version=2)])
+        session.commit()
+    assert views.get_post(post["id"], bus.uow)["title"] == post["title"]
+
+    while outbox_relay.relay(sql_session_factory, client, batch_size=100):
+        pass
+    while consumer.poll():
+        pass
+
+    assert views.get_post(post["id"], bus.uow)["title"] == "edited elsewhere"
+    assert client.groups[(settings.EVENT_STREAM, "test_group")]["pending"] == {}
@@ -0,0 +1,135 @@
+import datetime
+import uuid
+
+import pytest
+import sqlalchemy as sa
+
+from src.app import views
+from src.app.adapters import orm
+from src.app.entrypoints import schema
+from tests.confest import bus  # noqa: F811, F401
+from tests.confest import recorded_statements
+from tests.confest import sql_session_factory  # noqa: F811, F401
+
+SEED_ROWS = 5000
+SEQ_SCAN_ROW_THRESHOLD = 1000
+
+
+@pytest.fixture(scope="module")
+def seeded(sql_session_factory):
+    """
+    Fill every table with enough rows for the planner to prefer indexes, the ids of the last rows are returned.
+    The rows are deleted after the tests of the module.
+    """
+    now = datetime.datetime.now()
+    post_ids = [str(uuid.uuid4()) for _ in range(SEED_ROWS)]
+    comment_ids = [str(uuid.uuid4()) for _ in range(SEED_ROWS)]
+    author_ids = [f"seed_author_{i % 100}" for i in range(SEED_ROWS)]
+
+    with sql_session_factory() as session:
+        session.execute(
+            sa.insert(orm.posts),
+            [
+                dict(
+                    id=post_id,
+                    title=f"seed title {i}",
+                    author_id=author_id,
+                    content="seed content",
+                    like_count=0,
+                    version=1,
+                    created_time=now - datetime.timedelta(seconds=i),
+                    updated_time=now,
+                )
+                for i, (post_id, author_id) in enumerate(zip(post_ids, author_ids))
+            ],
+        )
+        session.execute(
+            sa.insert(orm.comments),
+            [
+                dict(
+                    id=comment_id,
+                    content="seed comment",
+                    author_id="seed_author",
+                    level=1 if i % 2 else 0,
+                    post_id=post_ids[i // 10],
+                    comment_id=comment_ids[i - 1] if i % 2 else None,
+                    like_count=0,
+                    version=1,
+                    created_time=now - datetime.timedelta(seconds=i),
+                    updated_time=now,
+                )
+                for i, comment_id in enumerate(comment_ids)
+            ],
+        )
+        session.execute(
+            sa.insert(orm.images),
+            [dict(id=str(uuid.uuid4()), path=f"posts/{post_id}/seed.png", post_id=post_id, created_time=now) for post_id in post_ids],
+        )
+        session.execute(
+            sa.insert(orm.likes),
+            [
+                dict(id=str(uuid.uuid4()), user_id=f"seed_user_{i}", post_id=post_id, comment_id=None, created_time=now)
+                for i, post_id in enumerate(post_ids)
+            ],
+        )
+        session.commit()
+
+    # as autovacuum would, also merges the pending list of the GIN index
+    with sql_session_factory.kw["bind"].connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in orm.metadata.sorted_tables:
+            conn.execute(sa.text(f"VACUUM ANALYZE {table.name}"))
+
+    yield {"post_id": post_ids[-1], "comment_id": comment_ids[-2], "author_id": author_ids[-1]}
+
+    with sql_session_factory() as session:
+        session.execute(sa.delete(orm.likes).where(orm.likes.c.post_id.in_(post_ids)))
+        session.execute(sa.delete(orm.images).where(orm.images.c.post_id.in_(post_ids)))
+        session.execute(sa.delete(orm.comments).where(orm.comments.c.id.in_(comment_ids)))
+        session.execute(sa.delete(orm.posts).where(orm.posts.c.id.in_(post_ids)))
+        session.commit()
+
+
+def seq_scans(plan: dict) -> list[str]:
+    scans = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        scans.extend(seq_scans(child))
+    return scans
+
+
+@pytest.mark.parametrize(
+    "view",
+    [
+        lambda ids, uow: views.get_post(ids["post_id"], uow),
+        lambda ids, uow: views.get_comment(ids["comment_id"], uow),
+        lambda ids, uow: views.get_comments(ids["post_id"], uow, limit=20),
+        lambda ids, uow: views.get_reply_comments(ids["comment_id"], uow, limit=20),
+        lambda ids, uow: views.get_comment_thread(ids["post_id"], uow, limit=20),
+        lambda ids, uow: views.find_post("seed title 1", uow),
+        lambda ids, uow: views.get_posts(schema.GetPostsRequest(None, None, None, ["-created_time"], 10, 0), uow),
+        lambda ids, uow: views.get_posts(schema.GetPostsRequest(None, None, ids["author_id"], ["-created_time"], 10, 0), uow),
+        lambda ids, uow: views.get_posts(schema.GetPostsRequest(None, None, None, ["-created_time"], 10, 0, q="4999"), uow),
+    ],
+    ids=[
+        "get_post",
+        "get_comment",
+        "get_comments",
+        "get_reply_comments",
+        "get_comment_thread",
+        "find_post",
+        "get_posts",
+        "get_posts_by_author",
+        "get_posts_search",
+    ],
+)
+def test_view_queries_do_not_scan_large_tables(bus, sql_session_factory, seeded, view):
+    engine = sql_session_factory.kw["bind"]
+    with recorded_statements(engine) as statements:
+        view(seeded, bus.uow)
+
+    assert statements
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()[0]["Plan"]
+            for table in seq_scans(plan):
+                rows = conn.execute(sa.text("SELECT reltuples FROM pg_class WHERE relname = :table"), {"table": table}).scalar()
+                assert rows <= SEQ_SCAN_ROW_THRESHOLD, f"Seq Scan on {table} ({rows:.0f} rows) in {statement}"
@@ -0,0 +1,29 @@
+import sqlalchemy as sa
+
+from src.app import views
+from src.app.adapters import orm
+from src.app.domain import commands
+from src.app.entrypoints import reconcile_counts
+from tests.confest import bus  # noqa: F811, F401
+from tests.confest import sql_session_factory  # noqa: F811, F401
+
+
+def test_reconcile_counts(bus, sql_session_factory):
+    bus.handle(commands.CreatePostCommand(title="test reconcile title", content="test content", author_id="test_author_id"))
+    post_id = views.find_post("test reconcile title", bus.uow)[0]["id"]
+    bus.handle(commands.CommentPostCommand(post_id=post_id, user_id="test_user_id", content="comment"))
+    comment_id = views.get_comments(post_id, bus.uow)["items"][0]["id"]
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment_id, user_id="test_user_id", content="reply"))
+
+    with sql_session_factory() as session:
+        session.execute(sa.update(orm.posts).where(orm.posts.c.id == post_id).values(comment_count=7))
+        session.execute(sa.update(orm.comments).where(orm.comments.c.id == comment_id).values(reply_count=0))
+        session.commit()
+
+    assert reconcile_counts.reconcile(sql_session_factory, "posts", batch_size=100) >= 1
+    assert reconcile_counts.reconcile(sql_session_factory, "comments", batch_size=100) >= 1
+    assert reconcile_counts.reconcile(sql_session_factory, "posts", batch_size=100) == 0
+
+    with sql_session_factory() as session:
+        assert session.execute(sa.select(orm.posts.c.comment_count).where(orm.posts.c.id == post_id)).scalar() == 2
+        assert session.execute(sa.select(orm.comments.c.reply_count).where(orm.comments.c.id == comment_id)).scalar() == 1
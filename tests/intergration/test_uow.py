@@ -1,3 +1,185 @@
+import collections
+import concurrent.futures
+import threading
+import uuid
+
 import pytest
+from sqlalchemy import orm
+from sqlalchemy.orm.exc import StaleDataError
+
+from src.app import bootstrap
+from src.app import views
+from src.app.domain import commands
+from src.app.domain import events
+from src.app.domain import model
+from src.app.service_layer import handlers
+from src.app.service_layer import messagebus
+from src.app.service_layer import unit_of_work
+from tests.confest import bus  # noqa: F811, F401
+from tests.confest import sql_session_factory  # noqa: F811, F401
+
+
+def test_concurrent_units_of_work_do_not_share_sessions(bus):
+    barrier = threading.Barrier(2)
+
+    def open_unit_of_work():
+        with bus.uow.unit_of_work() as uow_ctx:
+            # both units of work are open at the same time
+            barrier.wait(timeout=5)
+            return uow_ctx, uow_ctx.session
+
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        (ctx_1, session_1), (ctx_2, session_2) = pool.map(lambda _: open_unit_of_work(), range(2))
+
+    assert ctx_1 is not ctx_2
+    assert session_1 is not session_2
+    assert ctx_1 is not bus.uow
+
+
+def test_with_statement_opens_a_unit_of_work_of_its_own(bus):
+    title = str(uuid.uuid4())
+
+    with bus.uow as uow_ctx, bus.uow as other_uow_ctx:
+        assert uow_ctx is not bus.uow
+        assert uow_ctx.session is not other_uow_ctx.session
+        post = model.Post.create(title=title, content="test content", author_id="test_author_id")
+        post_id = post.id
+        uow_ctx.posts.add(post)
+        uow_ctx.commit()
+
+    assert not hasattr(bus.uow, "session")
+    assert views.find_post(title, bus.uow)[0]["id"] == post_id
+
+
+def test_concurrent_commands(bus):
+    titles = [str(uuid.uuid4()) for _ in range(20)]
+
+    def create_and_like(title):
+        bus.handle(commands.CreatePostCommand(title=title, content="test content", author_id="test_author_id"))
+        post = views.find_post(title, bus.uow)[0]
+        bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id"))
+        return views.get_post(post["id"], bus.uow)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        posts = list(pool.map(create_and_like, titles))
+
+    assert [post["title"] for post in posts] == titles
+    assert all(post["like_count"] == 1 for post in posts)
+
+
+def test_events_of_every_repository_are_collected(bus):
+    title = str(uuid.uuid4())
+    bus.handle(commands.CreatePostCommand(title=title, content="test content", author_id="test_author_id"))
+    post_id = views.find_post(title, bus.uow)[0]["id"]
+    bus.handle(commands.CommentPostCommand(post_id=post_id, user_id="test_user_id", content="test comment"))
+    comment_id = views.get_comments(post_id, bus.uow)["items"][0]["id"]
+
+    with bus.uow.unit_of_work() as uow_ctx:
+        post = uow_ctx.posts.get(post_id)
+        comment = uow_ctx.comments.get(comment_id)
+        image = post.add_image("posts/test_image.png")
+        uow_ctx.images.add(image)
+        post.events.append(events.EditedPostEvent(post_id=post_id, version=1))
+        comment.events.append(events.LikedCommentEvent(comment_id=comment_id, user_id="test_user_id"))
+        image.events.append(events.AttachedImageEvent(post_id=post_id))
+
+    assert sorted(type(event).__name__ for event in bus.uow.collect_new_events()) == [
+        "AttachedImageEvent",
+        "EditedPostEvent",
+        "LikedCommentEvent",
+    ]
+
+
+def create_post(bus) -> str:
+    title = str(uuid.uuid4())
+    bus.handle(commands.CreatePostCommand(title=title, content="test content", author_id="test_author_id"))
+    return views.find_post(title, bus.uow)[0]["id"]
+
+
+def test_edit_of_a_stale_post_is_a_conflict(bus):
+    post_id = create_post(bus)
+
+    with bus.uow.unit_of_work() as uow_ctx:
+        post = uow_ctx.posts.get(post_id)
+        bus.handle(commands.EditPostCommand(user_id="test_author_id", post_id=post_id, title="concurrent", content="concurrent"))
+        post.edit(new_title="stale", new_content="stale")
+        with pytest.raises(StaleDataError) as error:
+            uow_ctx.commit()
+
+    assert bus.uow.is_conflict(error.value)
+    with bus.uow.unit_of_work() as uow_ctx:
+        assert uow_ctx.posts.get(post_id).title == "concurrent"
+
+
+def edit_post_under_concurrent_edits(bus, conflicts: int):
+    """
+    A handler editing the post after a concurrent edit, on its first `conflicts` runs.
+    """
+    runs = []
+
+    def edit_post(cmd: commands.EditPostCommand):
+        with bus.uow.unit_of_work() as uow_ctx:
+            post = uow_ctx.posts.get(cmd.post_id)
+            if len(runs) < conflicts:
+                bus.handle(commands.EditPostCommand(user_id=cmd.user_id, post_id=cmd.post_id, title="concurrent", content="concurrent"))
+            runs.append(cmd)
+            post.edit(new_title=cmd.title, new_content=cmd.content)
+            uow_ctx.commit()
+
+    return edit_post
+
+
+def test_conflicting_command_is_retried(bus):
+    post_id = create_post(bus)
+    retrying_bus = messagebus.MessageBus(
+        uow=bus.uow,
+        event_handlers=bus.event_handlers,
+        command_handlers={commands.EditPostCommand: edit_post_under_concurrent_edits(bus, conflicts=2)},
+        max_retries=2,
+        retry_base_delay=0,
+    )
+
+    retrying_bus.handle(commands.EditPostCommand(user_id="test_author_id", post_id=post_id, title="retried", content="retried"))
+
+    with bus.uow.unit_of_work() as uow_ctx:
+        post = uow_ctx.posts.get(post_id)
+        assert (post.title, post.version) == ("retried", 4)
+    assert retrying_bus.retry_stats() == {"EditPostCommand": {"retries": 2, "exhausted": 0}}
+
+
+def test_command_conflicting_after_every_retry(bus):
+    post_id = create_post(bus)
+    retrying_bus = messagebus.MessageBus(
+        uow=bus.uow,
+        event_handlers=bus.event_handlers,
+        command_handlers={commands.EditPostCommand: edit_post_under_concurrent_edits(bus, conflicts=2)},
+        max_retries=1,
+        retry_base_delay=0,
+    )
+
+    with pytest.raises(messagebus.CommandConflict):
+        retrying_bus.handle(commands.EditPostCommand(user_id="test_author_id", post_id=post_id, title="retried", content="retried"))
+
+    assert retrying_bus.retry_stats() == {"EditPostCommand": {"retries": 1, "exhausted": 1}}
+
+
+def test_concurrent_comments_do_not_conflict_at_repeatable_read(bus, sql_session_factory):
+    post_id = create_post(bus)
+    engine = sql_session_factory.kw["bind"].execution_options(isolation_level="REPEATABLE READ")
+    uow = unit_of_work.SqlAlchemyUnitOfWork(orm.sessionmaker(bind=engine))
+    # without retries, a conflict would fail its command
+    strict_bus = messagebus.MessageBus(
+        uow=uow,
+        event_handlers=collections.defaultdict(list),
+        command_handlers={commands.CommentPostCommand: bootstrap.inject_dependencies(handlers.comment_post, {"uow": uow})},
+        max_retries=0,
+    )
+
+    def comment(i):
+        strict_bus.handle(commands.CommentPostCommand(post_id=post_id, user_id="test_user_id", content=f"comment {i}"))
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(comment, range(40)))
 
-pytestmark = pytest.mark.usefixtures("mappers")
+    with bus.uow.unit_of_work() as uow_ctx:
+        assert uow_ctx.posts.get(post_id).comment_count == 40
@@ -1,17 +1,26 @@
+import io
 import os
+import threading
+import time
 import uuid
 
 import pytest
+import sqlalchemy as sa
 from fastapi import UploadFile
 from icecream import ic
 from sqlalchemy.orm import clear_mappers
 
 from src.app import bootstrap
+from src.app import config
 from src.app import views
+from src.app.adapters import cache
+from src.app.adapters import counter_buffer
 from src.app.domain import commands
 from src.app.entrypoints import schema
+from src.app.service_layer import messagebus
 from src.app.service_layer import unit_of_work
 from tests.confest import bus  # noqa: F811, F401
+from tests.confest import count_statements
 from tests.confest import sql_session_factory  # noqa: F811, F401
 
 
@@ -90,6 +99,19 @@ def test_like_unlike_post(bus, post):
     assert post["like_count"] == 1
 
 
+def test_like_unlike_post_same_user_toggles(bus, post):
+    cmd = commands.LikePostCommand(post_id=post["id"], user_id="test_user_id_toggle")
+
+    bus.handle(cmd)
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+
+    bus.handle(cmd)
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 0
+
+    bus.handle(cmd)
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+
+
 def test_comment_post(bus, post):
     cmd = commands.CommentPostCommand(
         post_id=post["id"],
@@ -98,7 +120,7 @@ def test_comment_post(bus, post):
     )
 
     bus.handle(cmd)
-    comments = views.get_comments(post["id"], bus.uow)
+    comments = views.get_comments(post["id"], bus.uow)["items"]
 
     assert len(comments) == 1
     assert comments[0]["author_id"] == cmd.user_id
@@ -116,7 +138,7 @@ def comment(bus, post):
     )
 
     bus.handle(cmd)
-    comments = views.get_comments(post["id"], bus.uow)
+    comments = views.get_comments(post["id"], bus.uow)["items"]
 
     return comments[0]
 
@@ -128,7 +150,7 @@ def test_delete_comment(bus, comment):
     )
 
     bus.handle(cmd)
-    comments = views.get_comments(comment["post_id"], bus.uow)
+    comments = views.get_comments(comment["post_id"], bus.uow)["items"]
 
     assert len(comments) == 0
 
@@ -159,7 +181,7 @@ def test_reply_comment(bus, comment):
     )
 
     bus.handle(cmd)
-    comments = views.get_comments(comment["post_id"], bus.uow)
+    comments = views.get_comments(comment["post_id"], bus.uow)["items"]
 
     assert len(comments) == 2
     assert comments[1]["author_id"] == cmd.user_id
@@ -178,7 +200,7 @@ def test_comment_exceed_3_layers(bus, comment):
     )
 
     bus.handle(cmd_0)
-    comments_0 = views.get_reply_comments(comment["id"], bus.uow)
+    comments_0 = views.get_reply_comments(comment["id"], bus.uow)["items"]
     assert len(comments_0) == 1
     assert comments_0[0]["author_id"] == cmd_0.user_id
     assert comments_0[0]["content"] == cmd_0.content
@@ -194,7 +216,7 @@ def test_comment_exceed_3_layers(bus, comment):
     )
 
     bus.handle(cmd_1)
-    comments_1 = views.get_reply_comments(comments_0[0]["id"], bus.uow)
+    comments_1 = views.get_reply_comments(comments_0[0]["id"], bus.uow)["items"]
     assert len(comments_1) == 1
     assert comments_1[0]["author_id"] == cmd_1.user_id
     assert comments_1[0]["content"] == cmd_1.content
@@ -210,7 +232,7 @@ def test_comment_exceed_3_layers(bus, comment):
     )
 
     bus.handle(cmd_2)
-    comments_2 = views.get_reply_comments(comments_1[0]["id"], bus.uow)
+    comments_2 = views.get_reply_comments(comments_1[0]["id"], bus.uow)["items"]
     assert len(comments_2) == 1
     assert comments_2[0]["author_id"] == cmd_2.user_id
     assert comments_2[0]["content"] == cmd_2.content
@@ -240,7 +262,7 @@ def test_get_posts(bus):
         offset=0,
     )
 
-    posts = views.get_posts(params, bus.uow)
+    posts = views.get_posts(params, bus.uow)["items"]
 
     assert isinstance(posts, list)
     assert len(posts) == 0  # Assuming no posts exist with the given parameters
@@ -268,7 +290,7 @@ def test_get_posts(bus):
     params.limit = 10
     params.offset = 0
 
-    posts = views.get_posts(params, bus.uow)
+    posts = views.get_posts(params, bus.uow)["items"]
 
     assert isinstance(posts, list)
     assert len(posts) == 2
@@ -304,3 +326,457 @@ def test_attach_image(bus, post):
 
     assert len(post["images"]) == 1
     # assert post["images"][0]["path"] == f"posts/{post['id']}/test_image.png"
+
+
+def test_attach_multiple_images(bus, post):
+    file_path = "tests/assets/test_image.png"
+    images = [UploadFile(open(file_path, "rb"), filename=f"test_image_{i}.png", size=os.path.getsize(file_path)) for i in range(3)]
+
+    bus.handle(commands.AttachImageCommand(post_id=post["id"], user_id=post["author_id"], images=images))
+    post = views.get_post(post["id"], bus.uow)
+
+    paths = [image["path"] for image in post["images"]]
+    assert all(path.startswith(f"posts/{post['id']}/") for path in paths)
+    assert sorted(path.rsplit("/", 1)[1] for path in paths) == [f"test_image_{i}.png" for i in range(3)]
+    # unique object names, an image of the same file name does not replace another
+    assert len(set(paths)) == 3
+
+
+def test_failed_attach_deletes_only_its_uploads(bus, post, monkeypatch):
+    def attach():
+        image = UploadFile(io.BytesIO(b"image"), filename="image.png", size=5)
+        bus.handle(commands.AttachImageCommand(post_id=post["id"], user_id=post["author_id"], images=[image]))
+
+    def fail_commit(self):
+        raise RuntimeError("commit failed")
+
+    def fail_delete(path):
+        raise ConnectionError("minio is down")
+
+    attach()
+    [attached] = views.get_post(post["id"], bus.uow)["images"]
+
+    monkeypatch.setattr(unit_of_work.SqlAlchemyUnitOfWork, "_commit", fail_commit)
+    with pytest.raises(RuntimeError, match="commit failed"):
+        attach()
+    # the same file name, the committed image is left alone
+    objects = bus.uow.minio_client.list_objects("posts", prefix=f"posts/{post['id']}/", recursive=True)
+    assert [o.object_name for o in objects] == [attached["path"]]
+
+    monkeypatch.setattr(bus.uow.minio, "delete", fail_delete)
+    with pytest.raises(RuntimeError, match="commit failed"):
+        # the failed delete is logged, the caller gets the failure of the commit
+        attach()
+
+
+def test_get_posts_loads_images_in_one_query(bus, sql_session_factory):
+    uniq = str(uuid.uuid4())
+    file_path = "tests/assets/test_image.png"
+    for i in range(3):
+        bus.handle(commands.CreatePostCommand(title=f"{uniq} {i}", content="test_content", author_id=uniq))
+    for post in views.get_posts(schema.GetPostsRequest(None, None, uniq, ["-created_time"], 10, 0), bus.uow)["items"]:
+        image = UploadFile(open(file_path, "rb"), filename="test_image.png", size=os.path.getsize(file_path))
+        bus.handle(commands.AttachImageCommand(post_id=post["id"], user_id=uniq, images=[image]))
+
+    (posts, found), statements = count_statements(
+        sql_session_factory.kw["bind"],
+        lambda: (
+            views.get_posts(schema.GetPostsRequest(None, None, uniq, ["-created_time"], 10, 0), bus.uow)["items"],
+            views.find_post(f"{uniq} 0", bus.uow),
+        ),
+    )
+
+    assert len(posts) == 3
+    assert all(len(post["images"]) == 1 for post in posts)
+    assert len(found[0]["images"]) == 1
+    # posts + images for each view
+    assert statements == 4
+
+
+@pytest.mark.parametrize("order", [["-created_time"], ["+title"], ["-like_count", "+created_time"]])
+def test_get_posts_cursor_pagination(bus, order):
+    uniq = str(uuid.uuid4())
+    for i in range(5):
+        bus.handle(commands.CreatePostCommand(title=f"{uniq} {i}", content="test_content", author_id=uniq))
+    all_posts = views.get_posts(schema.GetPostsRequest(None, None, uniq, order, 10, 0), bus.uow)
+    assert all_posts["next_cursor"] is None
+
+    pages = []
+    params = schema.GetPostsRequest(None, None, uniq, order, 2, 0)
+    while True:
+        page = views.get_posts(params, bus.uow)
+        pages.append(page["items"])
+        if page["next_cursor"] is None:
+            break
+        params.cursor = page["next_cursor"]
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [post["id"] for page in pages for post in page] == [post["id"] for post in all_posts["items"]]
+
+
+def test_get_comments_cursor_pagination(bus, post):
+    for i in range(3):
+        bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content=f"test comment {i}"))
+
+    first = views.get_comments(post["id"], bus.uow, limit=2)
+    second = views.get_comments(post["id"], bus.uow, limit=2, cursor=first["next_cursor"])
+
+    assert [comment["content"] for comment in first["items"]] == ["test comment 0", "test comment 1"]
+    assert [comment["content"] for comment in second["items"]] == ["test comment 2"]
+    assert second["next_cursor"] is None
+
+
+def test_get_posts_cursor_of_another_order(bus):
+    uniq = str(uuid.uuid4())
+    for i in range(2):
+        bus.handle(commands.CreatePostCommand(title=f"{uniq} {i}", content="test_content", author_id=uniq))
+    page = views.get_posts(schema.GetPostsRequest(None, None, uniq, ["-created_time"], 1, 0), bus.uow)
+
+    with pytest.raises(views.InvalidCursor):
+        views.get_posts(schema.GetPostsRequest(None, None, uniq, ["+title"], 1, 0, page["next_cursor"]), bus.uow)
+
+
+def test_get_posts_full_text_search(bus):
+    word = uuid.uuid4().hex
+    bus.handle(commands.CreatePostCommand(title="in the content", content=f"about {word}", author_id="test_search_author_id"))
+    bus.handle(commands.CreatePostCommand(title=f"about {word}", content="in the title", author_id="test_search_author_id"))
+    bus.handle(commands.CreatePostCommand(title="unrelated", content="unrelated", author_id="test_search_author_id"))
+
+    first = views.get_posts(schema.GetPostsRequest(None, None, None, ["-created_time"], 1, 0, q=word), bus.uow)
+    second = views.get_posts(schema.GetPostsRequest(None, None, None, ["-created_time"], 1, 0, first["next_cursor"], q=word), bus.uow)
+
+    assert [post["title"] for post in first["items"]] == [f"about {word}"]
+    assert [post["title"] for post in second["items"]] == ["in the content"]
+    assert second["next_cursor"] is None
+
+
+def test_get_posts_full_text_search_follows_edit(bus, post):
+    word = uuid.uuid4().hex
+    cmd = commands.EditPostCommand(user_id=post["author_id"], post_id=post["id"], title=f"edited {word}", content="new content")
+
+    bus.handle(cmd)
+    posts = views.get_posts(schema.GetPostsRequest(None, None, None, ["-created_time"], 10, 0, q=word), bus.uow)["items"]
+
+    assert [p["id"] for p in posts] == [post["id"]]
+
+
+def test_get_post_is_cached_until_changed(bus, sql_session_factory, post):
+    engine = sql_session_factory.kw["bind"]
+    views.get_post(post["id"], bus.uow)
+
+    cached, statements = count_statements(engine, lambda: views.get_post(post["id"], bus.uow))
+    assert statements == 0
+    assert cached["title"] == post["title"]
+
+    bus.handle(commands.EditPostCommand(user_id=post["author_id"], post_id=post["id"], title="edited", content="edited"))
+    assert views.get_post(post["id"], bus.uow)["title"] == "edited"
+
+    file_path = "tests/assets/test_image.png"
+    image = UploadFile(open(file_path, "rb"), filename="test_image.png", size=os.path.getsize(file_path))
+    bus.handle(commands.AttachImageCommand(post_id=post["id"], user_id=post["author_id"], images=[image]))
+    assert len(views.get_post(post["id"], bus.uow)["images"]) == 1
+
+
+def test_load_racing_an_invalidation_is_not_cached(bus, post):
+    views.invalidate_post(post["id"], bus.uow)
+
+    def load_then_edit():
+        loaded = views._load_post(post["id"], bus.uow)
+        # edited, and the post invalidated, while the load is in flight
+        bus.handle(commands.EditPostCommand(user_id=post["author_id"], post_id=post["id"], title="edited", content="edited"))
+        return loaded
+
+    _, stale = views._cached(f"post:{post['id']}", load_then_edit, bus.uow)
+
+    assert stale["title"] == post["title"]
+    assert views.get_post(post["id"], bus.uow)["title"] == "edited"
+
+
+def test_get_comments_is_cached_until_changed(bus, sql_session_factory, comment):
+    engine = sql_session_factory.kw["bind"]
+    views.get_comments(comment["post_id"], bus.uow)
+    views.get_comment(comment["id"], bus.uow)
+
+    (page, _), statements = count_statements(
+        engine, lambda: (views.get_comments(comment["post_id"], bus.uow), views.get_comment(comment["id"], bus.uow))
+    )
+    assert statements == 0
+    assert [item["id"] for item in page["items"]] == [comment["id"]]
+
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment["id"], user_id="test_reply_user_id", content="reply"))
+    assert len(views.get_comments(comment["post_id"], bus.uow)["items"]) == 2
+
+    bus.handle(commands.DeleteCommentCommand(user_id=comment["author_id"], comment_id=comment["id"]))
+    assert comment["id"] not in [item["id"] for item in views.get_comments(comment["post_id"], bus.uow)["items"]]
+
+
+def test_cached_like_count_follows_counter_flush(bus, post):
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id_like"))
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+
+    deadline = time.monotonic() + 5
+    while bus.uow.counters.pending("posts", post["id"]) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    assert bus.uow.counters.pending("posts", post["id"]) == 0
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+
+
+def test_read_during_a_counter_flush_does_not_wait_for_it(bus, post, monkeypatch):
+    monkeypatch.setattr(bus.uow, "counters", counter_buffer.CounterBuffer())
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id_like"))
+    applying, release = threading.Event(), threading.Event()
+
+    def apply(ids):
+        applying.set()
+        release.wait()
+        return bus.uow.flush_counters(ids)
+
+    flush = threading.Thread(target=bus.uow.counters.flush, args=(apply,))
+    flush.start()
+    try:
+        applying.wait()
+        # the like_count is read with its deltas from the database while the flush is applied
+        assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+        page = views.get_posts(schema.GetPostsRequest(post["title"], None, None, ["-created_time"], 10, 0), bus.uow)
+        assert [item["like_count"] for item in page["items"]] == [1]
+    finally:
+        release.set()
+        flush.join()
+
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+    assert stored_like_count(bus, post["id"]) == 1
+
+
+def add_like_count_delta(bus, post_id: str, delta: int) -> int:
+    # committed like a like does, without buffering it in this process
+    with bus.uow.unit_of_work() as uow_ctx:
+        delta_id = uow_ctx.likes.add_like_count_delta("posts", post_id, delta)
+        uow_ctx.commit()
+    return delta_id
+
+
+def stored_like_count(bus, post_id: str) -> int:
+    with bus.uow.unit_of_work() as uow_ctx:
+        return uow_ctx.posts.get(post_id).like_count
+
+
+def test_like_count_delta_is_applied_once(bus, post):
+    delta_id = add_like_count_delta(bus, post["id"], 1)
+
+    assert list(bus.uow.flush_counters([delta_id])) == [("posts", post["id"])]
+    # a flush retried after its commit finds nothing left to apply
+    assert list(bus.uow.flush_counters([delta_id])) == []
+    assert stored_like_count(bus, post["id"]) == 1
+
+
+def test_like_count_delta_of_a_lost_buffer_is_applied(bus, post, monkeypatch):
+    add_like_count_delta(bus, post["id"], 1)
+    assert stored_like_count(bus, post["id"]) == 0
+
+    monkeypatch.setattr(config.settings, "LIKE_COUNTER_ORPHAN_AGE", 0.0)
+    bus.uow.flush_counters([])
+
+    assert stored_like_count(bus, post["id"]) == 1
+
+
+def test_get_comment_thread(bus, sql_session_factory, post):
+    for i in range(3):
+        bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content=f"comment {i}"))
+    first, second, _ = [comment["id"] for comment in views.get_comments(post["id"], bus.uow)["items"]]
+    bus.handle(commands.ReplyCommentCommand(comment_id=first, user_id="test_user_id", content="reply 0"))
+    bus.handle(commands.ReplyCommentCommand(comment_id=second, user_id="test_user_id", content="reply 1"))
+    reply = views.get_reply_comments(first, bus.uow)["items"][0]["id"]
+    bus.handle(commands.ReplyCommentCommand(comment_id=reply, user_id="test_user_id", content="reply 0 0"))
+
+    page, statements = count_statements(sql_session_factory.kw["bind"], lambda: views.get_comment_thread(post["id"], bus.uow, limit=2))
+
+    assert statements == 1
+    assert [comment["content"] for comment in page["items"]] == ["comment 0", "comment 1"]
+    assert [reply["content"] for reply in page["items"][0]["replies"]] == ["reply 0"]
+    assert [reply["content"] for reply in page["items"][0]["replies"][0]["replies"]] == ["reply 0 0"]
+    assert page["items"][0]["replies"][0]["replies"][0]["replies"] == []
+    assert [reply["content"] for reply in page["items"][1]["replies"]] == ["reply 1"]
+
+    last_page = views.get_comment_thread(post["id"], bus.uow, limit=2, cursor=page["next_cursor"])
+    assert [comment["content"] for comment in last_page["items"]] == ["comment 2"]
+    assert last_page["items"][0]["replies"] == []
+    assert last_page["next_cursor"] is None
+
+
+def test_comment_and_reply_counts(bus, post):
+    bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content="comment"))
+    comment = views.get_comments(post["id"], bus.uow)["items"][0]
+    assert views.get_post(post["id"], bus.uow)["comment_count"] == 1
+    assert views.get_comment(comment["id"], bus.uow)["reply_count"] == 0
+
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment["id"], user_id="test_user_id", content="reply"))
+    reply = views.get_reply_comments(comment["id"], bus.uow)["items"][0]
+    assert views.get_post(post["id"], bus.uow)["comment_count"] == 2
+    assert views.get_comment(comment["id"], bus.uow)["reply_count"] == 1
+
+    bus.handle(commands.DeleteCommentCommand(user_id="test_user_id", comment_id=reply["id"]))
+    assert views.get_post(post["id"], bus.uow)["comment_count"] == 1
+    assert views.get_comment(comment["id"], bus.uow)["reply_count"] == 0
+
+
+def test_delete_liked_comment_deletes_its_likes_and_replies(bus, sql_session_factory, post):
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id"))
+    bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content="comment"))
+    comment = views.get_comments(post["id"], bus.uow)["items"][0]
+    # the author of the comment liked the post too
+    bus.handle(commands.LikeCommentCommand(comment_id=comment["id"], user_id="test_user_id"))
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment["id"], user_id="test_user_id", content="reply"))
+    reply = views.get_reply_comments(comment["id"], bus.uow)["items"][0]
+    bus.handle(commands.ReplyCommentCommand(comment_id=reply["id"], user_id="test_user_id", content="reply of reply"))
+
+    bus.handle(commands.DeleteCommentCommand(user_id="test_user_id", comment_id=comment["id"]))
+
+    with sql_session_factory() as session:
+        likes = session.execute(sa.text("SELECT comment_id FROM likes WHERE post_id = :id"), {"id": post["id"]}).scalars().all()
+        comments = session.execute(sa.text("SELECT count(*) FROM comments WHERE post_id = :id"), {"id": post["id"]}).scalar()
+    # only the like of the post is left, the like of the comment did not become a second one
+    assert likes == [None]
+    assert comments == 0
+    assert views.get_comment_thread(post["id"], bus.uow)["items"] == []
+    assert views.get_post(post["id"], bus.uow)["comment_count"] == 0
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+
+
+def test_cached_comments_of_a_deleted_post_are_dropped(bus, comment):
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment["id"], user_id="test_user_id", content="reply"))
+    reply = views.get_reply_comments(comment["id"], bus.uow)["items"][0]
+    views.get_comment(comment["id"], bus.uow)
+    views.get_comment(reply["id"], bus.uow)
+
+    bus.handle(commands.DeletePostCommand(user_id="test_author_id", post_id=comment["post_id"]))
+
+    # not found anymore instead of served from the cache
+    for comment_id in (comment["id"], reply["id"]):
+        with pytest.raises(AttributeError):
+            views.get_comment(comment_id, bus.uow)
+
+
+def test_cached_replies_of_a_deleted_comment_are_dropped(bus, comment):
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment["id"], user_id="test_user_id", content="reply"))
+    reply = views.get_reply_comments(comment["id"], bus.uow)["items"][0]
+    views.get_comment(reply["id"], bus.uow)
+
+    bus.handle(commands.DeleteCommentCommand(user_id=comment["author_id"], comment_id=comment["id"]))
+
+    with pytest.raises(AttributeError):
+        views.get_comment(reply["id"], bus.uow)
+
+
+def test_delete_post_deletes_everything_of_the_post(bus, sql_session_factory, post):
+    image = UploadFile(io.BytesIO(b"image"), filename="test_image.png", size=5)
+    bus.handle(commands.AttachImageCommand(post_id=post["id"], user_id=post["author_id"], images=[image]))
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id"))
+    for i in range(3):
+        bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content=f"comment {i}"))
+    comment_id = views.get_comments(post["id"], bus.uow)["items"][0]["id"]
+    bus.handle(commands.ReplyCommentCommand(comment_id=comment_id, user_id="test_user_id", content="reply"))
+    bus.handle(commands.LikeCommentCommand(comment_id=comment_id, user_id="test_user_id"))
+    [image] = views.get_post(post["id"], bus.uow)["images"]
+    assert bus.uow.minio_client.stat_object("posts", image["path"])
+
+    _, statements = count_statements(
+        sql_session_factory.kw["bind"], lambda: bus.handle(commands.DeletePostCommand(user_id=post["author_id"], post_id=post["id"]))
+    )
+
+    # get the post, one DELETE per table and the outbox, whatever the number of comments
+    assert statements == 6
+    with sql_session_factory() as session:
+        for table in ("posts", "comments", "likes", "images"):
+            column = "id" if table == "posts" else "post_id"
+            assert session.execute(sa.text(f"SELECT count(*) FROM {table} WHERE {column} = :id"), {"id": post["id"]}).scalar() == 0
+    # the files are removed in the background
+    deadline = time.monotonic() + 5
+    while list(bus.uow.minio_client.list_objects("posts", prefix=f"posts/{post['id']}/")) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert list(bus.uow.minio_client.list_objects("posts", prefix=f"posts/{post['id']}/")) == []
+
+
+def test_retried_like_with_idempotency_key_is_not_toggled(bus, post):
+    cmd = commands.LikePostCommand(post_id=post["id"], user_id="test_user_id_retry", idempotency_key=str(uuid.uuid4()))
+
+    bus.handle(cmd)
+    bus.handle(cmd)
+
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 1
+
+
+def test_retried_create_post_is_answered_without_the_database(bus, sql_session_factory):
+    unique_title = str(uuid.uuid4())
+    cmd = commands.CreatePostCommand(title=unique_title, content="content", author_id="test_author_id", idempotency_key=str(uuid.uuid4()))
+    bus.handle(cmd)
+
+    _, statements = count_statements(sql_session_factory.kw["bind"], lambda: bus.handle(cmd))
+
+    assert statements == 0
+    assert len(views.find_post(unique_title, bus.uow)) == 1
+
+
+def test_idempotency_key_reused_for_another_command(bus, post):
+    key = str(uuid.uuid4())
+    bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content="first", idempotency_key=key))
+
+    with pytest.raises(messagebus.IdempotencyKeyReused):
+        bus.handle(commands.CommentPostCommand(post_id=post["id"], user_id="test_user_id", content="second", idempotency_key=key))
+
+    assert views.get_post(post["id"], bus.uow)["comment_count"] == 1
+
+
+def test_idempotency_key_of_another_user_is_not_shared(bus, post):
+    key = str(uuid.uuid4())
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id_1", idempotency_key=key))
+    bus.handle(commands.LikePostCommand(post_id=post["id"], user_id="test_user_id_2", idempotency_key=key))
+
+    assert views.get_post(post["id"], bus.uow)["like_count"] == 2
+
+
+def test_failed_command_frees_its_idempotency_key(bus):
+    key = str(uuid.uuid4())
+    with pytest.raises(Exception):
+        bus.handle(
+            commands.EditPostCommand(
+                user_id="test_user_id", post_id=str(uuid.uuid4()), title="title", content="content", idempotency_key=key
+            )
+        )
+
+    assert bus.idempotency_store.get(f"idempotency:EditPostCommand:test_user_id:{key}") is None
+
+
+class UnreadableStore(cache.LRUCache):
+    def get(self, key, default=None):
+        # like a RedisCache failing to read
+        return default
+
+
+def test_unreadable_idempotency_key_is_retried_a_few_times(bus, monkeypatch):
+    unique_title, key = str(uuid.uuid4()), str(uuid.uuid4())
+    store = UnreadableStore(max_size=10)
+    store.add(f"idempotency:CreatePostCommand:test_author_id:{key}", "taken")
+    sleeps = []
+    monkeypatch.setattr(bus, "idempotency_store", store)
+    monkeypatch.setattr(bus.uow, "sleep", sleeps.append)
+
+    with pytest.raises(messagebus.IdempotencyKeyInProgress):
+        bus.handle(commands.CreatePostCommand(title=unique_title, content="content", author_id="test_author_id", idempotency_key=key))
+
+    assert len(sleeps) == bus.max_retries
+    assert views.find_post(unique_title, bus.uow) == []
+
+
+def test_idempotency_pending_ttl_outlasts_a_command(monkeypatch):
+    monkeypatch.setattr(config.settings, "IDEMPOTENCY_PENDING_TTL", None)
+    monkeypatch.setattr(config.settings, "POSTGRES_POOL_TIMEOUT", 30.0)
+    monkeypatch.setattr(config.settings, "POSTGRES_STATEMENT_TIMEOUT_MS", 30000)
+    monkeypatch.setattr(config.settings, "COMMAND_MAX_RETRIES", 3)
+    monkeypatch.setattr(config.settings, "COMMAND_RETRY_MAX_DELAY", 0.5)
+
+    # 4 runs of 60 s and 3 delays of 0.5 s at most, doubled
+    assert bootstrap.idempotency_pending_ttl() == 2 * (4 * 60 + 1.5)
+
+    monkeypatch.setattr(config.settings, "IDEMPOTENCY_PENDING_TTL", 10.0)
+    assert bootstrap.idempotency_pending_ttl() == 10.0
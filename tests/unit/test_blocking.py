@@ -0,0 +1,17 @@
+import asyncio
+import threading
+
+from sqlalchemy.util import concurrency
+
+from src.app.adapters import blocking
+
+
+def test_call_from_a_coroutine_runs_in_a_thread():
+    async def main():
+        return await concurrency.greenlet_spawn(blocking.call, threading.get_ident)
+
+    assert asyncio.run(main()) != threading.get_ident()
+
+
+def test_call_from_a_thread_runs_in_the_caller():
+    assert blocking.call(threading.get_ident) == threading.get_ident()
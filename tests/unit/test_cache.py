@@ -0,0 +1,175 @@
+import concurrent.futures
+import datetime
+import json
+import threading
+import time
+
+import pytest
+
+from src.app.adapters import cache
+from tests.fakes import FakeRedis
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_is_evicted():
+    lru = cache.LRUCache(max_size=2)
+
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+
+    assert lru.get("a") == 1
+    assert lru.get("b") is None
+    assert lru.get("c") == 3
+    assert len(lru) == 2
+
+
+def test_entries_expire_after_ttl():
+    clock = Clock()
+    lru = cache.LRUCache(max_size=10, ttl=10, clock=clock)
+
+    lru.set("a", 1)
+    lru.set("b", 2, ttl=30)
+    clock.now = 20
+
+    assert lru.get("a") is None
+    assert lru.get("b") == 2
+    assert lru.get("a", "missing") == "missing"
+
+
+def test_tiered_cache_reads_through_to_the_shared_tier():
+    shared = FakeRedis()
+    worker_1 = cache.TieredCache(cache.LRUCache(max_size=10), cache.RedisCache(shared, ttl=60))
+    worker_2 = cache.TieredCache(cache.LRUCache(max_size=10), cache.RedisCache(shared, ttl=60))
+
+    worker_1.set("post:1", {"id": "1"})
+
+    assert worker_2.get("post:1") == {"id": "1"}
+    assert worker_2.local.get("post:1") == {"id": "1"}
+    assert shared.expires["post-service:post:1"] == 60
+
+    worker_1.delete("post:1")
+
+    assert worker_1.get("post:1") is None
+    assert shared.values == {}
+
+
+def test_redis_cache_reads_as_a_miss_when_the_server_is_down():
+    shared = FakeRedis()
+    redis_cache = cache.RedisCache(shared, ttl=60)
+    redis_cache.set("post:1", {"id": "1"})
+
+    shared.down = True
+    redis_cache.set("post:2", {"id": "2"})
+    redis_cache.delete("post:1")
+
+    assert redis_cache.get("post:1", "missing") == "missing"
+
+
+def test_redis_cache_stores_json():
+    shared = FakeRedis()
+    redis_cache = cache.RedisCache(shared, ttl=60)
+    redis_cache.set("post:1", (1, {"id": "1", "created_time": datetime.datetime(2024, 1, 2, 3, 4, 5)}))
+
+    assert json.loads(shared.values["post-service:post:1"]) == [1, {"id": "1", "created_time": "2024-01-02T03:04:05"}]
+    assert redis_cache.get("post:1") == [1, {"id": "1", "created_time": "2024-01-02T03:04:05"}]
+
+
+def test_single_flight_coalesces_concurrent_loads():
+    flight = cache.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    def load():
+        loads.append(1)
+        started.set()
+        release.wait()
+        return {"id": "1"}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as pool:
+        leader = pool.submit(flight.do, ("get_post", "1"), load)
+        started.wait()
+        followers = [pool.submit(flight.do, ("get_post", "1"), load) for _ in range(4)]
+        while flight.coalesced["get_post"] < 4:
+            time.sleep(0.01)
+        release.set()
+        results = [leader.result()] + [follower.result() for follower in followers]
+
+    assert len(loads) == 1
+    assert all(result is results[0] for result in results)
+    assert flight.stats() == {"get_post": {"loads": 1, "coalesced": 4}}
+    # nothing in flight anymore, the next call loads again
+    assert flight.do(("get_post", "1"), lambda: {"id": "2"}) == {"id": "2"}
+
+
+def test_single_flight_does_not_share_a_load_started_before_a_write():
+    flight = cache.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def load():
+        started.set()
+        release.wait()
+        return "before the write"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, ("get_posts", "{}"), load)
+        started.wait()
+        flight.wrote()
+        # the caller of the write loads again instead of waiting for the stale load
+        assert flight.do(("get_posts", "{}"), lambda: "after the write") == "after the write"
+        release.set()
+        assert leader.result() == "before the write"
+
+    assert flight.stats() == {"get_posts": {"loads": 2, "coalesced": 0}}
+
+
+def test_single_flight_shares_the_exception_of_a_load():
+    flight = cache.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def load():
+        started.set()
+        release.wait()
+        raise LookupError("post")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, ("get_post", "1"), load)
+        started.wait()
+        follower = pool.submit(flight.do, ("get_post", "1"), load)
+        while flight.coalesced["get_post"] < 1:
+            time.sleep(0.01)
+        release.set()
+
+        with pytest.raises(LookupError):
+            leader.result()
+        with pytest.raises(LookupError):
+            follower.result()
+
+
+def test_add_sets_only_a_missing_key():
+    clock = Clock()
+    lru = cache.LRUCache(max_size=10, ttl=10, clock=clock)
+
+    assert lru.add("a", 1)
+    assert not lru.add("a", 2)
+    assert lru.get("a") == 1
+
+    clock.now = 20
+    assert lru.add("a", 3)
+    assert lru.get("a") == 3
+
+
+def test_redis_cache_add_sets_only_a_missing_key():
+    redis_cache = cache.RedisCache(FakeRedis(), ttl=60)
+
+    assert redis_cache.add("a", 1)
+    assert not redis_cache.add("a", 2)
+    assert redis_cache.get("a") == 1
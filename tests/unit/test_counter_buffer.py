@@ -0,0 +1,96 @@
+from src.app.adapters import counter_buffer
+
+
+def test_pending_merges_buffered_deltas():
+    buffer = counter_buffer.CounterBuffer()
+
+    buffer.add("posts", "post_id", 1, 1)
+    buffer.add("posts", "post_id", 1, 2)
+    buffer.add("posts", "post_id", -1, 3)
+    buffer.add("comments", "comment_id", 1, 4)
+
+    assert buffer.pending("posts", "post_id") == 1
+    assert buffer.pending("comments", "comment_id") == 1
+    assert buffer.pending("posts", "other_post_id") == 0
+    assert buffer.pending_since("posts", "post_id", buffer.seq) == 1
+
+
+def test_flush_applies_delta_ids_in_one_batch():
+    buffer = counter_buffer.CounterBuffer()
+    batches = []
+
+    def apply(ids):
+        batches.append(ids)
+        return [("posts", "post_id"), ("comments", "comment_id")]
+
+    buffer.add("posts", "post_id", 1, 1)
+    buffer.add("comments", "comment_id", -1, 2)
+    buffer.flush(apply)
+
+    assert batches == [[1, 2]]
+    assert buffer.pending("posts", "post_id") == 0
+
+    buffer.flush(apply)
+    assert batches == [[1, 2], []]
+
+
+def test_failed_flush_keeps_deltas():
+    buffer = counter_buffer.CounterBuffer()
+    batches = []
+
+    def fail(ids):
+        raise RuntimeError("database is down")
+
+    buffer.add("posts", "post_id", 1, 1)
+    buffer.flush(fail)
+    buffer.add("posts", "post_id", 1, 2)
+
+    assert buffer.pending("posts", "post_id") == 2
+    assert buffer.seq % 2 == 0
+
+    buffer.flush(lambda ids: batches.append(ids) or [])
+    assert batches == [[1, 2]]
+
+
+def test_record_read_before_a_flush_must_be_read_again():
+    buffer = counter_buffer.CounterBuffer()
+    buffer.add("posts", "post_id", 1, 1)
+    read = buffer.seq
+
+    buffer.flush(lambda ids: [("posts", "post_id")])
+
+    assert buffer.pending_since("posts", "post_id", read) is None
+    assert buffer.pending_since("posts", "post_id", buffer.seq) == 0
+    # other records did not change, their reads still hold
+    assert buffer.pending_since("posts", "other_post_id", read) == 0
+
+
+def test_flush_being_applied():
+    buffer = counter_buffer.CounterBuffer()
+    buffer.add("posts", "post_id", 1, 1)
+    read = buffer.seq
+    seen = {}
+
+    def apply(ids):
+        # the like_count read before the flush does not have the delta, the buffer does
+        seen["before"] = buffer.pending_since("posts", "post_id", read)
+        # no record can be read consistently while it is applied
+        seen["during"] = buffer.pending_since("posts", "post_id", buffer.seq)
+        return [("posts", "post_id")]
+
+    buffer.flush(apply)
+
+    assert seen == {"before": 1, "during": None}
+
+
+def test_forgotten_flushes_read_as_flushed():
+    buffer = counter_buffer.CounterBuffer()
+    buffer.MAX_FLUSHED = 2
+    read = buffer.seq
+
+    for i in range(3):
+        buffer.add("posts", f"post_{i}", 1, i)
+        buffer.flush(lambda ids, i=i: [("posts", f"post_{i}")])
+
+    assert buffer.pending_since("posts", "other_post_id", read) is None
+    assert buffer.pending_since("posts", "other_post_id", buffer.seq) == 0
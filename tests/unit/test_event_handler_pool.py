@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+
+from sqlalchemy.util import concurrency
+
+from src.app.domain import commands
+from src.app.domain import events
+from src.app.service_layer import event_handler_pool
+from src.app.service_layer import messagebus
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_concurrency_is_limited_per_handler():
+    pool = event_handler_pool.EventHandlerPool(workers=4, max_pending=10, concurrency=1, concurrency_limits={"fast": 3})
+    release = threading.Event()
+    running = {"slow": 0, "fast": 0}
+    lock = threading.Lock()
+
+    def handler(name):
+        def run():
+            with lock:
+                running[name] += 1
+            release.wait()
+
+        return run
+
+    pool.submit("slow", handler("slow"))
+    pool.submit("slow", handler("slow"))
+    pool.submit("fast", handler("fast"))
+    pool.submit("fast", handler("fast"))
+    wait_until(lambda: running == {"slow": 1, "fast": 2})
+    time.sleep(0.05)
+    assert running == {"slow": 1, "fast": 2}
+
+    release.set()
+    pool.drain(timeout=5)
+    assert running == {"slow": 2, "fast": 2}
+
+
+def test_busy_handler_does_not_hold_a_thread():
+    pool = event_handler_pool.EventHandlerPool(workers=2, max_pending=10, concurrency=1)
+    release = threading.Event()
+    ran = []
+
+    pool.submit("slow", release.wait)
+    pool.submit("slow", lambda: ran.append("slow"))
+    pool.submit("other", lambda: ran.append("other"))
+
+    # the second slow one waits for the first without its thread, which runs the other handler
+    wait_until(lambda: ran == ["other"])
+    assert pool.stats()["deferred"] == 1
+
+    release.set()
+    pool.drain(timeout=5)
+    assert ran == ["other", "slow"]
+    assert pool.stats()["deferred"] == 0
+
+
+def test_drain_of_a_full_pool_is_bounded():
+    pool = event_handler_pool.EventHandlerPool(workers=1, max_pending=1, concurrency=1)
+    release = threading.Event()
+
+    pool.submit("slow", release.wait)
+    wait_until(lambda: pool.pending.qsize() == 0)
+    pool.submit("slow", release.wait)
+
+    start = time.monotonic()
+    pool.drain(timeout=0.1)
+
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_full_pool_runs_the_handler_in_the_caller():
+    pool = event_handler_pool.EventHandlerPool(workers=1, max_pending=1, concurrency=1, submit_timeout=0.01)
+    release = threading.Event()
+    callers = []
+
+    pool.submit("slow", release.wait)
+    wait_until(lambda: pool.pending.qsize() == 0)
+    pool.submit("slow", release.wait)
+    pool.submit("other", lambda: callers.append(threading.current_thread()))
+
+    assert callers == [threading.current_thread()]
+    assert pool.stats() == {"pending": 1, "deferred": 0, "ran_inline": 1}
+    release.set()
+    pool.drain(timeout=5)
+
+
+def test_full_pool_does_not_block_the_event_loop():
+    pool = event_handler_pool.EventHandlerPool(workers=1, max_pending=1, concurrency=1, submit_timeout=0.2)
+    release = threading.Event()
+    ticks = []
+
+    pool.submit("slow", release.wait)
+    wait_until(lambda: pool.pending.qsize() == 0)
+    pool.submit("slow", release.wait)
+
+    async def tick():
+        while not release.is_set():
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def main():
+        ticking = asyncio.create_task(tick())
+        # as a handler run by AsyncSqlAlchemyUnitOfWork.run_sync submits
+        await concurrency.greenlet_spawn(pool.submit, "other", lambda: None)
+        release.set()
+        await ticking
+
+    asyncio.run(main())
+
+    # the loop kept running while submit waited for room
+    assert len(ticks) > 5
+    assert pool.stats()["ran_inline"] == 1
+    pool.drain(timeout=5)
+
+
+def test_drain_waits_for_pending_handlers():
+    pool = event_handler_pool.EventHandlerPool(workers=2, max_pending=100, concurrency=2)
+    done = []
+
+    for i in range(20):
+        pool.submit("handler", lambda i=i: (time.sleep(0.005), done.append(i)))
+    pool.drain(timeout=5)
+
+    assert sorted(done) == list(range(20))
+    # closed, handlers run in the caller
+    pool.submit("handler", lambda: done.append(20))
+    assert len(done) == 21
+
+
+class EventsUnitOfWork:
+    def __init__(self):
+        self.new_events = []
+
+    def collect_new_events(self):
+        new_events, self.new_events = self.new_events, []
+        return new_events
+
+
+def test_command_does_not_wait_for_background_handlers():
+    uow = EventsUnitOfWork()
+    pool = event_handler_pool.EventHandlerPool(workers=2, max_pending=10, concurrency=1)
+    release = threading.Event()
+    handled = []
+
+    def create_post(cmd):
+        uow.new_events.append(events.CreatedPostEvent(post_id="post_id"))
+
+    def notify(event):
+        release.wait()
+        handled.append(("notify", event))
+        # events raised in background are handled too
+        uow.new_events.append(events.DeletedPostEvent(post_id=event.post_id))
+
+    def invalidate(event):
+        handled.append(("invalidate", event))
+
+    bus = messagebus.MessageBus(
+        uow=uow,
+        event_handlers={events.CreatedPostEvent: [invalidate], events.DeletedPostEvent: [invalidate]},
+        command_handlers={commands.CreatePostCommand: create_post},
+        background_event_handlers={events.CreatedPostEvent: [notify]},
+        event_pool=pool,
+    )
+
+    bus.handle(commands.CreatePostCommand(title="title", content="content", author_id="author_id"))
+    assert handled == [("invalidate", events.CreatedPostEvent(post_id="post_id"))]
+
+    release.set()
+    bus.drain(timeout=5)
+    assert handled[1:] == [
+        ("notify", events.CreatedPostEvent(post_id="post_id")),
+        ("invalidate", events.DeletedPostEvent(post_id="post_id")),
+    ]
@@ -0,0 +1,83 @@
+import io
+
+from fastapi import UploadFile
+
+from src.app.adapters import file_storage
+from src.app.config import settings
+from tests.fakes import FakeMinio
+
+
+def test_storage_does_not_call_minio_until_upload():
+    client = FakeMinio()
+
+    storage = file_storage.MinIOFileStorage(client)
+    storage.get("posts/post_id/image.png")
+
+    assert client.calls == []
+
+
+def test_bucket_is_checked_once():
+    client = FakeMinio()
+    storage = file_storage.MinIOFileStorage(client)
+
+    for i in range(3):
+        assert storage.add(f"posts/post_id/{i}.png", UploadFile(io.BytesIO(b"image"), filename=f"{i}.png")) == 0
+
+    assert client.calls == ["bucket_exists", "make_bucket", "put_object", "put_object", "put_object"]
+    assert client.objects[("posts", "posts/post_id/0.png")] == b"image"
+
+
+def test_upload_is_streamed_in_parts():
+    client = FakeMinio()
+    storage = file_storage.MinIOFileStorage(client)
+    content = bytes(range(256)) * (3 * settings.MINIO_UPLOAD_PART_SIZE // 256 + 1)
+    reads = []
+
+    class File(io.BytesIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super().read(size)
+
+    assert storage.add("posts/post_id/large.png", UploadFile(File(content), filename="large.png")) == 0
+
+    assert client.objects[("posts", "posts/post_id/large.png")] == content
+    assert 0 < max(reads) <= settings.MINIO_UPLOAD_PART_SIZE
+
+
+def test_add_many_uploads_in_parallel():
+    client = FakeMinio(latency=0.2)
+    storage = file_storage.MinIOFileStorage(client)
+    storage.ensure_bucket()
+    files = [(f"posts/post_id/{i}.png", UploadFile(io.BytesIO(b"image"), filename=f"{i}.png")) for i in range(4)]
+
+    err_codes = storage.add_many(files)
+
+    assert err_codes == [0, 0, 0, 0]
+    assert client.max_in_flight == 4
+    assert len(client.objects) == 4
+
+
+def test_presigned_urls_are_cached_until_deleted():
+    client = FakeMinio()
+    storage = file_storage.MinIOFileStorage(client)
+
+    url = storage.get("posts/post_id/image.png")
+    assert storage.get("posts/post_id/image.png") == url
+    assert client.signed == 1
+
+    storage.delete("posts/post_id/image.png")
+    assert storage.get("posts/post_id/image.png") != url
+    assert client.signed == 2
+
+
+def test_delete_prefix_in_bulk():
+    client = FakeMinio()
+    storage = file_storage.MinIOFileStorage(client)
+    storage.ensure_bucket()
+    client.objects.update({("posts", f"posts/post_id/{i}.png"): b"image" for i in range(2500)})
+    client.objects[("posts", "posts/other_post_id/0.png")] = b"image"
+
+    assert storage.delete_prefix("posts/post_id/") == 2500
+
+    assert list(client.objects) == [("posts", "posts/other_post_id/0.png")]
+    assert client.calls.count("remove_objects") == 3
@@ -0,0 +1,139 @@
+import threading
+
+from src.app.domain import events
+from src.app.entrypoints import redis_event_consumer
+from src.app.service_layer import messagebus
+from tests.fakes import FakeRedis
+
+STREAM = "events"
+
+
+class RecordingBus:
+    def __init__(self, fail: set[str] | None = None):
+        self.handled = []
+        self.fail = fail or set()
+        self.lock = threading.Lock()
+
+    def handle(self, message, strict=False):
+        if getattr(message, "post_id", None) in self.fail:
+            raise RuntimeError("handler failed")
+        with self.lock:
+            self.handled.append(message)
+
+
+def consumer(client, bus, name="consumer-1", claim_idle_ms=60000, max_deliveries=5):
+    stream_consumer = redis_event_consumer.StreamConsumer(
+        client,
+        bus,
+        stream=STREAM,
+        group="group",
+        consumer=name,
+        batch_size=10,
+        workers=4,
+        block_ms=10,
+        claim_idle_ms=claim_idle_ms,
+        max_deliveries=max_deliveries,
+    )
+    stream_consumer.ensure_group()
+    return stream_consumer
+
+
+def publish(client, *post_ids, outbox_id=None):
+    for post_id in post_ids:
+        # the outbox id of the event, unique unless given
+        id = outbox_id if outbox_id is not None else len(client.streams.get(STREAM, []))
+        payload = events.EditedPostEvent(post_id=post_id, version=2).model_dump_json()
+        client.xadd(STREAM, {"id": id, "type": "EditedPostEvent", "payload": payload})
+
+
+def test_messages_are_handled_in_batches_and_acked():
+    client, bus = FakeRedis(), RecordingBus()
+    stream_consumer = consumer(client, bus)
+    consumer(client, bus).ensure_group()
+    publish(client, *[f"post_{i}" for i in range(15)])
+
+    assert stream_consumer.poll() == 10
+    assert stream_consumer.poll() == 5
+    assert stream_consumer.poll() == 0
+    assert sorted(event.post_id for event in bus.handled) == sorted(f"post_{i}" for i in range(15))
+    assert client.groups[(STREAM, "group")]["pending"] == {}
+
+
+def test_failed_messages_are_claimed_by_another_consumer():
+    client = FakeRedis()
+    failing = consumer(client, RecordingBus(fail={"post_1"}), name="consumer-1", claim_idle_ms=0)
+    bus = RecordingBus()
+    other = consumer(client, bus, name="consumer-2", claim_idle_ms=0)
+    publish(client, "post_0", "post_1")
+
+    failing.poll()
+    assert list(client.groups[(STREAM, "group")]["pending"].values())[0][0] == "consumer-1"
+
+    other.poll()
+    assert [event.post_id for event in bus.handled] == ["post_1"]
+    assert client.groups[(STREAM, "group")]["pending"] == {}
+
+
+def test_unknown_messages_are_dropped():
+    client, bus = FakeRedis(), RecordingBus()
+    stream_consumer = consumer(client, bus)
+    client.xadd(STREAM, {"id": 0, "type": "NoSuchEvent", "payload": "{}"})
+    client.xadd(STREAM, {"id": 1, "type": "EditedPostEvent", "payload": "not json"})
+
+    assert stream_consumer.poll() == 2
+    assert bus.handled == []
+    assert client.groups[(STREAM, "group")]["pending"] == {}
+
+
+class EventsUnitOfWork:
+    def collect_new_events(self):
+        return []
+
+
+def test_message_of_a_failed_event_handler_is_not_acked():
+    handled = []
+
+    def fail(event):
+        raise RuntimeError("handler failed")
+
+    bus = messagebus.MessageBus(
+        uow=EventsUnitOfWork(), event_handlers={events.EditedPostEvent: [fail, handled.append]}, command_handlers={}
+    )
+    client = FakeRedis()
+    stream_consumer = consumer(client, bus)
+    publish(client, "post_0")
+
+    stream_consumer.poll()
+
+    # the other handlers still ran
+    assert [event.post_id for event in handled] == ["post_0"]
+    assert len(client.groups[(STREAM, "group")]["pending"]) == 1
+
+
+def test_failing_message_is_dead_lettered_after_max_deliveries():
+    client = FakeRedis()
+    stream_consumer = consumer(client, RecordingBus(fail={"post_0"}), claim_idle_ms=0, max_deliveries=3)
+    publish(client, "post_0")
+
+    for _ in range(4):
+        stream_consumer.poll()
+
+    assert client.groups[(STREAM, "group")]["pending"] == {}
+    [(_, fields)] = client.streams[f"{STREAM}:dead"]
+    assert fields[b"type"] == b"EditedPostEvent"
+    assert fields[b"deliveries"] == b"4"
+
+
+def test_event_published_twice_is_handled_once():
+    client, bus = FakeRedis(), RecordingBus()
+    stream_consumer = consumer(client, bus, claim_idle_ms=0)
+    # in one batch, then in another
+    publish(client, "post_0", "post_0", outbox_id=7)
+    while stream_consumer.poll():
+        pass
+    publish(client, "post_0", outbox_id=7)
+    while stream_consumer.poll():
+        pass
+
+    assert [event.post_id for event in bus.handled] == ["post_0"]
+    assert client.groups[(STREAM, "group")]["pending"] == {}